@@ -1,85 +1,75 @@
 import os
 import sys
-import pandas as pd
+import numpy as np
 REPO_ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__),
                                           os.pardir,
                                           os.pardir))
 sys.path.insert(1, os.path.join(REPO_ROOT, 'src'))
 import analysis
 import data_io
+import hubs
+import instrumentation
 
-station_subset = data_io.load_station_subset()
-incoming, outgoing = data_io.load_incoming_outgoing_conns()
-excluded_pairs = data_io.load_excluded_pairs()
-all_gains = data_io.load_gain_values("", True)
-directions = data_io.load_directions()
-unique_stations_in, unique_stations_out, _ = data_io.load_unique_station_names()
+# Transfer hub whose transfers are analysed (see hubs.HUBS),
+# can be given as the first argument of the script, eg. koeln_hbf
+HUB = hubs.get_hub(sys.argv[1] if len(sys.argv) > 1 else 'frankfurt_hbf')
+# Profiling of the stages of the run report:
+# None, 'cprofile' or 'sampling' (see instrumentation.Report)
+PROFILE = None
+report = instrumentation.Report(f'exp_006_{HUB.key}', profile=PROFILE)
+with report.stage('load') as stage:
+    station_subset = data_io.load_station_subset()
+    incoming, outgoing = data_io.load_incoming_outgoing_conns(hub=HUB)
+    # Per-train information about the origins, computed once and cached
+    origin_features = data_io.load_origin_features(incoming, HUB)
+    all_gains = data_io.load_gain_values("", True, HUB)
+    stations = data_io.load_station_dictionary(HUB)
+    stage.rows_out = len(incoming) + len(outgoing)
 
-for origin in unique_stations_in:
-    if origin not in station_subset:
-        continue
-    # do some pre-calculations for the incoming list
-    incoming_from_origin = incoming[incoming['origin'].apply(lambda x: any(origin == value for value in x))]
-    incoming_from_origin['origin_idx'] = incoming_from_origin['origin'].apply(lambda x: x.index(origin))
-    incoming_from_origin['departure_origin'] = incoming_from_origin.apply(lambda row: row['departure'][row['origin_idx']], axis=1)
-    incoming_from_origin['arrival_fra'] = incoming_from_origin['arrival'] + pd.to_timedelta(incoming_from_origin['delay'], unit='m')
-    delay_all_no_wait = {}
-    delay_all_avg_gain = {}
-    delay_all_zero_gain = {}
-    delay_all_avg_pos_gain = {}
-    delay_all_theoretical_max_gain = {}
-    print(origin)
-    for destination in unique_stations_out:
-        if (
-                destination not in station_subset
-                or origin == destination
-                or (origin, destination) in excluded_pairs
-           ):
-            continue
-        org_direction = None
-        dest_direction = None
-        for key, value_list in directions.items():
-            if origin in value_list:
-                org_direction = key
-                break
-        if org_direction:
-            for key, value_list in directions.items():
-                if destination in value_list:
-                    dest_direction = key
-                    break
-            if dest_direction and org_direction == dest_direction:
-                # Maybe skip also if directions could not be determined,
-                # and log it. Should not get called for that case though.
-                continue
-        print(destination)
-        delay_no_wait = analysis.reachable_transfers(incoming_from_origin, outgoing, origin, destination, worst_case=True)
-        delay_avg_gain = analysis.reachable_transfers(incoming_from_origin, outgoing, origin, destination, gains=all_gains['average'])
-        delay_zero_gain = analysis.reachable_transfers(incoming_from_origin, outgoing, origin, destination, estimated_gain=0.0)
-        delay_avg_pos_gain = analysis.reachable_transfers(incoming_from_origin, outgoing, origin, destination, gains=all_gains['pos_avg'])
-        delay_theoretical_max_gain = analysis.reachable_transfers(incoming_from_origin, outgoing, origin, destination, estimated_gain=0.27)
-        delay_all_no_wait[destination] = delay_no_wait
-        delay_all_avg_gain[destination] = delay_avg_gain
-        delay_all_zero_gain[destination] = delay_zero_gain
-        delay_all_avg_pos_gain[destination] = delay_avg_pos_gain
-        delay_all_theoretical_max_gain[destination] = delay_theoretical_max_gain
+# Pairs of different stations of the subset that are not excluded
+# and do not lie in the same direction
+in_subset = stations.mask(station_subset)
+origin_ids, destination_ids = stations.pairs(stations.incoming & in_subset,
+                                             stations.outgoing & in_subset)
 
-        data_io.write_json(delay_all_no_wait,
-                           f'delay_006_{data_io.filename_escape(origin)}.json',
-                           'results', 'exp_006', 'no_wait'
-                           )
-        data_io.write_json(delay_all_avg_gain,
-                           f'delay_006_{data_io.filename_escape(origin)}.json',
-                           'results', 'exp_006', 'avg_gain'
-                           )
-        data_io.write_json(delay_all_zero_gain,
-                           f'delay_006_{data_io.filename_escape(origin)}.json',
-                           'results', 'exp_006', 'zero_gain'
-                           )
-        data_io.write_json(delay_all_avg_pos_gain,
-                           f'delay_006_{data_io.filename_escape(origin)}.json',
-                           'results', 'exp_006', 'avg_pos_gain'
-                           )
-        data_io.write_json(delay_all_theoretical_max_gain,
-                           f'delay_006_{data_io.filename_escape(origin)}.json',
-                           'results', 'exp_006', 'theoretical_max_gain'
-                           )
+with report.stage('analysis', rows_in=len(origin_ids)) as stage:
+    stage.rows_out = 0
+    for origin_id in np.flatnonzero(stations.incoming & in_subset):
+        origin = stations.names[origin_id]
+        # do some pre-calculations for the incoming list
+        incoming_from_origin = origin_features.select(origin)
+        delay_all_no_wait = {}
+        delay_all_avg_gain = {}
+        delay_all_zero_gain = {}
+        delay_all_avg_pos_gain = {}
+        delay_all_theoretical_max_gain = {}
+        print(origin)
+        for destination in stations.names[destination_ids[origin_ids == origin_id]]:
+            print(destination)
+            with report.pair(origin, destination):
+                delays = analysis.reachable_transfers(
+                        incoming_from_origin, outgoing, origin, destination,
+                        scenarios=[{'worst_case': True},
+                                   {'gains': all_gains['average']},
+                                   {'estimated_gain': 0.0},
+                                   {'gains': all_gains['pos_avg']},
+                                   {'estimated_gain': 0.27}])
+            delay_no_wait, delay_avg_gain, delay_zero_gain, delay_avg_pos_gain, delay_theoretical_max_gain = delays
+            stage.rows_out += sum(len(delay['delay']) for delay in delays)
+            delay_all_no_wait[destination] = delay_no_wait
+            delay_all_avg_gain[destination] = delay_avg_gain
+            delay_all_zero_gain[destination] = delay_zero_gain
+            delay_all_avg_pos_gain[destination] = delay_avg_pos_gain
+            delay_all_theoretical_max_gain[destination] = delay_theoretical_max_gain
+
+        # Only origins with at least one destination are written
+        if delay_all_no_wait:
+            data_io.write_results(delay_all_no_wait, origin, 'exp_006', 'no_wait', HUB)
+            data_io.write_results(delay_all_avg_gain, origin, 'exp_006', 'avg_gain', HUB)
+            data_io.write_results(delay_all_zero_gain, origin, 'exp_006', 'zero_gain', HUB)
+            data_io.write_results(delay_all_avg_pos_gain, origin, 'exp_006', 'avg_pos_gain', HUB)
+            data_io.write_results(delay_all_theoretical_max_gain, origin,
+                                  'exp_006', 'theoretical_max_gain', HUB)
+# The results of all days are computed from the current train data
+data_io.clear_stale_result_days('exp_006', HUB)
+report.write()
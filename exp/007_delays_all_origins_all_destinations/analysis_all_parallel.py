@@ -1,83 +1,123 @@
 import os
 import sys
 import pandas as pd
-from parallel_pandas import ParallelPandas
 REPO_ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__),
                                           os.pardir,
                                           os.pardir))
 sys.path.insert(1, os.path.join(REPO_ROOT, 'src'))
 import analysis
 import data_io
+import hubs
+import instrumentation
+import runs
+import scheduler
 
-ParallelPandas.initialize(n_cpu=6, split_factor=3, disable_pr_bar=False, show_vmem=True)
+# Transfer hub whose transfers are analysed (see hubs.HUBS),
+# can be given as the first argument of the script, eg. koeln_hbf
+HUB = hubs.get_hub(sys.argv[1] if len(sys.argv) > 1 else 'frankfurt_hbf')
+# Number of worker processes (1 turns off parallelization)
+N_WORKERS = 6
 USE_SUBSET = False
-station_subset = data_io.load_station_subset()
-incoming, outgoing = data_io.load_incoming_outgoing_conns()
-excluded_pairs = data_io.load_excluded_pairs()
-gain_vals = data_io.load_gain_values('average')
-directions = data_io.load_directions()
-unique_stations_in, unique_stations_out, _ = data_io.load_unique_station_names()
+# Load the train data with narrower dtypes, which need less memory
+# (see data_io.load_stop_table)
+COMPACT = True
+# Upper bound in bytes for the memory of the loaded train data, or None.
+# If it is exceeded, the stops are spilled to memory-mapped files
+# instead of running out of memory (see data_io.load_incoming_outgoing_conns)
+MEMORY_BUDGET = None
+# If days of the train data changed since the last run (eg. appended days,
+# see data_io.stale_result_days), only compute the transfers around them
+# again, and merge them with the stored results. The other stored transfers
+# keep the gain estimates they were computed with, which change only
+# slightly with new days. If false, all results are computed again.
+INCREMENTAL = True
+# Profiling of the stages of the run report (in the main process):
+# None, 'cprofile' or 'sampling' (see instrumentation.Report)
+PROFILE = None
 
 # This is here to silence the warnings regarding chained assignment
 # that also display in the other experiments.
-# The warning should be a false positive,
-# and here it is silenced to allow for a progress bar to be shown.
+# The warning should be a false positive.
 pd.options.mode.chained_assignment = None
 
-# Drop data we don't need
-del outgoing['origin']
+# Data of a run that calculate_delays reads, set in every worker by init_worker
+_worker_data = {}
 
-if USE_SUBSET:
-    unique_stations_in = unique_stations_in.difference(station_subset)
-    unique_stations_out = unique_stations_out.difference(station_subset)
 
+def init_worker(hub_key, gains, stored_pairs, start_date):
+    """Sets the data of the run in a worker process"""
+    # Memory-mapped, so the worker processes share it
+    _worker_data['origin_features'] = data_io.load_origin_features(hub=hub_key)
+    _worker_data['gains'] = gains
+    _worker_data['stored_pairs'] = stored_pairs
+    _worker_data['start_date'] = start_date
 
-def get_direction(station):
-    for key, value_list in directions.items():
-        if station in value_list:
-            return key
-    return None
 
+def calculate_delays(incoming, outgoing, origin, destination):
+    incoming_from_origin = _worker_data['origin_features'].select(origin)
+    if (origin, destination) in _worker_data['stored_pairs']:
+        # The earlier transfers are taken from the stored results
+        incoming_from_origin = incoming_from_origin[
+                incoming_from_origin['date'] >= _worker_data['start_date']
+                ].reset_index(drop=True)
+    return analysis.reachable_transfers(
+           incoming_from_origin,
+           outgoing,
+           origin,
+           destination,
+           gains=_worker_data['gains'])
 
-stations_in = pd.DataFrame(unique_stations_in, columns=['origin'])
-stations_in['origin-dir'] = stations_in['origin'].apply(get_direction)
-stations_out = pd.DataFrame(unique_stations_out, columns=['destination'])
-stations_out['dest-dir'] = stations_out['destination'].apply(get_direction)
-station_pairs = stations_in.join(stations_out, how='cross')
-station_pairs = station_pairs[
-    (station_pairs['origin'] != station_pairs['destination'])
-    & station_pairs.apply(
-        lambda pair: (pair['origin'], pair['destination']) not in excluded_pairs,
-        axis=1)
-    & (pd.isna(station_pairs['origin-dir'])
-       | (station_pairs['origin-dir'] != station_pairs['dest-dir']))
-    ]
-del station_pairs['origin-dir']
-del station_pairs['dest-dir']
 
+if __name__ == '__main__':
+    report = instrumentation.Report(f'exp_007_{HUB.key}', profile=PROFILE)
+    with report.stage('load') as stage:
+        station_subset = data_io.load_station_subset()
+        incoming, outgoing = data_io.load_incoming_outgoing_conns(
+                compact=COMPACT, memory_budget=MEMORY_BUDGET, spill=True, hub=HUB)
+        # Per-train information about the origins, computed once and cached
+        # here, before the worker processes load it (see init_worker)
+        data_io.load_origin_features(incoming, HUB)
+        gain_vals = data_io.load_gain_values('average', hub=HUB)
+        stations = data_io.load_station_dictionary(HUB)
+        stage.rows_out = len(incoming) + len(outgoing)
 
-def calculate_delays_per_origin(origin):
-    incoming_from_origin = incoming[incoming['origin'].apply(
-        lambda origin_list: origin in origin_list)]
-    incoming_from_origin['origin_idx'] = incoming_from_origin['origin'].apply(
-        lambda x: x.index(origin))
-    incoming_from_origin['departure_origin'] = incoming_from_origin.apply(
-        lambda row: row['departure'][row['origin_idx']], axis=1)
-    incoming_from_origin['arrival_fra'] = incoming_from_origin['arrival'] \
-        + pd.to_timedelta(incoming_from_origin['delay'], unit='m')
-    delay_all = {}
-    for destination in \
-            station_pairs.loc[station_pairs['origin'] == origin, 'destination']:
-        delay_all[destination] = analysis.reachable_transfers(
-               incoming_from_origin,
-               outgoing,
-               origin,
-               destination,
-               gains=gain_vals)
-    data_io.write_json(delay_all,
-                       f'delay_007_{data_io.filename_escape(origin)}.json',
-                       'results', 'exp_007', 'delay')
-    return None
+    origins, destinations = stations.incoming, stations.outgoing
+    if USE_SUBSET:
+        origins = origins & ~stations.mask(station_subset)
+        destinations = destinations & ~stations.mask(station_subset)
+    # Pairs of different stations that are not excluded
+    # and do not lie in the same direction
+    pairs = stations.pair_names(origins, destinations)
 
+    stale_days = data_io.stale_result_days('exp_007', HUB) if INCREMENTAL else set()
+    stored_pairs = set()
+    start_date = None
+    if stale_days:
+        first_stale_day = min(stale_days)
+        # Transfers of trains of earlier days can arrive on the stale days
+        start_date = pd.Timestamp(first_stale_day) \
+            - pd.Timedelta(days=data_io.STALE_RESULT_LAG_DAYS)
+        stored_pairs = data_io.result_pairs('exp_007', hub=HUB)
+        print(f"Computing the transfers of trains from {start_date:%Y-%m-%d} on again "
+              f"for {len(stored_pairs)} stored pairs")
 
-pd.Series(station_pairs['origin'].unique()).p_apply(calculate_delays_per_origin)
+    # Origins that were written in a previous (interrupted) run are skipped
+    run = runs.Run('exp_007', {'gains': gain_vals, 'stale_days': sorted(stale_days)}, hub=HUB)
+    with report.stage('analysis', rows_in=len(pairs)) as stage:
+        results = scheduler.run_pairs(
+                calculate_delays, run.pending(pairs), incoming, outgoing,
+                n_workers=N_WORKERS, report=report, initializer=init_worker,
+                initargs=(HUB.key, gain_vals, stored_pairs, start_date))
+        stage.rows_out = 0
+        for origin, delay_all in scheduler.results_per_origin(run.record(results),
+                                                              run.unwritten(pairs), run.results):
+            if stale_days:
+                delay_all = data_io.merge_stale_results(
+                        delay_all, data_io.load_origin_results('exp_007', 'delay', origin, HUB),
+                        first_stale_day)
+            data_io.write_results(delay_all, origin, 'exp_007', 'delay', HUB)
+            run.mark_written(origin, delay_all)
+            stage.rows_out += sum(len(delays['delay']) for delays in delay_all.values())
+    # The results of all days are computed from the current train data
+    data_io.clear_stale_result_days('exp_007', HUB)
+    report.write()
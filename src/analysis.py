@@ -1,54 +1,255 @@
+import numpy as np
 import pandas as pd
 from datetime import datetime, time, timedelta
+import instrumentation
 
+# Parameters of reachable_transfers that can differ between the scenarios
+# evaluated in one call (see the scenarios argument)
+SCENARIO_PARAMETERS = ['max_delay', 'gains', 'estimated_gain', 'worst_case']
+# Gains bigger than this fraction of the driving time to the next stop
+# are not used to estimate the gains
+MAX_GAIN_FRACTION = 0.27
 
-def find_gains_per_next_stop(incoming, outgoing):
+
+def next_stop_gains(incoming, outgoing):
     """
-    Finds the biggest gain per next stop based on incoming and outgoing train data.
+    Computes the gains of all pairs of an incoming train and
+    the outgoing train it continues as, on the way to the next stop.
     A gain is positive if the train made up time on the way and negative
     if it lost time (delay at next station is bigger than at the previous)
 
     Args:
-    - incoming (DataFrame): DataFrame containing incoming train information.
-    - outgoing (DataFrame): DataFrame containing outgoing train information.
+    - incoming (StopTable): Incoming train information.
+    - outgoing (StopTable): Outgoing train information.
 
     Returns:
-    - gains (dict): Dictionary containing all the gains in a list for each stop
-    """
-    gains = {}
-    train_pairs = pd.merge(incoming, outgoing, on='in_id', how='inner')
-    for train_pair in train_pairs.itertuples():
-        # Extracting relevant information from the merged DataFrame
-        departure = train_pair.departure_y
-        arrival = train_pair.arrival_x
-        delay_in = train_pair.delay_x
-        delay_out = train_pair.delay_y[0]
-        destination = train_pair.destination_y[0]
-
-        # Skip data point if either of the two trains had a canceled stop
-        # as we can't obtain useful information from them
-        if (
-                1 in train_pair.cancellation_x or
-                2 in train_pair.cancellation_x or
-                1 in train_pair.cancellation_y or
-                2 in train_pair.cancellation_y
-           ):
-            continue
-
-        driving_time = (train_pair.arrival_y[0] - departure).total_seconds() / 60
-        planned_transfer_time = (departure - arrival).total_seconds() / 60
-        departure_delay = max(0, delay_in - planned_transfer_time)
-        gain = departure_delay - delay_out
-
-        # Handling cases where gain exceeds a threshold of 27% of the time the train takes
-        if gain > 0.27 * driving_time:
-            continue
-        if destination not in gains.keys():
-            gains[destination] = [gain]
-        else:
-            gains[destination].append(gain)
+    - next_stop (ndarray): Name of the next stop after Frankfurt of every gain
+    - gains (ndarray): The gains in minutes
+    """
+    incoming_trains = incoming.trains[['in_id', 'arrival', 'delay']].assign(
+            cancelled=incoming.any_stop(incoming.cancellation != 0))
+    outgoing_trains = outgoing.trains[['in_id', 'departure']].assign(
+            cancelled=outgoing.any_stop(outgoing.cancellation != 0),
+            next_stop=outgoing.station_names(outgoing.first(outgoing.station)),
+            delay_next_stop=outgoing.first(outgoing.delay),
+            arrival_next_stop=outgoing.first(outgoing.time))
+    train_pairs = pd.merge(incoming_trains, outgoing_trains, on='in_id', how='inner')
+    # Skip data points where either of the two trains had a canceled stop
+    # as we can't obtain useful information from them
+    train_pairs = train_pairs[~(train_pairs['cancelled_x'] | train_pairs['cancelled_y'])]
+
+    driving_time = minutes(train_pairs['arrival_next_stop'] - train_pairs['departure'])
+    planned_transfer_time = minutes(train_pairs['departure'] - train_pairs['arrival'])
+    departure_delay = train_pairs['delay'].to_numpy(dtype=float) - planned_transfer_time
+    # Like max(0, departure_delay), also for missing delays
+    departure_delay = np.where(departure_delay > 0, departure_delay, 0)
+    gains = departure_delay - train_pairs['delay_next_stop'].to_numpy(dtype=float)
+
+    # Handling cases where gain exceeds a threshold of 27% of the time the train takes
+    is_plausible = ~(gains > MAX_GAIN_FRACTION * driving_time)
+    return train_pairs['next_stop'].to_numpy()[is_plausible], gains[is_plausible]
+
+
+def find_gains_per_next_stop(incoming, outgoing):
+    """
+    Finds the gains per next stop based on incoming and outgoing train data
+    (see next_stop_gains).
+
+    Args:
+    - incoming (StopTable): Incoming train information.
+    - outgoing (StopTable): Outgoing train information.
+
+    Returns:
+    - gains (dict): Dictionary containing all the gains in an array for each stop
+    """
+    next_stop, gains = next_stop_gains(incoming, outgoing)
+    codes, stops = pd.factorize(next_stop)
+    order = np.argsort(codes, kind='stable')
+    bounds = np.cumsum(np.bincount(codes, minlength=len(stops)))[:-1]
+    return dict(zip(stops, np.split(gains[order], bounds)))
+
+
+def gain_statistics(next_stop, gains):
+    """
+    Computes the median, mean, maximum and mean of the positive gains
+    per next stop, for all stops at once.
+
+    Args:
+    - next_stop (array): Name of the next stop of every gain
+    - gains (array): The gains (see next_stop_gains)
 
-    return gains
+    Returns:
+    - statistics (dict): Dict with the keys 'median', 'average', 'max'
+        and 'pos_avg', each of which maps the stops to the value
+        (0 for pos_avg if there are no positive gains)
+    """
+    gains = np.asarray(gains, dtype=float)
+    codes, stops = pd.factorize(np.asarray(next_stop))
+    counts = np.bincount(codes, minlength=len(stops))
+    starts = np.cumsum(counts) - counts
+    # Gains sorted by stop, and by value within every stop (nan last)
+    sorted_gains = gains[np.lexsort((gains, codes))]
+    median = (sorted_gains[starts + (counts - 1) // 2]
+              + sorted_gains[starts + counts // 2]) / 2
+    median[np.bincount(codes, weights=np.isnan(gains), minlength=len(stops)) > 0] = np.nan
+    average = np.bincount(codes, weights=gains, minlength=len(stops)) / counts
+    maximum = sorted_gains[starts + counts - 1]
+    is_positive = gains > 0
+    positive_counts = np.bincount(codes[is_positive], minlength=len(stops))
+    positive_sums = np.bincount(codes[is_positive], weights=gains[is_positive],
+                                minlength=len(stops))
+    positive_average = np.where(positive_counts > 0,
+                                positive_sums / np.maximum(positive_counts, 1), 0)
+    return {name: dict(zip(stops, values.tolist()))
+            for name, values in (('median', median), ('average', average),
+                                 ('max', maximum), ('pos_avg', positive_average))}
+
+
+class GainStatistics:
+    """
+    Running version of gain_statistics, to which the gains can be added
+    in parts (eg. per month of data), without keeping all of them.
+    The means and maxima are exact, the medians are estimated with a
+    quantile sketch, in which the gains are counted in buckets whose
+    bounds grow exponentially, such that every estimate is within
+    relative_accuracy of a gain of the right rank.
+    Gains whose absolute value is smaller than min_value are counted as 0.
+    """
+
+    # Bucket keys of one stop lie within [-KEY_RANGE / 2, KEY_RANGE / 2)
+    KEY_RANGE = 2**32
+
+    def __init__(self, relative_accuracy=0.01, min_value=0.01):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.min_index = np.ceil(np.log(min_value) / np.log(self.gamma))
+        self.min_value = min_value
+        self.stops = {}
+        self.count = np.zeros(0, dtype=np.int64)
+        self.sum = np.zeros(0)
+        self.max = np.zeros(0)
+        self.positive_count = np.zeros(0, dtype=np.int64)
+        self.positive_sum = np.zeros(0)
+        self.has_nan = np.zeros(0, dtype=bool)
+        self.buckets = {}
+
+    def add(self, next_stop, gains):
+        """Adds gains with their next stops (see next_stop_gains)"""
+        gains = np.asarray(gains, dtype=float)
+        chunk_codes, chunk_stops = pd.factorize(np.asarray(next_stop))
+        for stop in chunk_stops:
+            self.stops.setdefault(stop, len(self.stops))
+        self.grow(len(self.stops))
+        codes = np.array([self.stops[stop] for stop in chunk_stops],
+                         dtype=np.int64)[chunk_codes]
+        num = len(self.stops)
+        self.count += np.bincount(codes, minlength=num)
+        self.sum += np.bincount(codes, weights=gains, minlength=num)
+        maximum = np.full(num, -np.inf)
+        np.fmax.at(maximum, codes, gains)
+        self.max = np.fmax(self.max, maximum)
+        is_positive = gains > 0
+        self.positive_count += np.bincount(codes[is_positive], minlength=num)
+        self.positive_sum += np.bincount(codes[is_positive], weights=gains[is_positive],
+                                         minlength=num)
+        is_nan = np.isnan(gains)
+        self.has_nan[codes[is_nan]] = True
+        keys, key_counts = np.unique(
+                codes[~is_nan] * self.KEY_RANGE + self.bucket_keys(gains[~is_nan]),
+                return_counts=True)
+        for key, key_count in zip(keys.tolist(), key_counts.tolist()):
+            self.buckets[key] = self.buckets.get(key, 0) + key_count
+
+    def grow(self, num):
+        missing = num - len(self.count)
+        if missing <= 0:
+            return
+        self.count = np.concatenate([self.count, np.zeros(missing, dtype=np.int64)])
+        self.sum = np.concatenate([self.sum, np.zeros(missing)])
+        self.max = np.concatenate([self.max, np.full(missing, -np.inf)])
+        self.positive_count = np.concatenate(
+                [self.positive_count, np.zeros(missing, dtype=np.int64)])
+        self.positive_sum = np.concatenate([self.positive_sum, np.zeros(missing)])
+        self.has_nan = np.concatenate([self.has_nan, np.zeros(missing, dtype=bool)])
+
+    def bucket_keys(self, values):
+        """
+        Key of the bucket of every value, offset to be non-negative.
+        The keys are ordered like the values, 0 is the bucket of values
+        close to 0, and the signs of the keys are the signs of the values.
+        """
+        magnitude = np.maximum(np.abs(values), self.min_value)
+        index = np.ceil(np.log(magnitude) / np.log(self.gamma)) - self.min_index + 1
+        keys = np.where(np.abs(values) < self.min_value, 0, np.sign(values) * index)
+        return keys.astype(np.int64) + self.KEY_RANGE // 2
+
+    def bucket_values(self, keys):
+        """Estimate of the values in the buckets with the given keys"""
+        keys = np.asarray(keys, dtype=np.int64) - self.KEY_RANGE // 2
+        index = np.abs(keys) + self.min_index - 1
+        return np.where(keys == 0, 0.0,
+                        np.sign(keys) * 2 * self.gamma**index / (self.gamma + 1))
+
+    def medians(self):
+        """Estimated median per stop, like np.median (nan if there are nan gains)"""
+        keys = np.array(sorted(self.buckets), dtype=np.int64)
+        key_counts = np.array([self.buckets[key] for key in keys], dtype=np.int64)
+        codes = keys // self.KEY_RANGE
+        values = self.bucket_values(keys % self.KEY_RANGE)
+        medians = np.full(len(self.count), np.nan)
+        # The buckets of every stop are contiguous and ordered by value
+        for in_stop in np.split(np.arange(len(keys)), np.flatnonzero(np.diff(codes)) + 1):
+            if len(in_stop) == 0:
+                continue
+            cumulative = np.cumsum(key_counts[in_stop])
+            num = cumulative[-1]
+            # The gain of rank r is in the first bucket with more than r smaller gains
+            lower, upper = values[in_stop][np.searchsorted(
+                    cumulative, [(num - 1) // 2, num // 2], side='right')]
+            medians[codes[in_stop[0]]] = (lower + upper) / 2
+        medians[self.has_nan] = np.nan
+        return medians
+
+    def state(self):
+        """
+        The sketch as a dict of lists (that can be stored as JSON),
+        from which it can be restored with from_state.
+        """
+        return {'gamma': self.gamma, 'min_value': self.min_value,
+                'stops': list(self.stops), 'count': self.count.tolist(),
+                'sum': self.sum.tolist(), 'max': self.max.tolist(),
+                'positive_count': self.positive_count.tolist(),
+                'positive_sum': self.positive_sum.tolist(),
+                'has_nan': self.has_nan.tolist(),
+                'bucket_keys': list(self.buckets),
+                'bucket_counts': list(self.buckets.values())}
+
+    @classmethod
+    def from_state(cls, state):
+        """Restores a sketch from the output of state"""
+        gain_statistics = cls(min_value=state['min_value'])
+        gain_statistics.gamma = state['gamma']
+        gain_statistics.min_index = np.ceil(np.log(state['min_value'])
+                                            / np.log(state['gamma']))
+        gain_statistics.stops = {stop: code for code, stop in enumerate(state['stops'])}
+        gain_statistics.count = np.array(state['count'], dtype=np.int64)
+        gain_statistics.sum = np.array(state['sum'], dtype=float)
+        gain_statistics.max = np.array(state['max'], dtype=float)
+        gain_statistics.positive_count = np.array(state['positive_count'], dtype=np.int64)
+        gain_statistics.positive_sum = np.array(state['positive_sum'], dtype=float)
+        gain_statistics.has_nan = np.array(state['has_nan'], dtype=bool)
+        gain_statistics.buckets = dict(zip(state['bucket_keys'], state['bucket_counts']))
+        return gain_statistics
+
+    def statistics(self):
+        """The statistics in the format of gain_statistics"""
+        stops = list(self.stops)
+        average = self.sum / self.count
+        maximum = np.where(self.has_nan, np.nan, self.max)
+        positive_average = np.where(self.positive_count > 0,
+                                    self.positive_sum / np.maximum(self.positive_count, 1), 0)
+        return {name: dict(zip(stops, values.tolist()))
+                for name, values in (('median', self.medians()), ('average', average),
+                                     ('max', maximum), ('pos_avg', positive_average))}
 
 
 def get_plan_and_delay_difference(train_pair, gains={}, estimated_gain=0.0, worst_case=False):
@@ -82,11 +283,11 @@ def get_plan_and_delay_difference(train_pair, gains={}, estimated_gain=0.0, wors
     - delay_difference (float): Difference between the arrival delay of the
         first train and the departure delay of the second train
     """
-    arrival_FRA = train_pair.arrival_x
-    departure_FRA = train_pair.departure_y
-    in_delay = train_pair.delay_x
-    next_stop = train_pair.destination_y[0]
-    delay_at_next_stop = train_pair.delay_y[0]
+    arrival_FRA = train_pair.arrival
+    departure_FRA = train_pair.departure
+    in_delay = train_pair.delay
+    next_stop = train_pair.next_stop
+    delay_at_next_stop = train_pair.delay_next_stop
     arrival_at_next_stop = train_pair.arrival_next_stop
     plan_difference = (departure_FRA - arrival_FRA).total_seconds() / 60
 
@@ -145,93 +346,318 @@ def find_next_train(train, next_train_candidates, gains={}, estimated_gain=0.0,
     - next_train (Next Train in the Dataframe or None): The next train information, if found; otherwise, None.
     - time_difference (float): Time difference in minutes between the next train's departure and the current train's plan_departure.
     """
-    dest_idx = train.destination_idx
     plan_arrival = train.arrival_destination
     next_train_candidates = next_train_candidates[
             ~next_train_candidates['cancellation_inbound']
             & ~next_train_candidates['cancellation_outbound']
-            ].sort_values(by=['arrival_destination'])
+            ].sort_values(by=['arrival_destination'], kind='stable')
     while not next_train_candidates.empty:
         next_train = next_train_candidates.iloc[0]
-        dest_idx = next_train.destination_idx
         if not can_take_connecting_train(
                     next_train, gains, estimated_gain, worst_case):
             next_train_candidates.drop(next_train_candidates.index[0], inplace=True)
         else:
-            return next_train, (next_train.arrival_destination - plan_arrival).total_seconds() / 60, dest_idx
-    return None, 0, 0
-
-
-def add_columns(candidate_transfers, destination):
-    candidate_transfers.loc[:, 'destination_idx'] = \
-            candidate_transfers['destination_y'] \
-            .apply(lambda destinations: destinations.index(destination))
-    candidate_transfers['arrival_destination'] = candidate_transfers.apply(
-        lambda tp: tp['arrival_y'][tp['destination_idx']], axis=1)
-    candidate_transfers['arrival_next_stop'] = candidate_transfers['arrival_y'] \
-        .apply(lambda arrival_lst: arrival_lst[0])
-    candidate_transfers['cancellation_inbound'] = candidate_transfers.apply(
-        lambda tp: tp['cancellation_x'][-1] != 0 \
-                   or tp['cancellation_x'][tp['origin_idx']] != 0,
-        axis=1
-    )
-    candidate_transfers['cancellation_outbound'] = candidate_transfers.apply(
-        lambda tp: tp['cancellation_y'][tp['destination_idx']] != 0,
-        axis=1
-    )
-    return candidate_transfers
+            return next_train, (next_train.arrival_destination - plan_arrival).total_seconds() / 60
+    return None, 0
 
-def reachable_transfers(incoming_from_origin, outgoing, origin, destination, max_delay=60,
-                        gains={}, max_hours=4, estimated_gain=0.0, worst_case=False, debug=False):
-    # TODO
-    # This function is in dire need of refactoring
+
+def select_incoming_from_origin(incoming, origin):
     """
-    Identifies reachable transfers between incoming and outgoing trains.
+    Selects the incoming trains that stop at origin, and adds
+    the per-train information about origin needed in reachable_transfers.
+
+    Args:
+    - incoming (StopTable): Incoming train information.
+    - origin (str): Name of the origin station.
+
+    Returns:
+    - incoming_from_origin (DataFrame): One row per train that goes
+        from origin to Frankfurt
+    """
+    return compute_origin_features(incoming, *incoming.trains_at(origin))
+
+
+def widen_dtypes(frame):
+    """
+    Converts the narrow dtypes of compact StopTables (see data_io.load_stop_table)
+    back to int64 and float64, so that the analysis gives identical results
+    on compact and full tables. Only copies the columns that are converted.
+    """
+    for column, values in frame.items():
+        if values.dtype.kind in 'iu' and values.dtype != np.int64:
+            frame[column] = values.astype(np.int64)
+        elif values.dtype == np.float32:
+            frame[column] = values.astype(np.float64)
+    return frame
+
+
+def compute_origin_features(incoming, rows, origin_idx):
+    """
+    Computes the per-train information about the origin needed in
+    reachable_transfers, for the incoming trains in rows whose origin is
+    the stop at position origin_idx within the train
+    (see select_incoming_from_origin and origin_features.OriginFeatures).
+
+    Returns:
+    - DataFrame with one row per entry of rows
+    """
+    incoming_from_origin = widen_dtypes(incoming.trains.loc[
+            rows, ['in_id', 'date', 'arrival', 'delay']].reset_index(drop=True))
+    incoming_from_origin['origin_idx'] = np.asarray(origin_idx, dtype=np.int64)
+    incoming_from_origin['departure_origin'] = \
+        incoming.at(incoming.time, origin_idx, rows)
+    incoming_from_origin['arrival_fra'] = incoming_from_origin['arrival'] \
+        + pd.to_timedelta(incoming_from_origin['delay'], unit='m')
+    incoming_from_origin['cancellation_inbound'] = \
+        (incoming.last(incoming.cancellation, rows) != 0) \
+        | (incoming.at(incoming.cancellation, origin_idx, rows) != 0)
+    return incoming_from_origin
+
+
+def select_outgoing_to_destination(outgoing, destination):
+    """
+    Selects the outgoing trains that stop at destination, and adds
+    the per-train information about destination and the next stop
+    after Frankfurt needed in reachable_transfers.
+
+    Args:
+    - outgoing (StopTable): Outgoing train information.
+    - destination (str): Name of the destination station.
+
+    Returns:
+    - outgoing_to_dest (DataFrame): One row per train that goes
+        from Frankfurt to destination.
+        The result is cached in the station index of outgoing,
+        and must not be modified.
+    """
+    views = outgoing.station_index.views
+    if destination in views:
+        return views[destination]
+    rows, destination_idx = outgoing.trains_at(destination)
+    outgoing_to_dest = outgoing.trains.loc[
+            rows, ['out_id', 'in_id', 'date', 'departure']].reset_index(drop=True)
+    outgoing_to_dest['destination_idx'] = destination_idx
+    outgoing_to_dest['arrival_destination'] = \
+        outgoing.at(outgoing.time, destination_idx, rows)
+    outgoing_to_dest['delay_destination'] = \
+        outgoing.at(outgoing.delay, destination_idx, rows)
+    outgoing_to_dest['cancellation_outbound'] = \
+        outgoing.at(outgoing.cancellation, destination_idx, rows) != 0
+    outgoing_to_dest['next_stop'] = \
+        outgoing.station_names(outgoing.first(outgoing.station, rows))
+    outgoing_to_dest['arrival_next_stop'] = outgoing.first(outgoing.time, rows)
+    outgoing_to_dest['delay_next_stop'] = outgoing.first(outgoing.delay, rows)
+    views[destination] = widen_dtypes(outgoing_to_dest)
+    return outgoing_to_dest
+
+
+class OutgoingCalendar:
+    """
+    Calendar of the trains to a destination (see select_outgoing_to_destination),
+    sorted by date and by departure within every date, so that the trains
+    of a date that depart within a time window are a contiguous range,
+    which is found with a binary search.
+    Dates are counted in days since 1970, so the day after a date is
+    always the next number, also at the end of a month or year.
+
+    Attributes:
+    - order: rows of outgoing_to_dest in the order of the calendar
+    """
+
+    def __init__(self, outgoing_to_dest):
+        day = outgoing_to_dest['date'].to_numpy(dtype='datetime64[D]').view(np.int64)
+        departure = outgoing_to_dest['departure'].to_numpy(dtype='datetime64[ns]').view(np.int64)
+        self.order = np.lexsort((np.arange(len(outgoing_to_dest)), departure, day))
+        # Same technique as in find_first_alternatives: the day and the rank
+        # of the departure are combined into one sorted key
+        self.departures = np.unique(departure)
+        self.num_keys = len(self.departures) + 1
+        self.key = day[self.order] * self.num_keys \
+            + np.searchsorted(self.departures, departure[self.order])
+
+    def window(self, day, start, end):
+        """
+        Finds the trains on the given days that depart after start
+        and not after end, for many windows at once.
+
+        Args:
+        - day (array of datetime64[D]): date of every window
+        - start, end (arrays of datetime64[ns]): bounds of every window
+
+        Returns:
+        - first, stop (arrays of int): the trains of every window are
+            order[first:stop]
+        """
+        day = np.asarray(day, dtype='datetime64[D]').view(np.int64)
+        start = np.asarray(start, dtype='datetime64[ns]').view(np.int64)
+        end = np.asarray(end, dtype='datetime64[ns]').view(np.int64)
+        first = np.searchsorted(
+                self.key, day * self.num_keys
+                + np.searchsorted(self.departures, start, side='right'))
+        stop = np.searchsorted(
+                self.key, day * self.num_keys
+                + np.searchsorted(self.departures, end, side='right'))
+        return first, stop
+
+
+def outgoing_calendar(outgoing, destination):
+    """
+    Returns the OutgoingCalendar of the trains to destination.
+    Like select_outgoing_to_destination, it is cached in the station index
+    of outgoing.
+    """
+    calendars = outgoing.station_index.calendars
+    if destination not in calendars:
+        calendars[destination] = OutgoingCalendar(
+                select_outgoing_to_destination(outgoing, destination))
+    return calendars[destination]
+
+
+def expand_ranges(first, stop):
+    """
+    Expands ranges first[i]:stop[i] into the number i of the range and
+    the position of every element of the ranges, in order.
+    """
+    counts = stop - first
+    query = np.repeat(np.arange(len(counts)), counts)
+    positions = np.repeat(first - np.cumsum(counts) + counts, counts) \
+        + np.arange(counts.sum())
+    return query, positions
+
+
+def find_candidate_transfers(incoming_from_origin, outgoing_to_dest, max_hours=4, debug=False,
+                             calendar=None):
+    """
+    Finds all pairs of an incoming train from origin and an outgoing train
+    to destination on the same date that one could transfer between.
+    Instead of forming all pairs of trains on a date and filtering them,
+    the outgoing trains that depart within the transfer window of every
+    incoming train are looked up in the calendar, so only the pairs that
+    are returned are formed. The windows are given by timestamps,
+    so windows that extend past midnight are no special case.
 
     Args:
     - incoming_from_origin (DataFrame): DataFrame containing trains that go from origin to Frankfurt
-    - outgoing (DataFrame): DataFrame containing outgoing train information.
-    - gains (dict, optional): Dictionary containing gains. Default is an empty dictionary.
-    - estimated_gain (float, optional): Estimated gain. Default is 0.0.
-    - worst_case (bool, optional): Flag for worst-case scenario. Default is False.
+        (see select_incoming_from_origin)
+    - outgoing_to_dest (DataFrame): DataFrame containing trains that go from Frankfurt to destination
+        (see select_outgoing_to_destination)
+    - max_hours (int, optional): Maximum time between arrival and departure in Frankfurt.
+    - calendar (OutgoingCalendar, optional): Calendar of outgoing_to_dest.
+        Built from outgoing_to_dest by default.
 
     Returns:
-    - reachable_count (dict): Count of reachable and unreachable transfers based on plan and delay differences.
-    - delay (dict): Average delay information for each plan difference.
+    - candidate_transfers (DataFrame): One row per train pair, with the columns
+        of both inputs (in_id is named in_id_x and in_id_y), and the transfer_time
     """
     max_delay_minutes = max_hours * 60
-    delay = {'switch time': [], 'date': [], 'delay': [], 'reachable': []}
-    outgoing_to_dest = outgoing[
-            outgoing['destination']
-            .apply(lambda destinations: destination in destinations)]
+    if calendar is None:
+        calendar = OutgoingCalendar(outgoing_to_dest)
+    if debug:
+        print(len(incoming_from_origin), incoming_from_origin['in_id'].nunique())
     # Train pairs where one train goes from origin to Frankfurt
     # and the other train (possible the same train)
-    # goes from Frankfurt to destination
-    candidate_transfers = incoming_from_origin.merge(outgoing_to_dest,
-                                                     how='outer',
-                                                     on='date')
-    candidate_transfers.dropna(subset='origin_idx', inplace=True)
+    # goes from Frankfurt to destination on the same date, and departs
+    # after the first train arrived, but not more than max_hours later
+    arrival = incoming_from_origin['arrival'].to_numpy(dtype='datetime64[ns]')
+    in_rows, positions = expand_ranges(*calendar.window(
+            incoming_from_origin['date'].to_numpy(dtype='datetime64[D]'),
+            arrival, arrival + np.timedelta64(max_delay_minutes, 'm')))
+    out_rows = calendar.order[positions]
+    # Filter out trains that go from origin to destination directly,
+    # as there is no train transfer in that case.
+    is_transfer = incoming_from_origin['in_id'].to_numpy()[in_rows] \
+        != outgoing_to_dest['in_id'].to_numpy()[out_rows]
+    in_rows, out_rows = in_rows[is_transfer], out_rows[is_transfer]
+    # Same order as merging the trains on the date: by date, in the order
+    # in which the dates first occur in incoming_from_origin, then by rows
+    date_order = pd.factorize(incoming_from_origin['date'])[0]
+    order = np.lexsort((out_rows, in_rows, date_order[in_rows]))
+    in_rows, out_rows = in_rows[order], out_rows[order]
+    candidate_transfers = pd.concat(
+            [incoming_from_origin.iloc[in_rows].reset_index(drop=True)
+             .rename(columns={'in_id': 'in_id_x'}),
+             outgoing_to_dest.iloc[out_rows].drop(columns='date').reset_index(drop=True)
+             .rename(columns={'in_id': 'in_id_y'})],
+            axis=1)
     candidate_transfers['origin_idx'] = candidate_transfers['origin_idx'].astype(int)
     # Time between the arrival of the first train at Frankfurt and
     # the departure of the second train
     candidate_transfers['transfer_time'] = \
-        (candidate_transfers['departure_y']
-         - candidate_transfers['arrival_x']).dt.total_seconds() / 60
-    if debug:
-        print(len(incoming_from_origin), len(candidate_transfers['in_id_x'].unique()))
-    # Filter out trains that go from origin to destination directly,
-    # as there is no train transfer in that case.
-    candidate_transfers = candidate_transfers[
-            candidate_transfers['in_id_x'] != candidate_transfers['in_id_y']]
-    # Filter out trains that one can not transfer to, because they departed
-    # before the incoming train arrived, or because it would take too long
-    # (Restriction: may not take longer than max_hours)
-    candidate_transfers = candidate_transfers[
-            (candidate_transfers['transfer_time'] > 0) &
-            (candidate_transfers['transfer_time'] <= max_delay_minutes)]
+        (candidate_transfers['departure']
+         - candidate_transfers['arrival']).dt.total_seconds() / 60
+    return candidate_transfers.astype(
+            {'cancellation_inbound': bool, 'cancellation_outbound': bool})
+
+
+def reachable_transfers(incoming_from_origin, outgoing, origin, destination, max_delay=60,
+                        gains={}, max_hours=4, estimated_gain=0.0, worst_case=False, debug=False,
+                        engine='vectorized', scenarios=None):
+    """
+    Identifies reachable transfers between incoming and outgoing trains.
+
+    Args:
+    - incoming_from_origin (DataFrame): DataFrame containing trains that go from origin to Frankfurt
+        (see select_incoming_from_origin)
+    - outgoing (StopTable): Outgoing train information.
+    - gains (dict, optional): Dictionary containing gains. Default is an empty dictionary.
+    - estimated_gain (float, optional): Estimated gain. Default is 0.0.
+    - worst_case (bool, optional): Flag for worst-case scenario. Default is False.
+    - engine (str, optional): 'vectorized' (default) or 'reference' to
+        select the implementation, or 'compare' to run both and raise an
+        AssertionError if their results are not identical.
+    - scenarios (list of dict, optional): If given, the transfers are
+        evaluated for every scenario, and a list with one result per scenario
+        is returned. A scenario contains values for (some of) SCENARIO_PARAMETERS,
+        the other ones are taken from the arguments.
+        The candidate transfers are only determined once for all scenarios.
+
+    Returns:
+    - delay (dict): Lists of the switch time, date, delay and reachability
+        case of every transfer.
+    """
+    if scenarios is None:
+        return reachable_transfers(incoming_from_origin, outgoing, origin, destination,
+                                   max_delay, gains, max_hours, estimated_gain, worst_case,
+                                   debug, engine, scenarios=[{}])[0]
+    defaults = {'max_delay': max_delay, 'gains': gains,
+                'estimated_gain': estimated_gain, 'worst_case': worst_case}
+    for scenario in scenarios:
+        unknown = set(scenario) - set(SCENARIO_PARAMETERS)
+        if unknown:
+            raise ValueError(f"Unknown scenario parameters: {sorted(unknown)}")
+    scenarios = [{**defaults, **scenario} for scenario in scenarios]
+    outgoing_to_dest = select_outgoing_to_destination(outgoing, destination)
+    calendar = outgoing_calendar(outgoing, destination)
+    candidate_transfers = find_candidate_transfers(
+            incoming_from_origin, outgoing_to_dest, max_hours, debug, calendar)
+    if engine not in ('reference', 'vectorized', 'compare'):
+        raise ValueError(f"Unknown engine: {engine}")
+    if engine != 'vectorized':
+        delays_reference = [
+                reachable_transfers_reference(
+                    candidate_transfers, incoming_from_origin, outgoing_to_dest,
+                    max_hours=max_hours, debug=debug, **scenario)
+                for scenario in scenarios]
+        if engine == 'reference':
+            return delays_reference
+    delays = reachable_transfers_vectorized(
+            candidate_transfers, outgoing_to_dest, calendar, scenarios, max_hours, debug)
+    if engine == 'compare' and delays != delays_reference:
+        raise AssertionError(
+                f"Engines disagree on transfers from {origin} to {destination}")
+    return delays
+
+
+def reachable_transfers_reference(candidate_transfers, incoming_from_origin, outgoing_to_dest,
+                                  max_delay, gains, max_hours, estimated_gain, worst_case, debug):
+    """
+    Reference implementation of reachable_transfers,
+    which handles every candidate transfer on its own.
+    """
+    max_delay_minutes = max_hours * 60
+    delay = {'switch time': [], 'date': [], 'delay': [], 'reachable': []}
     if candidate_transfers.empty:
         return delay
-    candidate_transfers = add_columns(candidate_transfers, destination)
     num_discarded = 0
     unique_ids = candidate_transfers['in_id_x'].unique()
     # Counters for a quick sanity check. Not used further in the analysis.
@@ -247,12 +673,11 @@ def reachable_transfers(incoming_from_origin, outgoing, origin, destination, max
                 candidate_transfers['date'] == example_train['date']]
         for train in group_id.itertuples():
             # filter out trains for which we can't find next trains as we merge on the date
-            # or train.departure_y.time() > threshold_time
+            # or train.departure.time() > threshold_time
             if train.transfer_time > max_delay:
                 num_discarded += 1
                 continue
-            dest_idx = train.destination_idx
-            plan_arrival = train.arrival_y[dest_idx]
+            plan_arrival = train.arrival_destination
             arrival_FRA = train.arrival_fra
             plan_departure_origin = train.departure_origin
             plan_difference, delay_difference = \
@@ -266,7 +691,7 @@ def reachable_transfers(incoming_from_origin, outgoing, origin, destination, max
                 # at the origin after the original train
                 candidate_connections_to_frankfurt = group_date[
                         group_date['departure_origin'] > plan_departure_origin]
-                next_train, extra_delay, dest_idx = \
+                next_train, extra_delay = \
                     find_next_train(train,
                                     candidate_connections_to_frankfurt,
                                     gains,
@@ -274,7 +699,7 @@ def reachable_transfers(incoming_from_origin, outgoing, origin, destination, max
                                     worst_case)
                 if next_train is not None:
                     num_found_alternative_to_frankfurt += 1
-                    train_delay = next_train.delay_y[dest_idx] + extra_delay
+                    train_delay = next_train.delay_destination + extra_delay
                 else:
                     num_not_found_alternative_to_frankfurt += 1
                     train_delay = max_delay_minutes - train.transfer_time
@@ -282,8 +707,8 @@ def reachable_transfers(incoming_from_origin, outgoing, origin, destination, max
                 # If the departing train was cancelled or transfer to it is impossible
                 train_reachable = 2
                 # only look at trains that leave later in Frankfurt
-                candidate_departing_trains = group_id[group_id['departure_y'] > arrival_FRA]
-                next_train, extra_delay, dest_idx = \
+                candidate_departing_trains = group_id[group_id['departure'] > arrival_FRA]
+                next_train, extra_delay = \
                     find_next_train(train,
                                     candidate_departing_trains,
                                     gains,
@@ -291,23 +716,22 @@ def reachable_transfers(incoming_from_origin, outgoing, origin, destination, max
                                     worst_case)
                 if next_train is not None:
                     num_found_alternative_from_frankfurt += 1
-                    train_delay = next_train.delay_y[dest_idx] + extra_delay
+                    train_delay = next_train.delay_destination + extra_delay
                 else:
-                    if train.arrival_x.time() > time(24 - max_hours, 0, 0):
+                    if train.arrival.time() > time(24 - max_hours, 0, 0):
                         df1 = incoming_from_origin[incoming_from_origin['in_id'] == train.in_id_x]
                         df2 = outgoing_to_dest[outgoing_to_dest['date'] == train.date + timedelta(days=1)]
                         candidate_transfers_next_day = df1.merge(df2, how='cross')
                         if not candidate_transfers_next_day.empty:
-                            candidate_transfers_next_day = add_columns(candidate_transfers_next_day, destination)
                             candidate_transfers_next_day['transfer_time'] = \
-                                (candidate_transfers_next_day['departure_y']
-                                 - candidate_transfers_next_day['arrival_x']).dt.total_seconds() / 60
+                                (candidate_transfers_next_day['departure']
+                                 - candidate_transfers_next_day['arrival']).dt.total_seconds() / 60
                             candidate_transfers_next_day = candidate_transfers_next_day[
                                 candidate_transfers_next_day['transfer_time'] <= max_delay_minutes]
-                            next_train, extra_delay, dest_idx = find_next_train(train, candidate_transfers_next_day, gains, estimated_gain, worst_case)
+                            next_train, extra_delay = find_next_train(train, candidate_transfers_next_day, gains, estimated_gain, worst_case)
                             if next_train is not None:
                                 num_found_alternative_from_frankfurt += 1
-                                train_delay = next_train.delay_y[dest_idx] + extra_delay
+                                train_delay = next_train.delay_destination + extra_delay
                             else:
                                 num_not_found_alternative_from_frankfurt += 1
                                 train_delay = max_delay_minutes - train.transfer_time
@@ -320,7 +744,7 @@ def reachable_transfers(incoming_from_origin, outgoing, origin, destination, max
             else:
                 # If it was possible to take the connecting train as planned
                 train_reachable = 3
-                train_delay = train.delay_y[dest_idx]
+                train_delay = train.delay_destination
             if train_delay >= 0:
                 delay['switch time'].append(plan_difference)
                 delay['date'].append(plan_arrival.strftime('%Y-%m-%d %H:%M:%S'))
@@ -335,3 +759,268 @@ def reachable_transfers(incoming_from_origin, outgoing, origin, destination, max
               num_found_alternative_from_frankfurt,
               num_not_found_alternative_from_frankfurt)
     return delay
+
+
+def minutes(timedeltas):
+    """
+    Converts timedelta64[ns] values to minutes,
+    with the same result as Timedelta.total_seconds() / 60.
+    """
+    return seconds(timedeltas) / 60
+
+
+def seconds(timedeltas):
+    """
+    Converts timedelta64[ns] values to seconds,
+    with the same result as Timedelta.total_seconds().
+    """
+    return np.asarray(timedeltas, dtype='timedelta64[ns]').astype(np.int64) / 1e9
+
+
+def plan_and_delay_differences(train_pairs, gains={}, estimated_gain=0.0, worst_case=False):
+    """
+    Vectorized version of get_plan_and_delay_difference
+    for all rows of train_pairs at once.
+
+    Returns:
+    - plan_difference (array): see get_plan_and_delay_difference
+    - delay_difference (array): see get_plan_and_delay_difference
+    """
+    departure = train_pairs['departure'].to_numpy()
+    plan_difference = minutes(departure - train_pairs['arrival'].to_numpy())
+    delay_at_next_stop = train_pairs['delay_next_stop'].to_numpy(dtype=float)
+    if worst_case:
+        out_delay = np.zeros(len(train_pairs))
+    elif gains:
+        potential_gain = train_pairs['next_stop'].map(gains).fillna(0) \
+            .to_numpy(dtype=float)
+        out_delay = delay_at_next_stop + potential_gain
+    else:
+        gain = estimated_gain * seconds(
+                train_pairs['arrival_next_stop'].to_numpy() - departure) / 60
+        out_delay = delay_at_next_stop + gain
+    # Same as max(0, out_delay), which is also 0 for nan
+    out_delay = np.where(out_delay > 0, out_delay, 0)
+    delay_difference = train_pairs['delay'].to_numpy(dtype=float) - out_delay
+    return plan_difference, np.where(delay_difference > 0, delay_difference, 0)
+
+
+def find_first_alternatives(group, key, arrival, is_candidate, query_group, query_key):
+    """
+    Vectorized version of find_next_train for many trains at once.
+    For every query, finds the candidate with the earliest arrival
+    (ties are broken by the order of the candidates)
+    among the candidates of the same group with a key bigger
+    than the key of the query.
+
+    Args:
+    - group (array of int): group of every row
+    - key (array of int): key of every row
+    - arrival (array of int): arrival at the destination of every row
+    - is_candidate (array of bool): whether a row can be taken as alternative
+    - query_group (array of int): group of every query
+    - query_key (array of int): key of every query
+
+    Returns:
+    - alternative (array of int): row of the alternative for every query, -1 if none exists
+    """
+    alternative = np.full(len(query_group), -1, dtype=np.int64)
+    rows = np.flatnonzero(is_candidate)
+    if len(rows) == 0 or len(query_group) == 0:
+        return alternative
+    group, key, arrival = group[rows], key[rows], arrival[rows]
+    # Candidates in the order in which find_next_train would try them,
+    # per group. A lower rank means a better alternative.
+    by_preference = np.lexsort((rows, arrival, group))
+    rank = np.empty(len(rows), dtype=np.int64)
+    rank[by_preference] = np.arange(len(rows))
+    # Candidates sorted by group and key, so that all candidates with a key
+    # bigger than some value are a contiguous range at the end of the group.
+    by_key = np.lexsort((key, group))
+    unique_keys = np.unique(key)
+    num_keys = len(unique_keys) + 1
+    combined = group[by_key] * num_keys \
+        + np.searchsorted(unique_keys, key[by_key])
+    query_combined = query_group * num_keys \
+        + np.searchsorted(unique_keys, query_key, side='right')
+    start = np.searchsorted(combined, query_combined)
+    # The ranks are ordered by group first, so the minimum rank of all
+    # candidates starting at some position is within the group of
+    # that position.
+    best_rank = np.minimum.accumulate(rank[by_key][::-1])[::-1]
+    found = start < len(rows)
+    found[found] = group[by_key][start[found]] == query_group[found]
+    alternative[found] = rows[by_preference[best_rank[start[found]]]]
+    return alternative
+
+
+def reachable_transfers_vectorized(candidate_transfers, outgoing_to_dest, calendar,
+                                   scenarios, max_hours, debug):
+    """
+    Vectorized implementation of reachable_transfers,
+    which classifies all candidate transfers at once,
+    for every scenario (dict of SCENARIO_PARAMETERS) in scenarios.
+    calendar is the OutgoingCalendar of outgoing_to_dest.
+    The result per scenario is identical to the one of reachable_transfers_reference.
+    """
+    max_delay_minutes = max_hours * 60
+    if candidate_transfers.empty:
+        return [{'switch time': [], 'date': [], 'delay': [], 'reachable': []}
+                for _ in scenarios]
+    # Everything up to the loop over the scenarios does not depend on them
+    candidate_transfers = candidate_transfers.reset_index(drop=True)
+    num_rows = len(candidate_transfers)
+    instrumentation.count(candidates=num_rows)
+    transfer_time = candidate_transfers['transfer_time'].to_numpy()
+    arrival = candidate_transfers['arrival'].to_numpy().view(np.int64)
+    arrival_destination = candidate_transfers['arrival_destination'].to_numpy()
+    delay_destination = candidate_transfers['delay_destination'].to_numpy(dtype=float)
+    cancellation_inbound = candidate_transfers['cancellation_inbound'].to_numpy(dtype=bool)
+    cancellation_outbound = candidate_transfers['cancellation_outbound'].to_numpy(dtype=bool)
+    date_group = pd.factorize(candidate_transfers['date'])[0]
+    departure_origin = candidate_transfers['departure_origin'].to_numpy().view(np.int64)
+    id_group = pd.factorize(candidate_transfers['in_id_x'])[0]
+    departure = candidate_transfers['departure'].to_numpy().view(np.int64)
+    arrival_fra = candidate_transfers['arrival_fra'].to_numpy().view(np.int64)
+    dates = pd.DatetimeIndex(arrival_destination).strftime('%Y-%m-%d %H:%M:%S').to_numpy()
+    # Same order as in reachable_transfers_reference
+    id_order = {in_id: i for i, in_id in enumerate(
+        set(candidate_transfers['in_id_x'].unique()))}
+    output_order = np.lexsort((np.arange(num_rows),
+                               candidate_transfers['in_id_x'].map(id_order).to_numpy()))
+    day = 24 * 60 * 60 * 10**9
+    threshold = (24 - max_hours) * 60 * 60 * 10**9
+    is_late = arrival % day > threshold
+
+    delays = []
+    for scenario in scenarios:
+        gains = scenario['gains']
+        estimated_gain = scenario['estimated_gain']
+        worst_case = scenario['worst_case']
+        plan_difference, delay_difference = plan_and_delay_differences(
+                candidate_transfers, gains, estimated_gain, worst_case)
+        is_candidate = ~cancellation_inbound & ~cancellation_outbound \
+            & (plan_difference > delay_difference)
+        is_considered = ~(transfer_time > scenario['max_delay'])
+        train_delay = np.full(num_rows, np.nan)
+        train_reachable = np.full(num_rows, 3, dtype=np.int64)
+
+        # If the train that should arrive in Frankfurt was cancelled,
+        # find the next train going from origin to Frankfurt on the same date
+        # as alternative, which departs at the origin after the original train
+        case_1 = np.flatnonzero(is_considered & cancellation_inbound)
+        alternative_1 = find_first_alternatives(
+                date_group, departure_origin, arrival_destination.view(np.int64), is_candidate,
+                date_group[case_1], departure_origin[case_1])
+        train_reachable[case_1] = 1
+
+        # If the departing train was cancelled or transfer to it is impossible,
+        # find the next train from Frankfurt to destination as alternative,
+        # which departs after the (delayed) arrival of the incoming train
+        case_2 = np.flatnonzero(is_considered & ~cancellation_inbound
+                                & (cancellation_outbound
+                                   | (plan_difference <= delay_difference)))
+        alternative_2 = find_first_alternatives(
+                id_group, departure, arrival_destination.view(np.int64), is_candidate,
+                id_group[case_2], arrival_fra[case_2])
+        train_reachable[case_2] = 2
+
+        for case, alternative in ((case_1, alternative_1), (case_2, alternative_2)):
+            found = alternative >= 0
+            train_delay[case[found]] = delay_destination[alternative[found]] \
+                + minutes(arrival_destination[alternative[found]]
+                          - arrival_destination[case[found]])
+            train_delay[case[~found]] = max_delay_minutes - transfer_time[case[~found]]
+
+        # Late in the evening, look for alternatives on the next day
+        next_day = case_2[(alternative_2 < 0) & is_late[case_2]]
+        next_day_found, next_day_delay = find_next_day_alternatives(
+                candidate_transfers.loc[next_day], outgoing_to_dest, calendar,
+                max_hours, gains, estimated_gain, worst_case)
+        train_delay[next_day[next_day_found]] = next_day_delay[next_day_found]
+
+        # Summed over the scenarios
+        num_found = np.sum(alternative_1 >= 0) + np.sum(alternative_2 >= 0)
+        instrumentation.count(considered=int(np.sum(is_considered)),
+                              fallbacks=len(case_1) + len(case_2),
+                              fallbacks_found=int(num_found),
+                              fallbacks_not_found=len(case_1) + len(case_2) - int(num_found),
+                              next_day_lookups=len(next_day),
+                              next_day_found=int(np.sum(next_day_found)))
+
+        # If it was possible to take the connecting train as planned
+        case_3 = is_considered & (train_reachable == 3)
+        train_delay[case_3] = delay_destination[case_3]
+
+        if debug:
+            num_found_1 = np.sum(alternative_1 >= 0)
+            num_found_2 = np.sum(alternative_2 >= 0) + np.sum(next_day_found)
+            print(np.sum(~is_considered) / num_rows)
+            if num_found_1 > 0 and num_found_2 > 0:
+                print(num_found_1, len(case_1) - num_found_1,
+                      num_found_2, len(case_2) - num_found_2)
+
+        order = output_order[is_considered[output_order]
+                             & (train_delay[output_order] >= 0)]
+        delays.append({'switch time': plan_difference[order].tolist(),
+                       'date': dates[order].tolist(),
+                       'delay': train_delay[order].tolist(),
+                       'reachable': train_reachable[order].tolist()})
+    return delays
+
+
+def find_next_day_alternatives(trains, outgoing_to_dest, calendar,
+                               max_hours, gains, estimated_gain, worst_case):
+    """
+    For trains arriving late in Frankfurt, for which no alternative
+    connection to destination was found on the same day,
+    finds the first train to destination on the next day
+    that can be taken instead.
+    Only the trains of the next day that depart at most max_hours after
+    the arrival are considered, which are looked up in calendar
+    (the OutgoingCalendar of outgoing_to_dest).
+
+    Returns:
+    - found (array of bool): whether an alternative was found for a train
+    - delay (array of float): delay at the destination when taking the alternative
+    """
+    max_delay_minutes = max_hours * 60
+    found = np.zeros(len(trains), dtype=bool)
+    train_delay = np.full(len(trains), np.nan)
+    if trains.empty:
+        return found, train_delay
+    arrival = trains['arrival'].to_numpy(dtype='datetime64[ns]')
+    # A transfer is only possible to trains that depart after the arrival
+    first, stop = calendar.window(
+            trains['date'].to_numpy(dtype='datetime64[D]') + np.timedelta64(1, 'D'),
+            arrival, arrival + np.timedelta64(max_hours * 60, 'm'))
+    query, positions = expand_ranges(first, stop)
+    rows = calendar.order[positions]
+    train_pairs = outgoing_to_dest.iloc[rows][
+            ['departure', 'arrival_destination', 'delay_destination',
+             'cancellation_outbound', 'next_stop', 'delay_next_stop',
+             'arrival_next_stop']].reset_index(drop=True)
+    for column in ('arrival', 'delay', 'cancellation_inbound'):
+        train_pairs[column] = trains[column].to_numpy()[query]
+    plan_difference, delay_difference = plan_and_delay_differences(
+            train_pairs, gains, estimated_gain, worst_case)
+    is_alternative = (plan_difference <= max_delay_minutes) \
+        & ~train_pairs['cancellation_inbound'].to_numpy(dtype=bool) \
+        & ~train_pairs['cancellation_outbound'].to_numpy(dtype=bool) \
+        & (plan_difference > delay_difference)
+    if not is_alternative.any():
+        return found, train_delay
+    # First alternative per train, by arrival at the destination,
+    # ties are broken by the order of outgoing_to_dest
+    candidates = np.flatnonzero(is_alternative)
+    arrival_destination = train_pairs['arrival_destination'].to_numpy()
+    order = candidates[np.lexsort((rows[candidates], arrival_destination[candidates],
+                                   query[candidates]))]
+    _, first_of_query = np.unique(query[order], return_index=True)
+    best = order[first_of_query]
+    found[query[best]] = True
+    train_delay[query[best]] = \
+        train_pairs['delay_destination'].to_numpy(dtype=float)[best] \
+        + minutes(arrival_destination[best]
+                  - trains['arrival_destination'].to_numpy()[query[best]])
+    return found, train_delay
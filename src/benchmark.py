@@ -0,0 +1,289 @@
+"""
+This script measures the run time and memory of the stages of the pipeline
+on synthetic data (see synthetic_data.py) of several sizes, and stores the
+results in dat/benchmarks/, so that they can be compared between versions
+of the code. At the end, the results are compared with the previous ones.
+
+The stages are run on the data in memory, in the same order as in
+preprocessing and the experiments. Every stage is timed REPEATS times,
+and its peak memory is measured in one additional run with tracemalloc
+(which only sees memory allocated by python and numpy, not by pyarrow).
+
+Run it from the root directory of the repo with
+    python src/benchmark.py
+"""
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter, process_time
+import numpy as np
+import pandas as pd
+import pyarrow
+import data_io
+import data_tools
+import analysis
+import hubs
+import ingest
+import plotting_functions
+import synthetic_data
+
+# Parameters of synthetic_data.generate_scraped_data for every size
+SIZES = [
+    {'days': 30, 'trains_per_day': 100},
+    {'days': 90, 'trains_per_day': 300},
+    {'days': 365, 'trains_per_day': 600},
+]
+# Number of timed runs of every stage, the fastest one is reported
+REPEATS = 3
+# Whether to measure the peak memory of every stage (in an additional run)
+MEASURE_MEMORY = True
+# Number of (origin, destination) pairs for reachable_transfers
+NUM_PAIRS = 40
+SEED = 0
+BENCHMARKS_DIR = os.path.join(data_io.DATA_DIR, 'benchmarks')
+
+pd.options.mode.chained_assignment = None
+
+
+def measure(function, setup=None, repeats=REPEATS):
+    """
+    Runs function(*setup()) repeats times (setup is not measured),
+    and once more with tracemalloc if MEASURE_MEMORY.
+    Output printed by the function is discarded.
+
+    Returns:
+    - result: the return value of the last run
+    - measurement: dict with the fastest wall clock and cpu time in seconds,
+        all wall clock times, and the peak memory in bytes
+    """
+    wall_times, cpu_times = [], []
+    for _ in range(repeats):
+        args = setup() if setup is not None else ()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start_wall, start_cpu = perf_counter(), process_time()
+            result = function(*args)
+            wall_times.append(perf_counter() - start_wall)
+            cpu_times.append(process_time() - start_cpu)
+    measurement = {'seconds': min(wall_times), 'cpu_seconds': min(cpu_times),
+                   'all_seconds': wall_times}
+    if MEASURE_MEMORY:
+        args = setup() if setup is not None else ()
+        tracemalloc.start()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = function(*args)
+            measurement['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, measurement
+
+
+def read_raw_csv(filepath):
+    """Reads a scraped csv file without formatting the dates and times"""
+    return pd.read_csv(filepath, names=ingest.RAW_COLUMNS,
+                       dtype=ingest.RAW_DTYPES, comment='#')
+
+
+def choose_pairs(incoming, outgoing, num_pairs, rng):
+    """Random (origin, destination) pairs without the hub, grouped by origin"""
+    hub = hubs.get_hub()
+    # The hub, and its airport under both names (see data_tools.COORDINATES_NAMES)
+    hub_stations = {hub.station}
+    if hub.airport is not None:
+        hub_stations |= {hub.airport, data_tools.COORDINATES_NAMES.get(hub.airport)}
+    origins = np.unique(incoming.station_names(incoming.station))
+    destinations = np.unique(outgoing.station_names(outgoing.station))
+    pairs = set()
+    for _ in range(100 * num_pairs):
+        if len(pairs) == num_pairs:
+            break
+        origin, destination = rng.choice(origins), rng.choice(destinations)
+        if origin != destination and not {origin, destination} & hub_stations:
+            pairs.add((str(origin), str(destination)))
+    return sorted(pairs)
+
+
+def all_reachable_transfers(incoming, outgoing, pairs, gains):
+    """
+    Runs the analysis of experiment 7 for the pairs.
+    Returns the results in the format of plotting_functions.read_data.
+    """
+    results = {}
+    for origin in sorted({origin for origin, _ in pairs}):
+        incoming_from_origin = analysis.select_incoming_from_origin(incoming, origin)
+        delays = {destination: analysis.reachable_transfers(
+                      incoming_from_origin, outgoing, origin, destination, gains=gains)
+                  for o, destination in pairs if o == origin}
+        results[origin] = pd.DataFrame(delays).T
+    return results
+
+
+def write_load_stop_table(stop_table, dirname):
+    """
+    Writes a StopTable (the trains of the first half of its days with
+    data_io.write_stop_table, the others with data_io.append_stop_table)
+    and loads it again. Raises an AssertionError if the loaded stops
+    differ from the written ones, eg. because they were stored out of order.
+    """
+    days = stop_table.trains['date'].dt.normalize()
+    is_first = (days <= days.median()).to_numpy()
+    data_io.write_stop_table(stop_table.take(is_first), dirname)
+    if not is_first.all():
+        data_io.append_stop_table(stop_table.take(~is_first), dirname)
+    loaded = data_io.load_stop_table(dirname)
+    # Trains are loaded in the order they were written
+    expected = stop_table.take(np.concatenate([np.flatnonzero(is_first),
+                                               np.flatnonzero(~is_first)]))
+    # Station codes of appended stations differ from the ones of stop_table,
+    # so the names are compared
+    stations = [np.where(table.station >= 0,
+                         table.station_names(np.maximum(table.station, 0)), None)
+                for table in (loaded, expected)]
+    is_equal = {'station': np.array_equal(*stations)}
+    for name in ('offsets', 'time', 'delay', 'cancellation'):
+        is_equal[name] = np.array_equal(getattr(loaded, name), getattr(expected, name),
+                                        equal_nan=name in ('time', 'delay'))
+    changed = [name for name, equal in is_equal.items() if not equal]
+    if changed:
+        raise AssertionError(f"The {changed} of the stops changed when writing "
+                             f"and loading the StopTable")
+    return loaded
+
+
+def run_size(parameters, dirname):
+    """Generates data of one size and measures all stages on it"""
+    paths = synthetic_data.generate_scraped_data(dirname, seed=SEED, **parameters)
+    stages = {}
+
+    def stage(name, function, setup=None):
+        print(f"  {name}")
+        result, stages[name] = measure(function, setup)
+        return result
+
+    stage('read_scraped_csv',
+          lambda: [ingest.read_scraped_csv(paths[name], n_workers=1)
+                   for name in ('incoming', 'outgoing')])
+    raw_in = read_raw_csv(paths['incoming'])
+    raw_out = read_raw_csv(paths['outgoing'])
+    rows = {'incoming': len(raw_in), 'outgoing': len(raw_out)}
+
+    def format_both(data_in, data_out):
+        data_tools.format_datetimes(data_in)
+        data_tools.format_datetimes(data_out)
+        return data_in, data_out
+    data_in, data_out = stage('format_datetimes', format_both,
+                              lambda: (raw_in.copy(), raw_out.copy()))
+    data_in, data_out = data_tools.fix_duplicate_hub(data_in, data_out)
+
+    incoming, outgoing = stage(
+            'match_incoming_outgoing',
+            lambda: data_tools.match_incoming_outgoing(data_in, data_out))
+    stage('determine_train_direction',
+          lambda: (data_tools.determine_train_direction(incoming, True),
+                   data_tools.determine_train_direction(outgoing, False)))
+    incoming = data_tools.remove_wrong_incoming_trains(incoming)
+    outgoing = data_tools.remove_wrong_outgoing_trains(outgoing)
+    incoming.trains['date'] = pd.to_datetime(incoming.trains['date'])
+    outgoing.trains['date'] = pd.to_datetime(outgoing.trains['date'])
+    rows['incoming_trains'] = len(incoming)
+    rows['outgoing_trains'] = len(outgoing)
+    stage('write_load_stop_table',
+          lambda: write_load_stop_table(incoming, os.path.join(dirname, 'stop_table')))
+
+    stage('find_gains_per_next_stop',
+          lambda: analysis.find_gains_per_next_stop(incoming, outgoing))
+    gains = stage('gain_statistics',
+                  lambda: analysis.gain_statistics(
+                      *analysis.next_stop_gains(incoming, outgoing)))['average']
+
+    coordinates = pd.read_csv(paths['coordinates'], sep=';',
+                              usecols=['NAME', 'Laenge', 'Breite'])
+    stations = data_tools.unique_station_names(data_in, data_out)
+    stage('determine_excluded_station_pairs',
+          lambda: data_tools.determine_excluded_station_pairs(coordinates, stations))
+
+    pairs = choose_pairs(incoming, outgoing, NUM_PAIRS, np.random.default_rng(SEED))
+    rows['pairs'] = len(pairs)
+
+    def clear_views():
+        # Otherwise, the trains per destination would be cached between runs
+        outgoing.station_index.views.clear()
+        outgoing.station_index.calendars.clear()
+        return ()
+    results = stage('reachable_transfers',
+                    lambda: all_reachable_transfers(incoming, outgoing, pairs, gains),
+                    clear_views)
+    rows['transfers'] = int(sum(len(delays) for df in results.values()
+                                for delays in df['delay']))
+    stage('get_mean_delays',
+          lambda: plotting_functions.get_mean_delays(results, cases_needed=True))
+    return {'parameters': parameters, 'rows': rows, 'stages': stages}
+
+
+def code_version():
+    """Commit of the repo, with a + if there are uncommitted changes"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                cwd=data_io.REPO_ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        changes = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                 cwd=data_io.REPO_ROOT, capture_output=True,
+                                 text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+' if changes else '')
+
+
+def print_comparison(previous, current):
+    """Prints the time and memory of the stages relative to a previous benchmark"""
+    print(f"Compared to {previous['version']} ({previous['created']}):")
+    previous_sizes = {json.dumps(size['parameters'], sort_keys=True): size
+                      for size in previous['sizes']}
+    for size in current['sizes']:
+        previous_size = previous_sizes.get(json.dumps(size['parameters'], sort_keys=True))
+        if previous_size is None:
+            continue
+        print(f"  {size['parameters']}")
+        for name, measurement in size['stages'].items():
+            if name not in previous_size['stages']:
+                continue
+            before = previous_size['stages'][name]
+            line = f"    {name:34s} {measurement['seconds']:9.3f}s " \
+                   f"({before['seconds'] / max(measurement['seconds'], 1e-9):5.2f}x faster)"
+            if 'peak_bytes' in measurement and 'peak_bytes' in before:
+                line += f" {measurement['peak_bytes'] / 1024**2:9.1f} MiB " \
+                        f"({before['peak_bytes'] / max(measurement['peak_bytes'], 1):5.2f}x less)"
+            print(line)
+
+
+previous_files = sorted(Path(BENCHMARKS_DIR).glob('benchmark_*.json'))
+benchmark = {
+    'created': datetime.now().isoformat(timespec='seconds'),
+    'version': code_version(),
+    'python': platform.python_version(),
+    'packages': {'numpy': np.__version__, 'pandas': pd.__version__,
+                 'pyarrow': pyarrow.__version__},
+    'machine': platform.machine(),
+    'cpu_count': os.cpu_count(),
+    'repeats': REPEATS,
+    'sizes': [],
+}
+for parameters in SIZES:
+    print(f"Benchmarking {parameters}")
+    with tempfile.TemporaryDirectory(dir=data_io.DATA_DIR) as tmp_dir:
+        benchmark['sizes'].append(run_size(parameters, tmp_dir))
+    for name, measurement in benchmark['sizes'][-1]['stages'].items():
+        print(f"    {name:34s} {measurement['seconds']:9.3f}s")
+basename = f"benchmark_{benchmark['created'].replace(':', '-')}.json"
+data_io.write_json(benchmark, basename, os.path.relpath(BENCHMARKS_DIR, data_io.DATA_DIR))
+print(f"Wrote {os.path.join(BENCHMARKS_DIR, basename)}")
+if previous_files:
+    with open(previous_files[-1], 'r', encoding='utf-8') as file:
+        print_comparison(json.load(file), benchmark)
@@ -1,25 +1,70 @@
 """
 This file contains functions that write or load data.
 """
+import atexit
+import functools
 import os
 import sys
+import shutil
+import tempfile
 import numpy as np
 import pandas as pd
 import json
-import pickle
 import requests
+import psutil
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from pyarrow import feather, fs
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from stop_table import StopTable, StationIndex
+from station_dictionary import StationDictionary
+import hubs
+import origin_features
 
 REPO_ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__),
                                           os.pardir))
 DATA_DIR = os.path.join(REPO_ROOT, 'dat')
-TRAIN_DATA_DIR = os.path.join(DATA_DIR, 'train_data', 'frankfurt_hbf')
+# The train data of a hub is stored in <TRAIN_DATA_BASE_DIR>/<key of the hub>
+# (see train_data_dir), and its other data in hub_dir(hub)
+TRAIN_DATA_BASE_DIR = os.path.join(DATA_DIR, 'train_data')
+HUBS_DIR = os.path.join(DATA_DIR, 'hubs')
 STATION_NAMES_BASENAME = 'station_names.json'
 GAIN_VALS_BASENAME = 'gain_values.json'
+GAIN_STATISTICS_BASENAME = 'gain_statistics.json'
+INGEST_STATE_BASENAME = 'ingest_state.json'
 EXCLUDED_PAIRS_BASENAME = 'excluded_pairs.csv'
-EXCLUDED_PAIRS_FILE = os.path.join(DATA_DIR, EXCLUDED_PAIRS_BASENAME)
+DIRECTIONS_BASENAME = 'directions.json'
+# The coordinates are the same for all hubs
 COORDINATES_BASENAME = 'coordinates.csv'
 COORDINATES_FILE = os.path.join(DATA_DIR, COORDINATES_BASENAME)
+STATION_DISTANCES_BASENAME = 'station_distances.npy'
+STATION_DISTANCES_INFO_BASENAME = 'station_distances.json'
+STATION_DICTIONARY_BASENAME = 'station_dictionary.arrow'
+EXCLUDED_PAIRS_BITMAP_BASENAME = 'excluded_pairs_bitmap.npy'
+ORIGIN_FEATURES_BASENAME = 'origin_features'
+ORIGIN_FEATURES_INFO_BASENAME = 'info.json'
+STATIONS_BASENAME = 'stations.json'
+STATION_INDEX_BASENAME = 'station_index.arrow'
+RESULTS_BASENAME = 'results'
+# Arrays of StopTables that do not fit into the memory budget are stored
+# in <SPILL_DIR>/<pid of the process>/ (see spill_dir)
+SPILL_DIR = os.path.join(DATA_DIR, 'spill')
+STALE_DAYS_BASENAME = 'stale_days.json'
+# Upper bound in days for the time from the date of an incoming train to
+# the arrival at the destination (the date of a result) of its transfers
+# (see merge_stale_results)
+STALE_RESULT_LAG_DAYS = 2
+# Schema of the results of one origin in the result store (see write_results)
+RESULT_SCHEMA = pa.schema([('destination', pa.int32()),
+                           ('switch time', pa.float64()),
+                           ('date', pa.timestamp('s')),
+                           ('delay', pa.float64()),
+                           ('reachable', pa.int8())])
+RESULT_COLUMNS = ['switch time', 'date', 'delay', 'reachable']
+DAY_PARTITIONING = ds.partitioning(pa.schema([('day', pa.string())]),
+                                   flavor='hive')
 
 
 def load_error_msg(filepath, descr, from_repo):
@@ -42,11 +87,48 @@ def filename_escape(input_string):
     return output_string
 
 
+def hub_dir(hub=None):
+    """
+    Returns the directory of the data of a hub (see hubs.get_hub)
+    other than its train data: the data directory for the default hub,
+    and dat/hubs/<key of the hub> for the others.
+    """
+    hub = hubs.get_hub(hub)
+    if hub is hubs.DEFAULT_HUB:
+        return DATA_DIR
+    return os.path.join(HUBS_DIR, hub.key)
+
+
+def hub_path(hub, *names):
+    """Path of a file in the directory of a hub (see hub_dir)"""
+    return os.path.join(hub_dir(hub), *names)
+
+
+def hub_subdir(hub, *names):
+    """
+    Path of a directory in the directory of a hub relative to the data
+    directory, as it is given to write_json
+    """
+    return os.path.relpath(hub_path(hub, *names), DATA_DIR)
+
+
+def train_data_dir(hub=None):
+    """Returns the directory of the stored train data of a hub"""
+    return os.path.join(TRAIN_DATA_BASE_DIR, hubs.get_hub(hub).key)
+
+
+def results_dir(hub=None):
+    """Returns the directory of the result stores of the experiments of a hub"""
+    return hub_path(hub, RESULTS_BASENAME)
+
+
 def write_json(content, basename, *dirs):
     """
     Writes a dict to a JSON file.
     The files are stored in a subdirectory of
     the repo data directory (dat)
+    The file is written atomically, i.e. readers (and restarted runs)
+    see either the old or the complete new file, never a truncated one.
 
     Args:
     - content: dictionary that should be saved
@@ -57,60 +139,134 @@ def write_json(content, basename, *dirs):
     out_dirname = os.path.join(DATA_DIR, *dirs)
     Path(out_dirname).mkdir(parents=True, exist_ok=True)
     full_filename = os.path.join(out_dirname, basename)
-    with open(full_filename, 'w', encoding='utf-8') as file:
-        json.dump(content, file)
+    write_atomically(full_filename, lambda file: json.dump(content, file))
+
+
+def write_atomically(filepath, write, binary=False):
+    """
+    Calls write(file) on a temporary file in the directory of filepath,
+    and renames it to filepath once it is complete.
+    The temporary file does not end with the extension of filepath,
+    so that it is not picked up by functions reading all files of a directory.
+    The file is opened in binary mode if binary is true, otherwise as utf-8 text.
+    """
+    dirname, basename = os.path.split(filepath)
+    with tempfile.NamedTemporaryFile('wb' if binary else 'w',
+                                     encoding=None if binary else 'utf-8',
+                                     dir=dirname,
+                                     prefix=f'.{basename}.', suffix='.tmp',
+                                     delete=False) as file:
+        try:
+            write(file)
+            file.flush()
+            os.fsync(file.fileno())
+        except BaseException:
+            file.close()
+            os.remove(file.name)
+            raise
+    os.replace(file.name, filepath)
 
 
-def write_unique_station_names(incoming, outgoing):
+def write_unique_station_names(incoming, outgoing, append=False, hub=None):
     """
-    Writes a file in the data directory containing
+    Writes a file in the directory of the hub containing
     the names of the train stations we considered.
     Names are stored separately for stations from which
-    a train connection exists to Frankfurt(Main)Hbf,
-    from Frankfurt(Main)Hbf, and all stations.
-    """
-    unique_stations = set()
-    unique_stations_in = set()
-    unique_stations_out = set()
-    incoming['origin'].apply(lambda sl: unique_stations_in.update(sl))
-    outgoing['destination'].apply(lambda sl: unique_stations_out.update(sl))
+    a train connection exists to the hub (eg. Frankfurt(Main)Hbf),
+    from the hub, and all stations.
+    If append is true, the stations of incoming and outgoing are added
+    to the stored names instead of replacing them.
+
+    Returns:
+    - unique_stations_in, unique_stations_out: sets of the names
+        of the stations with trains to and from the hub
+    """
+    hub = hubs.get_hub(hub)
+    unique_stations_in = set(incoming.station_names(np.unique(incoming.station)))
+    unique_stations_out = set(outgoing.station_names(np.unique(outgoing.station)))
     unique_stations = unique_stations_in.union(unique_stations_out)
-    if 'Frankfurt(Main)Hbf' in unique_stations_in:
-        unique_stations_in.remove('Frankfurt(Main)Hbf')
-    if 'Frankfurt(Main)Hbf' in unique_stations_out:
-        unique_stations_out.remove('Frankfurt(Main)Hbf')
+    if append:
+        stored_in, stored_out, stored_all = load_unique_station_names(hub)
+        unique_stations_in |= stored_in
+        unique_stations_out |= stored_out
+        unique_stations |= stored_all
+    unique_stations_in.discard(hub.station)
+    unique_stations_out.discard(hub.station)
     write_json(
             {
                 "in": list(unique_stations_in),
                 "out": list(unique_stations_out),
                 "all": list(unique_stations)
             },
-            STATION_NAMES_BASENAME)
+            STATION_NAMES_BASENAME, hub_subdir(hub))
+    return unique_stations_in, unique_stations_out
 
 
-def write_gain_vals(all_gains):
+def write_gain_vals(gain_statistics, hub=None):
     """
-    Saves the gain estimates in the data directory.
+    Saves the gain estimates in the directory of the hub.
+
+    Args:
+    - gain_statistics: dict with the keys 'median', 'average', 'max' and
+        'pos_avg', each mapping the stops to a value
+        (see analysis.gain_statistics)
     """
-    median_gain = {}
-    average_gain = {}
-    max_gain = {}
-    pos_avg_gain = {}
-    for key in all_gains.keys():
-        median_gain[key] = np.median(all_gains[key]).item()
-        average_gain[key] = np.mean(all_gains[key]).item()
-        max_gain[key] = np.amax(all_gains[key]).item()
-        positive_numbers = [num for num in all_gains[key] if num > 0]
-        pos_avg_gain[key] = \
-            np.mean(positive_numbers).item() if len(positive_numbers) > 0 else 0
     write_json(
             {
-                "median": median_gain,
-                "average": average_gain,
-                "max": max_gain,
-                "pos_avg": pos_avg_gain
+                "median": gain_statistics['median'],
+                "average": gain_statistics['average'],
+                "max": gain_statistics['max'],
+                "pos_avg": gain_statistics['pos_avg']
             },
-            GAIN_VALS_BASENAME)
+            GAIN_VALS_BASENAME, hub_subdir(hub))
+
+def write_gain_statistics(state, hub=None):
+    """
+    Saves the state of an analysis.GainStatistics (see its state method),
+    so that the gains of new data can be added to it later.
+    """
+    write_json(state, GAIN_STATISTICS_BASENAME, hub_subdir(hub))
+
+
+def load_gain_statistics(hub=None):
+    """
+    Returns the state of the analysis.GainStatistics saved by
+    write_gain_statistics, or None if there is none.
+    """
+    filepath = hub_path(hub, GAIN_STATISTICS_BASENAME)
+    if not Path(filepath).is_file():
+        return None
+    with open(filepath, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def write_ingest_state(offsets, hub=None):
+    """
+    Records up to which byte offset the scraped csv files were read,
+    so that only the lines appended after them are read the next time
+    (see load_ingest_state).
+
+    Args:
+    - offsets: dict mapping the paths of the csv files to the offsets
+    """
+    write_json({os.path.basename(filepath): offset
+                for filepath, offset in offsets.items()},
+               INGEST_STATE_BASENAME, hub_subdir(hub))
+
+
+def load_ingest_state(filepath, hub=None):
+    """
+    Returns the byte offset in a scraped csv file up to which it was read
+    before (see write_ingest_state), or 0 if it was not read yet,
+    or if the file is smaller now (because it was replaced).
+    """
+    state_path = hub_path(hub, INGEST_STATE_BASENAME)
+    if not Path(state_path).is_file():
+        return 0
+    with open(state_path, 'r', encoding='utf-8') as file:
+        offset = json.load(file).get(os.path.basename(filepath), 0)
+    return offset if offset <= os.path.getsize(filepath) else 0
+
 
 def download_coordinates_file():
     """
@@ -132,40 +288,622 @@ def download_coordinates_file():
         print("Station coordinate file already exists, skipping.")
 
 
-def write_excluded_station_pairs(excluded_pairs):
-    excluded_pairs.to_csv(EXCLUDED_PAIRS_FILE, index=False)
+def write_excluded_station_pairs(excluded_pairs, hub=None):
+    Path(hub_dir(hub)).mkdir(parents=True, exist_ok=True)
+    write_atomically(hub_path(hub, EXCLUDED_PAIRS_BASENAME),
+                     lambda file: excluded_pairs.to_csv(file, index=False))
+
+
+def write_station_distances(distances, key, hub=None):
+    """
+    Saves a matrix of distances between stations
+    (DataFrame with the station names as index and columns,
+    see data_tools.station_distances) in the directory of the hub,
+    together with a key that describes what it was computed from.
+    """
+    Path(hub_dir(hub)).mkdir(parents=True, exist_ok=True)
+    write_atomically(hub_path(hub, STATION_DISTANCES_BASENAME),
+                     lambda file: np.save(file, distances.to_numpy(dtype=np.float64)),
+                     binary=True)
+    write_json({'key': key, 'stations': distances.index.tolist()},
+               STATION_DISTANCES_INFO_BASENAME, hub_subdir(hub))
+
+
+def load_station_distances(key=None, hub=None):
+    """
+    Returns the distances in km between stations saved by
+    write_station_distances, as a DataFrame with the station names
+    as index and columns. The matrix is memory-mapped.
+    Returns None if there are no saved distances,
+    or if they were saved with a different key than the given one.
+    """
+    info_path = hub_path(hub, STATION_DISTANCES_INFO_BASENAME)
+    distances_path = hub_path(hub, STATION_DISTANCES_BASENAME)
+    if not (Path(info_path).is_file() and Path(distances_path).is_file()):
+        return None
+    with open(info_path, 'r', encoding='utf-8') as file:
+        info = json.load(file)
+    if key is not None and info['key'] != key:
+        return None
+    distances = np.load(distances_path, mmap_mode='r')
+    if distances.shape != (len(info['stations']),) * 2:
+        return None
+    return pd.DataFrame(distances, index=info['stations'],
+                        columns=info['stations'], copy=False)
+
+
+def write_station_dictionary(station_dictionary, hub=None):
+    """
+    Saves a StationDictionary in the directory of the hub, as an Arrow file
+    with one row per station id, and the bitmap of the excluded pairs.
+    """
+    Path(hub_dir(hub)).mkdir(parents=True, exist_ok=True)
+    table = pa.table({'name': pa.array(station_dictionary.names.tolist(), pa.string()),
+                      'incoming': station_dictionary.incoming,
+                      'outgoing': station_dictionary.outgoing,
+                      'direction': station_dictionary.direction})
+    table = table.replace_schema_metadata(
+            {'directions': json.dumps(station_dictionary.direction_names)})
+    write_atomically(hub_path(hub, STATION_DICTIONARY_BASENAME),
+                     lambda file: feather.write_feather(table, file,
+                                                        compression='uncompressed'),
+                     binary=True)
+    write_atomically(hub_path(hub, EXCLUDED_PAIRS_BITMAP_BASENAME),
+                     lambda file: np.save(file, station_dictionary.excluded),
+                     binary=True)
+
+
+def load_station_dictionary(hub=None):
+    """
+    Returns the StationDictionary of a hub written in preprocessing,
+    which maps station names to ids and contains the directions
+    and excluded pairs of the stations.
+    """
+    filepath = hub_path(hub, STATION_DICTIONARY_BASENAME)
+    try:
+        table = feather.read_table(filepath, memory_map=True)
+        excluded = np.load(hub_path(hub, EXCLUDED_PAIRS_BITMAP_BASENAME), mmap_mode='r')
+    except FileNotFoundError:
+        load_error_msg(filepath, "station dictionary", False)
+        raise
+    return StationDictionary(
+            table.column('name').to_numpy(zero_copy_only=False),
+            table.column('incoming').to_numpy(zero_copy_only=False),
+            table.column('outgoing').to_numpy(zero_copy_only=False),
+            table.column('direction').to_numpy(),
+            json.loads(table.schema.metadata[b'directions']),
+            excluded)
+
+
+def stop_table_frames(stop_table, first_row=0):
+    """
+    Returns the trains and the stops of a StopTable as DataFrames in the
+    format of write_stop_table, with the day of every train, and the trains
+    numbered (train_row) from first_row on.
+    """
+    trains = stop_table.trains.assign(
+            train_row=np.arange(first_row, first_row + len(stop_table), dtype=np.int64),
+            day=stop_table.trains['date'].dt.strftime('%Y-%m-%d'))
+    stops = pd.DataFrame({
+        'train_row': first_row + stop_table.stop_train,
+        'station': stop_table.station,
+        'time': stop_table.time,
+        'delay': stop_table.delay,
+        'cancellation': stop_table.cancellation,
+        'day': np.repeat(trains['day'].to_numpy(), stop_table.lengths)
+        })
+    return trains, stops
+
+
+def write_station_index(entries, dirname):
+    """Writes the entries (station, train_row, position) of a StationIndex"""
+    stations, train_rows, positions = entries
+    write_atomically(os.path.join(dirname, STATION_INDEX_BASENAME),
+                     lambda file: feather.write_feather(
+                         pa.table({'station': stations,
+                                   'train_row': train_rows,
+                                   'position': positions}),
+                         file, compression='uncompressed'),
+                     binary=True)
+
+
+def write_stop_table(stop_table, dirname):
+    """
+    Writes a StopTable as a columnar dataset (uncompressed Arrow IPC files)
+    partitioned by the date of the trains.
+    The trains and the stops are stored in the subdirectories
+    trains and stops, and the station names in a json file.
+    """
+    Path(dirname).mkdir(parents=True, exist_ok=True)
+    trains, stops = stop_table_frames(stop_table)
+    for name, frame in (('trains', trains), ('stops', stops)):
+        shutil.rmtree(os.path.join(dirname, name), ignore_errors=True)
+        ds.write_dataset(pa.Table.from_pandas(frame, preserve_index=False),
+                         os.path.join(dirname, name),
+                         format='ipc',
+                         partitioning=DAY_PARTITIONING,
+                         existing_data_behavior='delete_matching',
+                         # With threads, the rows (and thereby the stops of a
+                         # train) can be written out of order
+                         use_threads=False)
+    write_atomically(os.path.join(dirname, STATIONS_BASENAME),
+                     lambda file: json.dump(list(stop_table.stations), file))
+    write_station_index(stop_table.station_index.entries(), dirname)
+
+
+def append_stop_table(stop_table, dirname):
+    """
+    Appends the trains of a StopTable to a StopTable written by
+    write_stop_table, as new day partitions. The days of the trains
+    must not be stored yet.
+    Station codes of the stored data stay the same, new stations are
+    appended to the station names, and the stored station index is extended.
+    """
+    with open(os.path.join(dirname, STATIONS_BASENAME), 'r',
+              encoding='utf-8') as file:
+        station_names = json.load(file)
+    trains_ds = ds.dataset(os.path.join(dirname, 'trains'), format='ipc',
+                           partitioning=DAY_PARTITIONING)
+    stored_days = set(train_data_days(dirname))
+    days = set(stop_table.trains['date'].dt.strftime('%Y-%m-%d'))
+    if days & stored_days:
+        raise ValueError(f"The days {sorted(days & stored_days)} are already "
+                         f"stored in {dirname}.")
+    first_row = pc.max(trains_ds.to_table(columns=['train_row'])
+                       .column('train_row')).as_py()
+    first_row = 0 if first_row is None else first_row + 1
+    # Translate the station codes of stop_table to codes of the stored data
+    codes = {name: code for code, name in enumerate(station_names)}
+    for name in stop_table.stations:
+        if name not in codes:
+            codes[name] = len(station_names)
+            station_names.append(name)
+    translation = np.array([codes[name] for name in stop_table.stations],
+                           dtype=np.int32)
+    station = np.where(stop_table.station >= 0,
+                       translation[np.maximum(stop_table.station, 0)], -1)
+    trains, stops = stop_table_frames(stop_table, first_row)
+    stops['station'] = station.astype(np.int32)
+    # Every call writes new files, so that no stored file is overwritten
+    basename = f"part-{pd.Timestamp.now().strftime('%Y%m%d%H%M%S%f')}-{{i}}.arrow"
+    for name, frame in (('trains', trains), ('stops', stops)):
+        schema = ds.dataset(os.path.join(dirname, name), format='ipc',
+                            partitioning=DAY_PARTITIONING).schema
+        ds.write_dataset(pa.Table.from_pandas(frame, preserve_index=False)
+                         .select(schema.names).cast(schema),
+                         os.path.join(dirname, name),
+                         format='ipc',
+                         partitioning=DAY_PARTITIONING,
+                         basename_template=basename,
+                         existing_data_behavior='overwrite_or_ignore',
+                         # In order, see write_stop_table
+                         use_threads=False)
+    write_atomically(os.path.join(dirname, STATIONS_BASENAME),
+                     lambda file: json.dump(station_names, file))
+    index = feather.read_table(os.path.join(dirname, STATION_INDEX_BASENAME))
+    new_stations, new_rows, new_positions = stop_table.station_index.entries()
+    stations = np.concatenate([index.column('station').to_numpy(),
+                               translation[new_stations]])
+    train_rows = np.concatenate([index.column('train_row').to_numpy(),
+                                 first_row + new_rows])
+    order = np.lexsort((train_rows, stations))
+    write_station_index(
+            (stations[order], train_rows[order],
+             np.concatenate([index.column('position').to_numpy(), new_positions])[order]),
+            dirname)
+
+
+def day_filter(start_date=None, end_date=None):
+    """Dataset filter for the days within [start_date, end_date]"""
+    row_filter = pc.scalar(True)
+    if start_date is not None:
+        row_filter &= ds.field('day') >= pd.Timestamp(start_date).strftime('%Y-%m-%d')
+    if end_date is not None:
+        row_filter &= ds.field('day') <= pd.Timestamp(end_date).strftime('%Y-%m-%d')
+    return row_filter
+
+
+def compact_trains(trains):
+    """
+    Casts the trains (pyarrow Table) to narrower types:
+    strings to dictionaries (categorical in pandas), ids and other 64 bit
+    integers to int32 if their values fit, and delays to float32
+    (delays are whole minutes, which float32 represents exactly).
+    Dates and times stay datetime64[ns], which has the same size as
+    datetime64 of any other resolution, and is expected by the analysis.
+    """
+    columns = []
+    for field, column in zip(trains.schema, trains.columns):
+        if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            column = column.dictionary_encode()
+        elif pa.types.is_int64(field.type):
+            min_max = pc.min_max(column).as_py()
+            if min_max['min'] is None or (min_max['min'] >= np.iinfo(np.int32).min
+                                          and min_max['max'] <= np.iinfo(np.int32).max):
+                column = column.cast(pa.int32())
+        elif pa.types.is_float64(field.type):
+            column = column.cast(pa.float32())
+        columns.append(column)
+    return pa.table(columns, names=trains.column_names,
+                    metadata=trains.schema.metadata)
+
+
+def load_stop_table(dirname, columns=None, start_date=None, end_date=None,
+                    stations=None, compact=False, spill_dirname=None):
+    """
+    Loads a StopTable written by write_stop_table.
+    Only the requested data is read, and the files are memory-mapped,
+    so that several processes reading the same data share its pages.
+
+    Args:
+    - dirname: directory the StopTable was written to
+    - columns (optional): list of columns of the trains to load,
+        columns that do not exist are ignored.
+        By default, all columns are loaded.
+    - start_date, end_date (optional): only load trains with a date
+        within [start_date, end_date]
+    - stations (optional): only load trains that stop at
+        at least one of these stations (all stops of them are loaded)
+    - compact (optional): if true, the trains and stops are loaded with
+        narrower dtypes, which need less memory (see compact_trains):
+        categorical strings, int32 ids, float32 delays, and an int32/int16
+        station index. The analysis gives identical results on them.
+    - spill_dirname (optional): if given, the arrays of the stops and of
+        the station index are spilled to memory-mapped files in this
+        directory (see spill_array) as soon as each of them is read,
+        so that at most one of them is in memory at a time.
+        The trains (one row per train) stay in memory.
+
+    Returns:
+    - StopTable
+    """
+    with open(os.path.join(dirname, STATIONS_BASENAME), 'r',
+              encoding='utf-8') as file:
+        station_names = json.load(file)
+    trains_ds, stops_ds = (
+            ds.dataset(os.path.join(dirname, name), format='ipc',
+                       partitioning=DAY_PARTITIONING,
+                       filesystem=fs.LocalFileSystem(use_mmap=True))
+            for name in ('trains', 'stops'))
+    row_filter = day_filter(start_date, end_date)
+    if stations is not None:
+        codes = [code for code, name in enumerate(station_names)
+                 if name in set(stations)]
+        rows = stops_ds.to_table(
+                columns=['train_row'],
+                filter=row_filter & ds.field('station').isin(codes))
+        row_filter &= ds.field('train_row').isin(
+                pc.unique(rows.column('train_row')))
+    if columns is not None:
+        columns = [c for c in trains_ds.schema.names
+                   if c in columns or c == 'train_row']
+    else:
+        columns = [c for c in trains_ds.schema.names if c != 'day']
+    trains = trains_ds.to_table(columns=columns, filter=row_filter)
+    if compact:
+        trains = compact_trains(trains)
+    trains = trains.to_pandas().sort_values('train_row', kind='stable')
+    stop_rows = stops_ds.to_table(columns=['train_row'], filter=row_filter) \
+        .column('train_row').to_numpy()
+    # Stops of a train are stored contiguously and in order
+    order = np.argsort(stop_rows, kind='stable')
+    train_rows = trains['train_row'].to_numpy()
+    counts = np.bincount(np.searchsorted(train_rows, stop_rows),
+                         minlength=len(trains))
+    del stop_rows
+    offsets = np.zeros(len(trains) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    dtypes = {'station': np.int32, 'time': 'datetime64[ns]',
+              'delay': np.float32 if compact else np.float64,
+              'cancellation': np.int8}
+    # The columns of the stops are read one at a time
+    arrays = {'offsets': offsets}
+    for column, dtype in dtypes.items():
+        arrays[column] = stops_ds.to_table(columns=[column], filter=row_filter) \
+            .column(column).to_numpy()[order].astype(dtype, copy=False)
+        if spill_dirname is not None:
+            arrays[column] = spill_array(arrays[column], spill_dirname, column)
+    if spill_dirname is not None:
+        arrays['offsets'] = spill_array(offsets, spill_dirname, 'offsets')
+    del order
+    stop_table = StopTable(trains.drop(columns='train_row'), arrays['offsets'],
+                           arrays['station'], station_names, arrays['time'],
+                           arrays['delay'], arrays['cancellation'])
+    index = load_station_index(dirname, train_rows, len(station_names), compact)
+    if spill_dirname is not None:
+        # StopTable converts the memory maps to plain arrays, but the
+        # scheduler only maps files that are memory maps (see scheduler.is_file_backed)
+        for name, array in arrays.items():
+            setattr(stop_table, name, array)
+        if index is not None:
+            for name in ('offsets', 'train_rows', 'positions'):
+                setattr(index, name,
+                        spill_array(getattr(index, name), spill_dirname, f'index_{name}'))
+    stop_table.station_index = index
+    return stop_table
+
+
+def load_station_index(dirname, train_rows, num_stations, compact=False):
+    """
+    Loads the StationIndex written by write_stop_table,
+    restricted to the trains with the given (sorted) train_rows.
+    If compact, the train rows are int32 and the positions int16.
+    Returns None if there is no stored index.
+    """
+    filepath = os.path.join(dirname, STATION_INDEX_BASENAME)
+    if not Path(filepath).is_file():
+        return None
+    index = feather.read_table(filepath, memory_map=True)
+    stations = index.column('station').to_numpy()
+    stored_rows = index.column('train_row').to_numpy()
+    # Translate train rows of the stored data to rows of the loaded data
+    rows = np.searchsorted(train_rows, stored_rows)
+    rows[rows == len(train_rows)] = 0
+    is_loaded = (train_rows[rows] == stored_rows) if len(train_rows) > 0 \
+        else np.zeros(len(rows), dtype=bool)
+    rows = rows[is_loaded]
+    positions = index.column('position').to_numpy()[is_loaded]
+    if compact:
+        rows = rows.astype(np.int32)
+        positions = positions.astype(np.int16)
+    return StationIndex.from_entries(stations[is_loaded], rows, positions, num_stations)
+
+
+def estimate_stop_table_bytes(dirname, columns=None, start_date=None, end_date=None,
+                              compact=False):
+    """
+    Estimates the memory in bytes that load_stop_table needs for the
+    StopTable in dirname, from the number of its trains and stops,
+    without loading it. Strings are counted as one pointer
+    (or one categorical code if compact) per row.
+    """
+    trains_ds, stops_ds = (
+            ds.dataset(os.path.join(dirname, name), format='ipc',
+                       partitioning=DAY_PARTITIONING)
+            for name in ('trains', 'stops'))
+    row_filter = day_filter(start_date, end_date)
+    train_bytes = 8  # offsets
+    for field in trains_ds.schema:
+        if field.name == 'day' or (columns is not None and field.name not in columns):
+            continue
+        if pa.types.is_dictionary(field.type) or not pa.types.is_primitive(field.type):
+            train_bytes += 4 if compact else 8
+        elif compact and field.type.bit_width == 64 and not pa.types.is_timestamp(field.type):
+            train_bytes += 4
+        else:
+            train_bytes += max(field.type.bit_width // 8, 1)
+    # station, time, delay, cancellation and one index entry per stop
+    stop_bytes = 4 + 8 + 1 + (4 + 4 + 2 if compact else 8 + 8 + 8)
+    return train_bytes * trains_ds.count_rows(filter=row_filter) \
+        + stop_bytes * stops_ds.count_rows(filter=row_filter)
+
+
+def remove_stale_spill_files():
+    """Removes the spilled arrays of processes that do not exist anymore"""
+    if not os.path.isdir(SPILL_DIR):
+        return
+    for pid in os.listdir(SPILL_DIR):
+        if pid.isdigit() and not psutil.pid_exists(int(pid)):
+            shutil.rmtree(os.path.join(SPILL_DIR, pid), ignore_errors=True)
 
 
-def write_incoming_outgoing_conns(incoming, outgoing):
-    Path(TRAIN_DATA_DIR).mkdir(parents=True, exist_ok=True)
-    incoming.to_pickle(os.path.join(TRAIN_DATA_DIR, "incoming.pkl"))
-    outgoing.to_pickle(os.path.join(TRAIN_DATA_DIR, "outgoing.pkl"))
+def spill_dir(name):
+    """
+    Creates and returns the directory <SPILL_DIR>/<pid>/<name>
+    for spilled arrays (see spill_array) of this process.
+    The directory of the process is removed when the process exits.
+    """
+    remove_stale_spill_files()
+    pid_dirname = os.path.join(SPILL_DIR, str(os.getpid()))
+    dirname = os.path.join(pid_dirname, name)
+    if not os.path.isdir(pid_dirname):
+        atexit.register(shutil.rmtree, pid_dirname, True)
+    Path(dirname).mkdir(parents=True, exist_ok=True)
+    return dirname
 
 
-def load_incoming_outgoing_conns():
+def spill_array(array, dirname, basename):
+    """
+    Moves an array to the file <dirname>/<basename>.npy, and returns
+    a read-only memory map of the file, so that the operating system can
+    page it out instead of running out of memory. The worker processes
+    of the scheduler map the same file instead of copying the array
+    into shared memory.
+    """
+    # Empty arrays cannot be memory-mapped
+    if len(array) == 0:
+        return array
+    filepath = os.path.join(dirname, f'{basename}.npy')
+    np.save(filepath, array)
+    return np.load(filepath, mmap_mode='r')
+
+
+def print_memory_report(name, stop_table):
+    """Prints the memory used by every column of a StopTable"""
+    usage = stop_table.memory_usage()
+    print(f"Memory of the {name} trains ({len(stop_table)} trains, "
+          f"{len(stop_table.station)} stops):")
+    for column, nbytes in usage.items():
+        print(f"    {column:28s} {nbytes / 1024**2:10.2f} MiB")
+    print(f"    {'total':28s} {usage.sum() / 1024**2:10.2f} MiB")
+
+
+def write_incoming_outgoing_conns(incoming, outgoing, hub=None):
+    write_stop_table(incoming, os.path.join(train_data_dir(hub), 'incoming'))
+    write_stop_table(outgoing, os.path.join(train_data_dir(hub), 'outgoing'))
+
+
+def append_incoming_outgoing_conns(incoming, outgoing, hub=None):
+    """
+    Appends incoming and outgoing trains of days that are not stored yet
+    to the stored train connections (see append_stop_table).
+    The in_id and out_id of the new trains are shifted, so that they
+    continue after the ids of the stored trains.
+    """
+    dirname_inc = os.path.join(train_data_dir(hub), 'incoming')
+    dirname_out = os.path.join(train_data_dir(hub), 'outgoing')
+    stored_ids = [pc.max(ds.dataset(os.path.join(dirname, 'trains'), format='ipc')
+                         .to_table(columns=[column]).column(column)).as_py()
+                  for dirname in (dirname_inc, dirname_out)
+                  for column in ('in_id', 'out_id')]
+    first_id = max([i for i in stored_ids if i is not None], default=-1) + 1
+    for stop_table in (incoming, outgoing):
+        for column in ('in_id', 'out_id'):
+            ids = stop_table.trains[column]
+            # -1 marks trains without a matching train
+            stop_table.trains[column] = ids.where(ids < 0, ids + first_id)
+    append_stop_table(incoming, dirname_inc)
+    append_stop_table(outgoing, dirname_out)
+
+
+def load_incoming_outgoing_conns(columns=None, start_date=None,
+                                 end_date=None, stations=None, compact=False,
+                                 memory_budget=None, spill=False, hub=None):
     """
     Returns the incoming and outgoing train connections
-    to Frankfurt Hbf.
+    of a hub (by default Frankfurt Hbf, see hubs.get_hub).
+    The optional arguments columns, start_date, end_date, stations and
+    compact restrict what is loaded and how, see load_stop_table.
+    If compact or memory_budget is given, the memory of every column
+    is printed.
+
+    Args:
+    - memory_budget (optional): upper bound in bytes for the memory
+        of the loaded trains (see estimate_stop_table_bytes).
+        If the data does not fit, a MemoryError is raised before loading it,
+        or, if spill is true, the arrays of the stops are spilled to
+        memory-mapped files while they are read (see load_stop_table),
+        so that neither the main process nor the workers hold them in memory.
+        The trains (one row per train, much fewer than the stops) are not spilled.
+    - spill (optional): see memory_budget
+    - hub (optional): the hub or its key
 
     Returns:
-    - incoming: Pandas dataframe containing trains
-        that arrive at Frankfurt Hbf
-    - outgoing: Pandas dataframe containing trains
-        that depart from Frankfurt Hbf
+    - incoming: StopTable containing trains
+        that arrive at the hub
+    - outgoing: StopTable containing trains
+        that depart from the hub
     """
-    filepath_inc = os.path.join(TRAIN_DATA_DIR, 'incoming.pkl')
-    filepath_out = os.path.join(TRAIN_DATA_DIR, 'outgoing.pkl')
+    dirname_inc = os.path.join(train_data_dir(hub), 'incoming')
+    dirname_out = os.path.join(train_data_dir(hub), 'outgoing')
     try:
-        with open(filepath_inc, 'rb') as file:
-            incoming = pickle.load(file)
-        with open(filepath_out, 'rb') as file:
-            outgoing = pickle.load(file)
+        over_budget = False
+        if memory_budget is not None:
+            estimate = sum(estimate_stop_table_bytes(dirname, columns, start_date,
+                                                     end_date, compact)
+                           for dirname in (dirname_inc, dirname_out))
+            over_budget = estimate > memory_budget
+            if over_budget and not spill:
+                raise MemoryError(
+                        f"The train data needs about {estimate} bytes, which "
+                        f"exceeds the memory budget of {memory_budget} bytes. "
+                        f"Load it with compact=True, fewer columns or days, "
+                        f"or with spill=True.")
+        stop_tables = []
+        for name, dirname in (('incoming', dirname_inc), ('outgoing', dirname_out)):
+            spill_dirname = None
+            if over_budget:
+                spill_dirname = spill_dir(name)
+                print(f"Spilling the stops of the {name} trains to {spill_dirname}")
+            stop_table = load_stop_table(dirname, columns, start_date, end_date,
+                                         stations, compact, spill_dirname)
+            if compact or memory_budget is not None:
+                print_memory_report(name, stop_table)
+            stop_tables.append(stop_table)
+        incoming, outgoing = stop_tables
         return incoming, outgoing
     except FileNotFoundError:
-        load_error_msg(filepath_inc, "train database", False)
+        load_error_msg(dirname_inc, "train database", False)
         raise
 
 
+def fingerprint_files(paths):
+    """
+    Describes the files (recursively) in paths by their
+    path (relative to the data directory), size and modification time.
+    """
+    fingerprint = []
+    for input_path in paths:
+        filepaths = [Path(input_path)] if os.path.isfile(input_path) \
+            else sorted(p for p in Path(input_path).rglob('*') if p.is_file())
+        for filepath in filepaths:
+            stat = filepath.stat()
+            fingerprint.append([os.path.relpath(filepath, DATA_DIR),
+                                stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
+
+def write_origin_features(features, fingerprint, hub=None):
+    """
+    Saves OriginFeatures in the directory of the hub, as one .npy file per
+    array, together with the version of the features and the fingerprint
+    of the incoming train data they were computed from (see fingerprint_files).
+    """
+    dirname = hub_path(hub, ORIGIN_FEATURES_BASENAME)
+    shutil.rmtree(dirname, ignore_errors=True)
+    Path(dirname).mkdir(parents=True)
+    arrays = {'offsets': features.offsets, **features.columns}
+    for name, array in arrays.items():
+        np.save(os.path.join(dirname, f'{name}.npy'), array)
+    # The info is written last, so that incomplete features are never loaded
+    write_json({'version': origin_features.VERSION,
+                'fingerprint': fingerprint,
+                'stations': features.stations.tolist(),
+                'columns': list(features.columns)},
+               ORIGIN_FEATURES_INFO_BASENAME,
+               hub_subdir(hub, ORIGIN_FEATURES_BASENAME))
+
+
+def load_origin_features(incoming=None, hub=None):
+    """
+    Returns the OriginFeatures of the incoming trains, with memory-mapped
+    arrays, so that processes loading them share their pages.
+    The features are computed and saved first if there are no saved
+    features, or if the incoming train data or the computation of the
+    features (origin_features.VERSION) has changed since they were saved.
+
+    Args:
+    - incoming (optional): StopTable of all incoming trains, used to compute
+        the features if necessary. By default, it is loaded if necessary.
+    - hub (optional): the hub or its key
+    """
+    dirname = os.path.join(train_data_dir(hub), 'incoming')
+    features_dir = hub_path(hub, ORIGIN_FEATURES_BASENAME)
+    fingerprint = fingerprint_files([dirname])
+    info_path = os.path.join(features_dir, ORIGIN_FEATURES_INFO_BASENAME)
+    info = None
+    if Path(info_path).is_file():
+        with open(info_path, 'r', encoding='utf-8') as file:
+            info = json.load(file)
+    if info is None or info['version'] != origin_features.VERSION \
+            or info['fingerprint'] != fingerprint:
+        print("Computing the origin features")
+        if incoming is None:
+            incoming = load_stop_table(dirname)
+        write_origin_features(origin_features.OriginFeatures.build(incoming),
+                              fingerprint, hub)
+        return load_origin_features(hub=hub)
+    arrays = {name: np.load(os.path.join(features_dir, f'{name}.npy'),
+                            mmap_mode='r')
+              for name in ['offsets'] + info['columns']}
+    offsets = arrays.pop('offsets')
+    return origin_features.OriginFeatures(info['stations'], offsets, arrays)
+
+
+def train_data_days(dirname=None, hub=None):
+    """
+    Returns the sorted days ('YYYY-MM-DD') of the stored train data
+    of a hub, or of the StopTable written to dirname.
+    """
+    if dirname is None:
+        dirname = os.path.join(train_data_dir(hub), 'incoming')
+    dirname = os.path.join(dirname, 'trains')
+    if not os.path.isdir(dirname):
+        return []
+    return sorted(name.split('=', 1)[1] for name in os.listdir(dirname)
+                  if name.startswith('day='))
+
+
 def load_station_subset():
     """
     Returns a python set containing a hand-selected list of stations,
@@ -183,35 +921,43 @@ def load_station_subset():
         raise
 
 
-def load_directions():
+def load_directions(hub=None):
     """
     Returns pre-defined 5 directions
     (South, West, North, North East and East)
-    in which train stations can lie relative to Frankfurt(Main)Hbf.
+    in which train stations can lie relative to a hub.
+    The directions of Frankfurt(Main)Hbf are contained in the repo,
+    the ones of the other hubs are written in preprocessing
+    (see data_tools.directions_by_bearing).
 
     Returns:
     - directions: Dict containing as keys the directions, and as
         values lists containing the corresponding train station names
     """
-    filepath = os.path.join(DATA_DIR, 'directions.json')
+    filepath = hub_path(hub, DIRECTIONS_BASENAME)
     try:
         with open(filepath, 'r', encoding='utf-8') as file:
             return json.loads(file.read())
     except FileNotFoundError:
-        load_error_msg(filepath, "directions json", True)
+        load_error_msg(filepath, "directions json", hubs.get_hub(hub) is hubs.DEFAULT_HUB)
         raise
 
 
-def load_unique_station_names():
+def write_directions(directions, hub=None):
+    """Saves the directions of a hub (see load_directions)"""
+    write_json(directions, DIRECTIONS_BASENAME, hub_subdir(hub))
+
+
+def load_unique_station_names(hub=None):
     """
     Returns the train station names for all stations that
-    have a train coming to, going to, and both, Frankfurt Hbf
+    have a train coming to, going to, and both, the hub
 
     Returns:
     - incoming_names: Dict containing as keys the directions, and as
         values lists containing the corresponding train station names
     """
-    filepath = os.path.join(DATA_DIR, STATION_NAMES_BASENAME)
+    filepath = hub_path(hub, STATION_NAMES_BASENAME)
     try:
         with open(filepath, 'r', encoding='utf-8') as file:
             sn_dict = json.loads(file.read())
@@ -221,11 +967,11 @@ def load_unique_station_names():
         raise
 
 
-def load_gain_values(gain_key, return_all=False):
+def load_gain_values(gain_key, return_all=False, hub=None):
     """
-    Returns a dict containing gain estimates.
+    Returns a dict containing the gain estimates of a hub.
     """
-    filepath = os.path.join(DATA_DIR, GAIN_VALS_BASENAME)
+    filepath = hub_path(hub, GAIN_VALS_BASENAME)
     try:
         with open(filepath, 'r', encoding='utf-8') as file:
             gain_dict = json.loads(file.read())
@@ -243,21 +989,334 @@ def load_gain_values(gain_key, return_all=False):
         raise
 
 
+@functools.lru_cache(maxsize=1)
 def load_station_coordinates():
     """
     Returns a dataframe containing train stations
     and their geographical coordinates.
+    The file is only read once per process, and processes forked
+    afterwards share the dataframe (see multi_hub.py),
+    so it must not be modified.
     """
     return pd.read_csv(COORDINATES_FILE, sep=';',
                        usecols=['NAME', 'Laenge', 'Breite'])
 
 
-def load_excluded_pairs():
+def load_excluded_pairs(hub=None):
     """
     Returns a set containing tuples (origin, destination)
-    of station names that should be ignored in the analysis.
+    of station names that should be ignored in the analysis of a hub.
+    """
+    excluded_pairs = pd.read_csv(hub_path(hub, EXCLUDED_PAIRS_BASENAME))
+    return set(zip(excluded_pairs['origin'], excluded_pairs['destination']))
+
+
+def result_stations(experiment, names=(), hub=None):
+    """
+    Returns the station dictionary of the result store of an experiment,
+    a list of station names whose positions are used as station ids.
+    Names that are not in the dictionary yet are appended to it,
+    so the ids of stations never change.
+    """
+    filepath = os.path.join(results_dir(hub), experiment, STATIONS_BASENAME)
+    stations = []
+    if os.path.exists(filepath):
+        with open(filepath, 'r', encoding='utf-8') as file:
+            stations = json.load(file)
+    new_names = sorted(set(names).difference(stations))
+    if new_names:
+        stations += new_names
+        write_json(stations, STATIONS_BASENAME,
+                   hub_subdir(hub, RESULTS_BASENAME, experiment))
+    return stations
+
+
+def write_results(delay_all, origin, experiment, scenario, hub=None):
+    """
+    Writes the results of reachable_transfers for one origin
+    to the result store, as an Arrow IPC file
+    <results_dir(hub)>/<experiment>/<scenario>/<origin id>.arrow
+    (dat/results/... for the default hub)
+    with one row per transfer (see RESULT_SCHEMA).
+    Stations are stored as ids (see result_stations),
+    and dates as timestamps with a resolution of seconds.
+    The destinations are also stored in the metadata of the file,
+    so that destinations without any transfer are kept.
+
+    Args:
+    - delay_all: dict mapping destinations to results of reachable_transfers
+    - origin: name of the origin station
+    - experiment: name of the experiment, eg. 'exp_007'
+    - scenario: name of the scenario, eg. 'delay' or 'avg_gain'
+    - hub (optional): the hub or its key
+    """
+    stations = result_stations(experiment, [origin, *delay_all], hub)
+    station_ids = {name: i for i, name in enumerate(stations)}
+    destinations = list(delay_all)
+    lengths = [len(delay_all[destination]['delay']) for destination in destinations]
+    columns = {column: [value for destination in destinations
+                        for value in delay_all[destination][column]]
+               for column in RESULT_COLUMNS}
+    table = pa.table({
+        'destination': np.repeat(
+            np.array([station_ids[d] for d in destinations], dtype=np.int32),
+            lengths),
+        'switch time': np.array(columns['switch time'], dtype=np.float64),
+        'date': pd.to_datetime(pd.Series(columns['date'], dtype=object),
+                               format='%Y-%m-%d %H:%M:%S')
+        .to_numpy(dtype='datetime64[s]'),
+        'delay': np.array(columns['delay'], dtype=np.float64),
+        'reachable': np.array(columns['reachable'], dtype=np.int8)},
+        schema=RESULT_SCHEMA.with_metadata({
+            'destinations': json.dumps([station_ids[d] for d in destinations])}))
+    dirname = os.path.join(results_dir(hub), experiment, scenario)
+    Path(dirname).mkdir(parents=True, exist_ok=True)
+    write_atomically(os.path.join(dirname, f'{station_ids[origin]}.arrow'),
+                     lambda file: feather.write_feather(
+                         table, file, compression='uncompressed'),
+                     binary=True)
+
+
+def convert_json_results(experiment, hub=None):
+    """
+    Converts results of an experiment that were stored as JSON files
+    (dat/results/<experiment>/<scenario>/delay_<nr>_<origin>.json)
+    to the result store. The JSON files are kept.
+    """
+    _, _, all_stations = load_unique_station_names(hub)
+    origins = {filename_escape(station): station for station in all_stations}
+    for scenario in result_scenarios(experiment, hub):
+        dirname = os.path.join(results_dir(hub), experiment, scenario)
+        for filename in sorted(os.listdir(dirname)):
+            if not filename.endswith('.json'):
+                continue
+            escaped_origin = filename[:-len('.json')].split('_', 2)[2]
+            with open(os.path.join(dirname, filename), 'r', encoding='utf-8') as file:
+                delay_all = json.load(file)
+            write_results(delay_all, origins[escaped_origin], experiment, scenario, hub)
+            print(f"Converted {os.path.join(experiment, scenario, filename)}")
+
+
+def mark_stale_result_days(days, hub=None):
+    """
+    Marks the given days ('YYYY-MM-DD') as stale in the result stores of all
+    experiments of a hub, eg. because the train data of these days has changed,
+    so the stored results of these days are not up to date anymore.
+    """
+    dirname = results_dir(hub)
+    if not os.path.isdir(dirname):
+        return
+    for entry in os.scandir(dirname):
+        if entry.is_dir():
+            stale_days = stale_result_days(entry.name, hub) | set(days)
+            write_json(sorted(stale_days), STALE_DAYS_BASENAME,
+                       hub_subdir(hub, RESULTS_BASENAME, entry.name))
+
+
+def stale_result_days(experiment, hub=None):
+    """
+    Returns the set of days marked as stale in the result store
+    of an experiment (see mark_stale_result_days).
+    """
+    filepath = os.path.join(results_dir(hub), experiment, STALE_DAYS_BASENAME)
+    if not os.path.exists(filepath):
+        return set()
+    with open(filepath, 'r', encoding='utf-8') as file:
+        return set(json.load(file))
+
+
+def clear_stale_result_days(experiment, hub=None):
+    """Marks all results of an experiment as up to date"""
+    filepath = os.path.join(results_dir(hub), experiment, STALE_DAYS_BASENAME)
+    if os.path.exists(filepath):
+        os.remove(filepath)
+
+
+def result_pairs(experiment, scenarios=None, hub=None):
+    """
+    Returns the set of (origin, destination) pairs whose results are
+    in the result store of an experiment, in all of the given scenarios
+    (all scenarios by default).
+    """
+    stations = result_stations(experiment, hub=hub)
+    if scenarios is None:
+        scenarios = result_scenarios(experiment, hub)
+    pairs = None
+    for scenario in scenarios:
+        dirname = os.path.join(results_dir(hub), experiment, scenario)
+        pairs_of_scenario = set()
+        if os.path.isdir(dirname):
+            for filename in os.listdir(dirname):
+                if not filename.endswith('.arrow'):
+                    continue
+                origin = stations[int(filename[:-len('.arrow')])]
+                _, destination_ids = read_result_file(os.path.join(dirname, filename))
+                pairs_of_scenario |= {(origin, stations[d]) for d in destination_ids}
+        pairs = pairs_of_scenario if pairs is None else pairs & pairs_of_scenario
+    return pairs or set()
+
+
+def load_origin_results(experiment, scenario, origin, hub=None):
+    """
+    Loads the results of one origin from the result store, in the format
+    of write_results (dict mapping destinations to results of
+    reachable_transfers). Returns an empty dict if there are none.
+    """
+    stations = result_stations(experiment, hub=hub)
+    if origin not in stations:
+        return {}
+    filepath = os.path.join(results_dir(hub), experiment, scenario,
+                            f'{stations.index(origin)}.arrow')
+    if not os.path.exists(filepath):
+        return {}
+    table, destination_ids = read_result_file(filepath)
+    # The rows of every destination are stored contiguously, in the order of destinations
+    counts = np.bincount(table['destination'].to_numpy(),
+                         minlength=max(destination_ids, default=-1) + 1)[destination_ids]
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    columns = {column: table[column].to_numpy() for column in RESULT_COLUMNS}
+    columns['date'] = pd.DatetimeIndex(columns['date']).strftime('%Y-%m-%d %H:%M:%S').to_numpy()
+    return {stations[d]: {column: values[start:end].tolist()
+                          for column, values in columns.items()}
+            for d, start, end in zip(destination_ids, offsets[:-1], offsets[1:])}
+
+
+def merge_stale_results(delay_all, stored, first_stale_day):
+    """
+    Merges the results of an origin that were computed again because of
+    stale days (see stale_result_days) with its stored results:
+    the stored transfers that arrive before first_stale_day are kept,
+    the others are taken from delay_all. These are complete if the
+    transfers of all incoming trains from STALE_RESULT_LAG_DAYS days
+    before first_stale_day on were computed again.
+
+    Args:
+    - delay_all: dict mapping destinations to results of reachable_transfers
+    - stored: stored results of the origin (see load_origin_results)
+    - first_stale_day: first stale day ('YYYY-MM-DD')
+
+    Returns:
+    - delay_all with the results of the stored destinations merged
+    """
+    merged = {}
+    for destination, result in delay_all.items():
+        if destination not in stored:
+            merged[destination] = result
+            continue
+        # Dates 'YYYY-MM-DD HH:MM:SS' compare with days as strings
+        kept = [i for i, date in enumerate(stored[destination]['date'])
+                if date < first_stale_day]
+        new = [i for i, date in enumerate(result['date']) if date >= first_stale_day]
+        merged[destination] = {column: [stored[destination][column][i] for i in kept]
+                               + [result[column][i] for i in new]
+                               for column in RESULT_COLUMNS}
+    return merged
+
+
+def result_scenarios(experiment, hub=None):
+    """Returns the names of the scenarios in the result store of an experiment"""
+    dirname = os.path.join(results_dir(hub), experiment)
+    return sorted(entry.name for entry in os.scandir(dirname) if entry.is_dir())
+
+
+def read_result_file(filepath, destination_ids=None):
+    """
+    Reads one file of the result store (memory-mapped), keeping only
+    the rows of the given destination ids.
+    Returns the table and the ids of its destinations, in the order
+    in which their rows are stored.
+    """
+    table = feather.read_table(filepath, memory_map=True)
+    destinations = json.loads(table.schema.metadata[b'destinations'])
+    if destination_ids is not None:
+        table = table.filter(pc.is_in(table['destination'],
+                                      pa.array(destination_ids, pa.int32())))
+        destination_ids = set(destination_ids)
+        destinations = [d for d in destinations if d in destination_ids]
+    return table.replace_schema_metadata(), destinations
+
+
+def iter_results(experiment, scenarios=None, origins=None, destinations=None,
+                 n_workers=None, hub=None):
+    """
+    Reads results from the result store (see write_results) one origin
+    at a time, while the files of the next origins are read in parallel.
+    Only the requested scenarios, origins and destinations are read.
+
+    Args:
+    - experiment: name of the experiment, eg. 'exp_006'
+    - scenarios (optional): list of scenario names. Defaults to all scenarios.
+    - origins (optional): list of origin station names. Defaults to all.
+    - destinations (optional): list of destination station names. Defaults to all.
+    - n_workers (optional): number of threads. Defaults to the number of cpus.
+    - hub (optional): the hub or its key
+
+    Yields:
+    - (scenario, origin, table, destinations), where table is a pyarrow Table
+        with the schema RESULT_SCHEMA, and destinations are the names of the
+        destinations of the origin, in the order of their rows in table
+    """
+    stations = result_stations(experiment, hub=hub)
+    station_ids = {name: i for i, name in enumerate(stations)}
+    if scenarios is None:
+        scenarios = result_scenarios(experiment, hub)
+    destination_ids = None if destinations is None \
+        else [station_ids[d] for d in destinations if d in station_ids]
+    files = []
+    for scenario in scenarios:
+        dirname = os.path.join(results_dir(hub), experiment, scenario)
+        if origins is None:
+            origin_ids = sorted(int(name[:-len('.arrow')]) for name in os.listdir(dirname)
+                                if name.endswith('.arrow'))
+        else:
+            origin_ids = [station_ids[o] for o in origins if o in station_ids]
+        files += [(scenario, origin_id, os.path.join(dirname, f'{origin_id}.arrow'))
+                  for origin_id in origin_ids
+                  if os.path.exists(os.path.join(dirname, f'{origin_id}.arrow'))]
+    n_workers = n_workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(n_workers) as executor:
+        # Only read a few files ahead, so that not all results are in memory
+        pending = []
+        for index in range(len(files) + 2 * n_workers):
+            if index < len(files):
+                pending.append(executor.submit(read_result_file, files[index][2],
+                                               destination_ids))
+            if index >= 2 * n_workers:
+                scenario, origin_id, _ = files[index - 2 * n_workers]
+                table, destination_ids_of_origin = pending.pop(0).result()
+                yield (scenario, stations[origin_id], table,
+                       [stations[d] for d in destination_ids_of_origin])
+
+
+def load_results(experiment, scenarios=None, origins=None, destinations=None,
+                 n_workers=None, hub=None):
+    """
+    Loads results from the result store (see write_results) into one DataFrame,
+    reading the files of the origins in parallel.
+    For the arguments, see iter_results.
+
+    Returns:
+    - DataFrame with the columns scenario, origin, destination (categorical)
+        and RESULT_COLUMNS, with one row per transfer
     """
-    excluded_pairs = set()
-    for _, origin, destination in pd.read_csv(EXCLUDED_PAIRS_FILE).itertuples():
-        excluded_pairs.add((origin, destination))
-    return excluded_pairs
+    stations = result_stations(experiment, hub=hub)
+    station_ids = {name: i for i, name in enumerate(stations)}
+    if scenarios is None:
+        scenarios = result_scenarios(experiment, hub)
+    tables = []
+    scenario_codes = []
+    origin_codes = []
+    for scenario, origin, table, _ in iter_results(
+            experiment, scenarios, origins, destinations, n_workers, hub):
+        tables.append(table)
+        scenario_codes.append(np.full(len(table), scenarios.index(scenario), dtype=np.int32))
+        origin_codes.append(np.full(len(table), station_ids[origin], dtype=np.int32))
+    table = pa.concat_tables(tables) if tables else RESULT_SCHEMA.empty_table()
+    results = table.to_pandas(date_as_object=False)
+    results.insert(0, 'scenario', pd.Categorical.from_codes(
+        np.concatenate(scenario_codes or [np.zeros(0, dtype=np.int32)]), scenarios))
+    results.insert(1, 'origin', pd.Categorical.from_codes(
+        np.concatenate(origin_codes or [np.zeros(0, dtype=np.int32)]), stations))
+    results['destination'] = pd.Categorical.from_codes(
+            results['destination'].to_numpy(), stations)
+    return results
@@ -3,13 +3,32 @@ This file contains functions that work directly on data.
 The functions contained in here are only used in preprocessing.
 """
 import os
-import math
+import hashlib
+import json
 import numpy as np
 import pandas as pd
 from datetime import timedelta
 from datetime import datetime
 from pathlib import Path
+from time import perf_counter
 import data_io
+import hubs
+from stop_table import StopTable
+from station_dictionary import station_direction_codes
+
+DATETIME_FORMAT = '%d.%m.%Y-%H:%M'
+# Radius of the Earth in km
+EARTH_RADIUS = 6371.0
+# Names of stations in the scraped data that differ in the coordinates file
+COORDINATES_NAMES = {'Frankfurt am Main Flughafen Fernbahnhof': 'Frankfurt(M) Flughafen Fernbf',
+                     'Stendal Hbf': 'Stendal',
+                     'Hamm(Westf)Hbf': 'Hamm(Westf)'}
+# Bearing (in degrees, clockwise from north) of the directions from a hub
+# (see directions_by_bearing)
+DIRECTION_BEARINGS = {'South': 180, 'West': 270, 'North': 0,
+                      'North East': 45, 'East': 110}
+# Stations closer to the hub than this (in km) get no direction
+MIN_DIRECTION_DISTANCE = 15.0
 
 
 def str_to_date(s):
@@ -17,36 +36,44 @@ def str_to_date(s):
 
 
 def strs_to_datetime_departure(sdate, stime):
-    return datetime.strptime(sdate + '-' + stime, '%d.%m.%Y-%H:%M')
+    return datetime.strptime(sdate + '-' + stime, DATETIME_FORMAT)
 
 
 # Assuming that the date is the date of departure, not the date of arrival
 def strs_to_datetime_arrival(sdate, stime, time_departure):
-    time_arrival = datetime.strptime(sdate + '-' + stime, '%d.%m.%Y-%H:%M')
+    time_arrival = datetime.strptime(sdate + '-' + stime, DATETIME_FORMAT)
     if time_arrival < time_departure:
         return time_arrival + timedelta(days=1)
     else:
         return time_arrival
 
 
-def format_datetimes(df):
-    df.loc[:, 'departure'] = \
-            df.loc[:, ['date', 'departure']].apply(
-                    lambda c: strs_to_datetime_departure(
-                        c['date'],
-                        c['departure']),
-                    axis=1)
-    df.loc[:, 'arrival'] = \
-            df.loc[:, ['date', 'arrival', 'departure']].apply(
-                    lambda c: strs_to_datetime_arrival(
-                        c['date'],
-                        c['arrival'],
-                        c['departure']),
-                    axis=1)
+def format_datetimes(df, verbose=True):
+    """
+    Converts the date, departure and arrival columns of the scraped data
+    from strings to dates and datetimes, for all rows at once.
+    Gives the same results as strs_to_datetime_departure and
+    strs_to_datetime_arrival applied to every row.
+    If verbose, prints how many rows per second were processed.
+    """
+    start = perf_counter()
+    departure = pd.to_datetime(df['date'] + '-' + df['departure'],
+                               format=DATETIME_FORMAT)
+    arrival = pd.to_datetime(df['date'] + '-' + df['arrival'],
+                             format=DATETIME_FORMAT)
+    # Assuming that the date is the date of departure, arrivals that are
+    # before the departure happen on the next day
+    arrival = arrival.mask(arrival < departure, arrival + timedelta(days=1))
+    df['departure'] = departure
+    df['arrival'] = arrival
     # We define the date of a train as the date of departure.
     # If the train arrives a day later, it still has the date of departure
     # associated with it.
-    df.loc[:, 'date'] = df.loc[:, 'departure'].apply(lambda d: d.date())
+    df['date'] = departure.dt.date
+    elapsed = perf_counter() - start
+    if verbose:
+        print(f"Formatted {len(df)} rows in {elapsed:.2f}s "
+              f"({len(df) / max(elapsed, 1e-9):.0f} rows/s)")
 
 
 def cancellation_to_int(s):
@@ -62,8 +89,13 @@ def cancellation_to_int(s):
     return 2
 
 
-def cancellation_to_int_lst(l):
-    return [cancellation_to_int(c) for c in l]
+def cancellation_to_codes(cancellation):
+    """
+    Vectorized version of cancellation_to_int for a whole Series.
+    """
+    return np.where(pd.isna(cancellation), 0,
+                    np.where(cancellation == 'Ausfall (Startbahnhof)', 1, 2)) \
+        .astype(np.int8)
 
 
 def d_id_to_int(d):
@@ -73,168 +105,322 @@ def d_id_to_int(d):
         return int(d)
 
 
-def determine_train_direction(train_data, is_incoming, debug=False):
+def match_incoming_outgoing(data_in, data_out):
+    """
+    Groups the rows (stops) of the scraped data into trains, and matches
+    every incoming train with the outgoing train of the same name and date
+    that leaves the hub within an hour after it arrived.
+
+    Returns:
+    - incoming (StopTable): Incoming trains, with their in_id and the
+        out_id of the matching outgoing train (-1 if there is none)
+    - outgoing (StopTable): Outgoing trains, with their out_id and the
+        in_id of the matching incoming train (-1 if there is none)
+    """
+    data_in = data_in.sort_values(["date", "departure"])
+    data_out = data_out.sort_values(["date", "arrival"])
+
+    # Merge individual rows (stops of a train) together into one train line,
+    # with the stops, delays, etc. stored in a StopTable
+    print("Group data by trains")
+    data_in['cancellation'] = cancellation_to_codes(data_in['cancellation'])
+    data_out['cancellation'] = cancellation_to_codes(data_out['cancellation'])
+    result_in = StopTable.from_rows(data_in,
+                                    ['train', 'date', 'arrival', 'destination'],
+                                    'origin', 'departure')
+    result_out = StopTable.from_rows(data_out,
+                                     ['train', 'date', 'departure', 'origin'],
+                                     'destination', 'arrival')
+    # The delay of an incoming train is its delay at the hub,
+    # which is the same for all of its stops
+    result_in.trains['delay'] = result_in.first(result_in.delay)
+    in_clean = result_in.trains.infer_objects()
+    out_clean = result_out.trains.infer_objects()
+
+    # Assign ids to every individual train
+    len_in = len(in_clean)
+    len_out = len(out_clean)
+    in_clean['in_id'] = range(0, len_in)
+    out_clean['out_id'] = range(len_in, len_in + len_out)
+
+    print("Matching corresponding incoming and outgoing connections")
+    merged = pd.merge(in_clean, out_clean, on=['date', 'train'], how='outer')
+    correctly_matched = (
+            pd.isna(merged['arrival']) |
+            pd.isna(merged['departure']) |
+            ((merged['arrival'] <= merged['departure']) &
+             (merged['arrival'] > merged['departure'] - timedelta(minutes=60))
+             # Here, it is assumed that trains with the same train name have at
+             # least one hour in-between different trains with the same train name,
+             # which was manually verified to be the case for our dataset.
+             )
+            )
+    merged = merged[correctly_matched]
+
+    incoming_trains = merged.loc[merged.loc[:, 'in_id'].notna(),
+                                 ['in_id', 'train', 'date', 'arrival',
+                                  'destination', 'delay', 'out_id']]
+    outgoing_trains = merged.loc[merged.loc[:, 'out_id'].notna(),
+                                 ['out_id', 'train', 'date', 'departure',
+                                  'origin', 'in_id']]
+    incoming_trains['out_id'] = incoming_trains.loc[:, 'out_id'].apply(d_id_to_int).astype(int)
+    incoming_trains['in_id'] = incoming_trains.loc[:, 'in_id'].apply(d_id_to_int).astype(int)
+    outgoing_trains['out_id'] = outgoing_trains.loc[:, 'out_id'].apply(d_id_to_int).astype(int)
+    outgoing_trains['in_id'] = outgoing_trains.loc[:, 'in_id'].apply(d_id_to_int).astype(int)
+    # The ids are the positions of the trains in result_in and result_out
+    incoming = result_in.take(incoming_trains['in_id'].to_numpy(), incoming_trains)
+    outgoing = result_out.take(outgoing_trains['out_id'].to_numpy() - len_in,
+                               outgoing_trains)
+
+    print(f"Removed {len_in - len(incoming)} wrongly merged incoming trains.")
+    print(f"Removed {len_out - len(outgoing)} wrongly merged incoming trains.")
+    return incoming, outgoing
+
+
+def determine_train_direction(train_data, is_incoming, debug=False, hub=None):
     """
     Determine the direction a train is taking.
     Directions are one of the five:
     South, West, North, North East, East.
-    Returns a dataframe with an additional direction column
-    containing the appropriate direction.
-    """
-    directions = data_io.load_directions()
-    direction_list = [""] * len(train_data)
-    remove_indices = set()
-    not_found = found = airport = count_unclear = 0
-
-    for index, train_out in enumerate(train_data.itertuples()):
-        direction_set = set()
-
-        if is_incoming:
-            stops = list(train_out.origin)
-            stops.reverse()
-        else:
-            stops = list(train_out.destination)
-
-        for dest in stops:
-            for direction, stations in directions.items():
-                if dest in stations:
-                    direction_set.add(direction)
-                    break
-        if ("South" in direction_set
-            and ("West" in direction_set
-                 or "North" in direction_set
-                 or "North East" in direction_set)
-            or ("East" in direction_set
-                and ("West" in direction_set
-                     or "North" in direction_set))):
-            if debug:
-                    print("############")
-                    print(index)
-                    print(stops)
-                    print(train_out.departure)
-                    print(train_out.arrival)
-                    count_unclear += 1
-            direction_set = set()
-
-        direction_list[index] = next(iter(direction_set), 'None')
-        if direction_list[index] == 'None':
-            not_found += 1
-            if 'Frankfurt am Main Flughafen Fernbahnhof' in stops:
-                airport += 1
-        else:
-            found += 1
-    train_data['direction'] = direction_list
-    if debug:
-        print(count_unclear)
+    Every stop gets the direction of its station (from a lookup table
+    per station code), and the directions of a train are combined
+    into a bitmask. Trains whose stops lie in conflicting directions
+    get no direction, otherwise a train gets the direction of its stop
+    closest to the hub that has a direction.
+    Returns the StopTable with an additional direction column
+    in its trains containing the appropriate direction.
+    """
+    hub = hubs.get_hub(hub)
+    directions = data_io.load_directions(hub)
+    direction_names = np.array(list(directions) + ['None'], dtype=object)
+    stop_direction = station_direction_codes(
+            train_data.stations, directions)[train_data.station]
+    stop_train = train_data.stop_train
+    has_direction = stop_direction >= 0
+
+    masks = np.zeros(len(train_data), dtype=np.int64)
+    np.bitwise_or.at(masks, stop_train[has_direction],
+                     1 << stop_direction[has_direction].astype(np.int64))
+    bits = {name: 1 << code for code, name in enumerate(directions)}
+
+    def any_of(*names):
+        return (masks & sum(bits.get(name, 0) for name in names)) != 0
+    is_unclear = (any_of("South") & any_of("West", "North", "North East")) \
+        | (any_of("East") & any_of("West", "North"))
+
+    # Stops are ordered by time, so the stop closest to the hub is
+    # the last one of incoming trains and the first one of outgoing trains
+    directed_stops = np.flatnonzero(has_direction)
     if is_incoming:
-        print(f"Set directions of {found} incoming trains.")
-        print(f"Did not find clear direction of {not_found} trains.")
-        print(f"Out of those, {airport} trains end at Frankfurt airport without other stops.")
-    else:
-        print(f"Set directions of {found} outgoing trains.")
-        print(f"Did not find clear direction of {not_found} trains.")
-        print(f"Out of those, {airport} trains start at Frankfurt airport without other stops.")
+        directed_stops = directed_stops[::-1]
+    trains, first = np.unique(stop_train[directed_stops], return_index=True)
+    train_direction = np.full(len(train_data), len(directions), dtype=np.int64)
+    train_direction[trains] = stop_direction[directed_stops[first]]
+    train_direction[is_unclear] = len(directions)
+    train_data.trains['direction'] = direction_names[train_direction]
+
+    if debug:
+        station_lists = train_data.station_names(train_data.station)
+        for index in np.flatnonzero(is_unclear):
+            start, end = train_data.offsets[index], train_data.offsets[index + 1]
+            print("############")
+            print(index)
+            print(list(station_lists[start:end][::-1] if is_incoming
+                       else station_lists[start:end]))
+            print(train_data.time[start:end])
+        print(np.count_nonzero(is_unclear))
+    not_found = train_direction == len(directions)
+    found = np.count_nonzero(~not_found)
+    kind = 'incoming' if is_incoming else 'outgoing'
+    print(f"Set directions of {found} {kind} trains.")
+    print(f"Did not find clear direction of {np.count_nonzero(not_found)} trains.")
+    if hub.airport is not None:
+        airport = np.count_nonzero(not_found & train_data.any_stop(
+                train_data.station == train_data.station_code(hub.airport)))
+        print(f"Out of those, {airport} trains {'end' if is_incoming else 'start'} "
+              f"at {hub.airport} without other stops.")
     return train_data
 
 
-def fix_duplicate_frankfurt(data_in, data_out):
-    data_in = data_in[data_in['origin'] != 'Frankfurt(Main)Hbf']
-    data_out = data_out[data_out['destination'] != 'Frankfurt(Main)Hbf']
+def fix_duplicate_hub(data_in, data_out, hub=None):
+    """Removes the rows of trains from the hub to itself"""
+    hub = hubs.get_hub(hub)
+    data_in = data_in[data_in['origin'] != hub.station]
+    data_out = data_out[data_out['destination'] != hub.station]
     return data_in, data_out
 
 
-def remove_wrong_incoming_trains(incoming):
+def remove_wrong_incoming_trains(incoming, hub=None):
     """
-    Remove trains from the dataset that contain wrong datapoints.
+    Remove trains from the dataset that contain wrong datapoints:
+    trains that stop at a station of the city of the hub,
+    but not at the end.
     """
-    is_wrong = incoming['origin'].apply(
-            lambda origins:
-            len(origins) > 0
-            and "Frankfurt" not in origins[-1]
-            and any(map(lambda origin: "Frankfurt" in origin, origins)))
+    hub = hubs.get_hub(hub)
+    is_hub_city = np.array([hub.city in station
+                            for station in incoming.stations],
+                           dtype=bool)[incoming.station]
+    is_wrong = ~incoming.last(is_hub_city) & incoming.any_stop(is_hub_city)
     print(f"Dropping {sum(is_wrong)} wrong incoming trains from the dataset.")
-    return incoming[~is_wrong]
+    return incoming.take(~is_wrong)
 
 
-def remove_wrong_outgoing_trains(outgoing):
+def remove_wrong_outgoing_trains(outgoing, hub=None):
     """
     Remove trains from the dataset that contain wrong datapoints
-    found by manual inspection.
-    """
-    out_ids_of_wrong_trains = \
-        [
-            321822,
-            326938,
-            193134,
-            193205,
-            265197,
-            265739
-        ]
+    found by manual inspection (see hubs.Hub).
+    """
+    out_ids_of_wrong_trains = hubs.get_hub(hub).wrong_outgoing_trains
     print(f"Dropping {len(out_ids_of_wrong_trains)} wrong outgoing \
             trains from the dataset.")
-    return outgoing[outgoing['out_id'].apply(
-        lambda out_id: out_id not in out_ids_of_wrong_trains)]
+    return outgoing.take(
+            ~outgoing.trains['out_id'].isin(out_ids_of_wrong_trains).to_numpy())
 
 
-def unique_station_names(data_in, data_out):
+def unique_station_names(data_in, data_out, hub=None):
     incoming_stations = set(data_in["origin"])
     outgoing_stations = set(data_out["destination"])
     stations = incoming_stations.union(outgoing_stations)
+    stations.add(hubs.get_hub(hub).station)
     # Rename a few stations as the 2 datasets use different names for these
-    stations.add("Frankfurt(Main)Hbf")
-    stations.add("Frankfurt(M) Flughafen Fernbf")
-    stations.add("Stendal")
-    stations.add("Hamm(Westf)")
-    stations.remove('Hamm(Westf)Hbf')
-    stations.remove('Frankfurt am Main Flughafen Fernbahnhof')
-    stations.remove('Stendal Hbf')
+    for scraped_name, coordinates_name in COORDINATES_NAMES.items():
+        stations.add(coordinates_name)
+        stations.discard(scraped_name)
     return stations
 
 
-def haversine(coord1, coord2):
-    # Radius of the Earth in km
-    R = 6371.0
-    lat1, lon1 = coord1
-    lat2, lon2 = coord2
-    lat1 = float(lat1.replace(',', '.'))
-    lon1 = float(lon1.replace(',', '.'))
-    lat2 = float(lat2.replace(',', '.'))
-    lon2 = float(lon2.replace(',', '.'))
+def parse_decimal_commas(values):
+    """
+    Parses numbers written with a decimal comma
+    (as in the coordinates file, eg. '8,663') to a float array.
+    """
+    return pd.Series(values).astype(str) \
+        .str.replace(',', '.', regex=False).astype(float).to_numpy()
+
+
+def haversine_matrix(lat1, lon1, lat2, lon2):
+    """
+    Distances in kilometers between all points (lat1, lon1)
+    and all points (lat2, lon2), given in degrees.
+    Returns a matrix with one row per point of the first
+    and one column per point of the second array.
+    """
     # Convert latitude and longitude from degrees to radians
-    phi1, phi2 = math.radians(lat1), math.radians(lat2)
-    delta_phi = math.radians(lat2 - lat1)
-    delta_lambda = math.radians(lon2 - lon1)
+    phi1 = np.radians(np.asarray(lat1, dtype=float))[:, np.newaxis]
+    phi2 = np.radians(np.asarray(lat2, dtype=float))[np.newaxis, :]
+    delta_phi = np.radians(np.asarray(lat2, dtype=float)[np.newaxis, :]
+                           - np.asarray(lat1, dtype=float)[:, np.newaxis])
+    delta_lambda = np.radians(np.asarray(lon2, dtype=float)[np.newaxis, :]
+                              - np.asarray(lon1, dtype=float)[:, np.newaxis])
     # Haversine formula
-    a = math.sin(delta_phi / 2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda / 2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    a = np.sin(delta_phi / 2)**2 + np.cos(phi1) * np.cos(phi2) * np.sin(delta_lambda / 2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
     # Distance in kilometers
-    distance = R * c
-    return distance
+    return EARTH_RADIUS * c
 
 
-def pair_exclusion_criterion(origin_coords, destination_coords, frankfurt_coords):
-    return (
-        haversine(origin_coords, destination_coords) * 1.5
-        < (haversine(frankfurt_coords, origin_coords)
-           + haversine(frankfurt_coords, destination_coords))
-    )
+def coordinates_key(station_coords):
+    """Hash of the station names and coordinates"""
+    description = json.dumps([station_coords['NAME'].tolist(),
+                              station_coords['Laenge'].astype(str).tolist(),
+                              station_coords['Breite'].astype(str).tolist()])
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()
 
 
-def determine_excluded_station_pairs(station_coords, stations):
+def station_distances(station_coords, stations, hub=None):
+    """
+    Returns the distances in kilometers between all stations in stations
+    (that are in station_coords) as a DataFrame with the station names
+    as index and columns.
+    The distances are cached in the directory of the hub, and only computed
+    again if the coordinates or the stations changed.
+    """
+    station_coords = station_coords[station_coords['NAME'].isin(stations)]
+    key = coordinates_key(station_coords)
+    distances = data_io.load_station_distances(key, hub)
+    if distances is None:
+        latitude = parse_decimal_commas(station_coords['Breite'])
+        longitude = parse_decimal_commas(station_coords['Laenge'])
+        names = station_coords['NAME'].tolist()
+        distances = pd.DataFrame(
+                haversine_matrix(latitude, longitude, latitude, longitude),
+                index=names, columns=names)
+        data_io.write_station_distances(distances, key, hub)
+    return distances
+
+
+def hub_coordinates(station_coords, hub=None):
+    """Longitude and latitude of the hub (in degrees)"""
+    hub = hubs.get_hub(hub)
+    row = station_coords[station_coords['NAME'] == hub.station]
+    if len(row) == 0:
+        raise KeyError(f"{hub.station} is not in the coordinates file")
+    return parse_decimal_commas(row['Laenge'])[0], parse_decimal_commas(row['Breite'])[0]
+
+
+def directions_by_bearing(station_coords, stations, hub=None):
+    """
+    Assigns the stations to the directions (see data_io.load_directions)
+    by their bearing from the hub: every station gets the direction in
+    DIRECTION_BEARINGS that is closest to its bearing, except for stations
+    closer to the hub than MIN_DIRECTION_DISTANCE.
+    Used for hubs without hand-selected directions.
+    Stations that are named differently in the scraped data
+    (see COORDINATES_NAMES) are added under both names.
+
+    Returns:
+    - directions: Dict containing as keys the directions, and as
+        values lists containing the corresponding train station names
+    """
+    hub = hubs.get_hub(hub)
+    hub_longitude, hub_latitude = hub_coordinates(station_coords, hub)
+    station_coords = station_coords[station_coords['NAME'].isin(stations)
+                                    & (station_coords['NAME'] != hub.station)]
+    names = station_coords['NAME'].to_numpy()
+    longitude = parse_decimal_commas(station_coords['Laenge'])
+    latitude = parse_decimal_commas(station_coords['Breite'])
+    distance = haversine_matrix(latitude, longitude, [hub_latitude], [hub_longitude])[:, 0]
+    # Initial bearing of the great circle from the hub to the stations
+    phi1, phi2 = np.radians(hub_latitude), np.radians(latitude)
+    delta_lambda = np.radians(longitude - hub_longitude)
+    bearing = np.degrees(np.arctan2(
+        np.sin(delta_lambda) * np.cos(phi2),
+        np.cos(phi1) * np.sin(phi2) - np.sin(phi1) * np.cos(phi2) * np.cos(delta_lambda)))
+    direction_bearings = np.array(list(DIRECTION_BEARINGS.values()), dtype=float)
+    # Angles between the bearings and the directions, between 0 and 180 degrees
+    difference = np.abs((bearing[:, np.newaxis] - direction_bearings[np.newaxis, :]
+                         + 180) % 360 - 180)
+    closest = np.argmin(difference, axis=1)
+    scraped_names = {coordinates_name: scraped_name
+                     for scraped_name, coordinates_name in COORDINATES_NAMES.items()}
+    directions = {}
+    for code, direction in enumerate(DIRECTION_BEARINGS):
+        is_direction = (closest == code) & (distance >= MIN_DIRECTION_DISTANCE)
+        directions[direction] = sorted(
+                [str(name) for name in names[is_direction]]
+                + [scraped_names[name] for name in names[is_direction]
+                   if name in scraped_names])
+    return directions
+
+
+def determine_excluded_station_pairs(station_coords, stations, hub=None):
+    """
+    Returns the (origin, destination) pairs of stations for which going
+    through the hub (eg. Frankfurt(Main)Hbf) is a big detour, ie. the distance
+    from origin to destination times 1.5 is smaller than the distances from
+    the hub to the origin and to the destination together.
+    """
     station_coords = station_coords[station_coords['NAME'].isin(stations)]
-    frankfurt_coords = station_coords[
-            station_coords["NAME"] == "Frankfurt(Main)Hbf"] \
-        .iloc[0][['Laenge', 'Breite']]
-    station_pairs = station_coords.merge(station_coords, how='cross')
-
-    def exclusion_fun(coord_pair):
-        return pair_exclusion_criterion(
-                (coord_pair['Laenge_x'], coord_pair['Breite_x']),
-                (coord_pair['Laenge_y'], coord_pair['Breite_y']),
-                frankfurt_coords)
-
-    station_pairs = station_pairs[
-            station_pairs.apply(exclusion_fun, axis=1)
-            ]
-    return station_pairs[['NAME_x', 'NAME_y']] \
-        .rename(columns={'NAME_x': 'origin', 'NAME_y': 'destination'})
+    names = station_coords['NAME'].to_numpy()
+    longitude = parse_decimal_commas(station_coords['Laenge'])
+    latitude = parse_decimal_commas(station_coords['Breite'])
+    # The criterion was defined with the longitudes in the place of the
+    # latitudes and vice versa, which is kept so that the excluded pairs
+    # stay the same. Use station_distances for actual distances.
+    distances = haversine_matrix(longitude, latitude, longitude, latitude)
+    from_hub = distances[np.flatnonzero(names == hubs.get_hub(hub).station)[0]]
+    is_excluded = distances * 1.5 \
+        < from_hub[:, np.newaxis] + from_hub[np.newaxis, :]
+    origins, destinations = np.nonzero(is_excluded)
+    return pd.DataFrame({'origin': names[origins],
+                         'destination': names[destinations]})
@@ -0,0 +1,79 @@
+"""
+This file contains the transfer hubs, the stations at which transfers from
+incoming to outgoing trains are analysed. The analysis was developed for
+Frankfurt(Main)Hbf, and the data of the other hubs is scraped, processed
+and stored in the same way, in directories of their own
+(see data_io.hub_dir and data_io.train_data_dir).
+
+Preprocessing and the experiments take the key of the hub as their first
+argument, eg.
+    python src/preprocessing.py koeln_hbf
+and all hubs can be processed in parallel with multi_hub.py.
+"""
+
+
+class Hub:
+    """
+    A transfer hub.
+
+    Args:
+    - station: name of the station in the scraped data, eg. 'Frankfurt(Main)Hbf'
+    - key: name of the directories of its data, eg. 'frankfurt_hbf'
+    - label: name of the hub in the names of the scraped csv files,
+        eg. 'Frankfurt_Hbf' for scraped_incoming_Frankfurt_Hbf.csv
+    - city: name of the city of the hub, which is part of the names
+        of all of its stations (see data_tools.remove_wrong_incoming_trains)
+    - airport (optional): name of an airport station in the scraped data
+        at which some trains stop right before or after the hub
+    - wrong_outgoing_trains (optional): out_ids of outgoing trains with
+        wrong data, found by manual inspection
+        (see data_tools.remove_wrong_outgoing_trains)
+    """
+
+    def __init__(self, station, key, label, city, airport=None,
+                 wrong_outgoing_trains=()):
+        self.station = station
+        self.key = key
+        self.label = label
+        self.city = city
+        self.airport = airport
+        self.wrong_outgoing_trains = list(wrong_outgoing_trains)
+
+    @property
+    def incoming_basename(self):
+        """Basename of the scraped csv file of the trains to the hub"""
+        return f'scraped_incoming_{self.label}.csv'
+
+    @property
+    def outgoing_basename(self):
+        """Basename of the scraped csv file of the trains from the hub"""
+        return f'scraped_outgoing_{self.label}.csv'
+
+    def __repr__(self):
+        return f'Hub({self.station!r})'
+
+
+FRANKFURT = Hub('Frankfurt(Main)Hbf', 'frankfurt_hbf', 'Frankfurt_Hbf', 'Frankfurt',
+                airport='Frankfurt am Main Flughafen Fernbahnhof',
+                wrong_outgoing_trains=[321822, 326938, 193134, 193205, 265197, 265739])
+KOELN = Hub('Köln Hbf', 'koeln_hbf', 'Koeln_Hbf', 'Köln')
+HANNOVER = Hub('Hannover Hbf', 'hannover_hbf', 'Hannover_Hbf', 'Hannover')
+MANNHEIM = Hub('Mannheim Hbf', 'mannheim_hbf', 'Mannheim_Hbf', 'Mannheim')
+HUBS = {hub.key: hub for hub in (FRANKFURT, KOELN, HANNOVER, MANNHEIM)}
+# The hub of the original analysis, whose data is stored directly
+# in the data directory
+DEFAULT_HUB = FRANKFURT
+
+
+def get_hub(hub=None):
+    """
+    Returns the Hub for a Hub, the key of a hub (see HUBS),
+    or None for the default hub.
+    """
+    if hub is None:
+        return DEFAULT_HUB
+    if isinstance(hub, Hub):
+        return hub
+    if hub not in HUBS:
+        raise KeyError(f"Unknown hub: {hub}, has to be one of {list(HUBS)}")
+    return HUBS[hub]
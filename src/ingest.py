@@ -0,0 +1,145 @@
+"""
+This file contains functions that read the scraped csv files.
+They are only used in preprocessing.
+
+The csv files are split into byte ranges that are parsed in parallel
+by a process pool. Every worker writes its typed part of the data to
+a temporary file, and the parts are merged in file order at the end,
+such that the result is the same as reading the whole file at once.
+"""
+import io
+import os
+import tempfile
+from multiprocessing import Pool
+import pandas as pd
+from pandas.api.types import union_categoricals
+import data_io
+from data_tools import format_datetimes
+
+RAW_COLUMNS = ['origin', 'destination', 'date', 'departure',
+               'arrival', 'train', 'delay', 'cancellation']
+RAW_DTYPES = {
+    'origin': 'category',
+    'destination': 'category',
+    'date': str,
+    'departure': str,
+    'arrival': str,
+    'train': 'category',
+    'delay': 'float32',
+    'cancellation': 'category'
+}
+CATEGORICAL_COLUMNS = [c for c, t in RAW_DTYPES.items() if t == 'category']
+# Default upper bound for the memory used by ingest, in bytes
+MEMORY_LIMIT = 4 * 1024**3
+# Rough factor of how much memory a byte of csv takes up
+# while it is being parsed
+PARSE_MEMORY_FACTOR = 10
+# Approximate memory of one parsed (typed) row in bytes
+TYPED_ROW_BYTES = 80
+
+
+def chunk_ranges(filepath, chunk_bytes, start=0):
+    """
+    Splits a file, from byte start on, into byte ranges
+    of (at most) chunk_bytes bytes.
+    """
+    size = os.path.getsize(filepath)
+    return [(chunk_start, min(chunk_start + chunk_bytes, size))
+            for chunk_start in range(start, size, chunk_bytes)]
+
+
+def read_byte_range(filepath, start, end):
+    """
+    Returns all lines of a file that start within the byte range
+    [start, end), so that every line belongs to exactly one range.
+    """
+    with open(filepath, 'rb') as file:
+        if start > 0:
+            # Skip the line that started in the previous range
+            file.seek(start - 1)
+            file.readline()
+        pos = file.tell()
+        if pos >= end:
+            return b''
+        data = file.read(end - pos)
+        if not data.endswith(b'\n'):
+            data += file.readline()
+        return data
+
+
+def ingest_chunk(args):
+    """
+    Parses one byte range of a scraped csv file with explicit dtypes,
+    formats its dates and times, and stores it in part_path.
+    """
+    filepath, start, end, part_path = args
+    data = read_byte_range(filepath, start, end)
+    if data.strip():
+        chunk = pd.read_csv(io.BytesIO(data), names=RAW_COLUMNS,
+                            dtype=RAW_DTYPES, comment='#')
+    else:
+        chunk = pd.DataFrame({c: pd.Series(dtype=t)
+                              for c, t in RAW_DTYPES.items()})
+    format_datetimes(chunk, verbose=False)
+    chunk.to_pickle(part_path)
+    return part_path, len(chunk)
+
+
+def merge_parts(part_paths):
+    """
+    Concatenates the typed parts in order,
+    merging the categories of the categorical columns.
+    """
+    parts = [pd.read_pickle(part_path) for part_path in part_paths]
+    categoricals = {
+            column: union_categoricals([part[column] for part in parts],
+                                       sort_categories=True)
+            for column in CATEGORICAL_COLUMNS}
+    for part in parts:
+        for column in CATEGORICAL_COLUMNS:
+            part[column] = part[column].cat.set_categories(
+                    categoricals[column].categories)
+    return pd.concat(parts, ignore_index=True)
+
+
+def read_scraped_csv(filepath, n_workers=None, memory_limit=MEMORY_LIMIT, start=0):
+    """
+    Reads a scraped csv file (see the .SAMPLE files for the format)
+    in parallel, with typed columns and formatted dates and times.
+    Lines starting with # are skipped.
+
+    Args:
+    - filepath: path to the csv file
+    - n_workers (optional): number of worker processes.
+        Defaults to the number of cpus.
+    - memory_limit (optional): upper bound for the memory in bytes that
+        the workers and the merged result may use. The chunk size is
+        chosen according to it.
+    - start (optional): byte offset of the beginning of a line, from which
+        on the file is read (see data_io.load_ingest_state)
+
+    Returns:
+    - DataFrame with the columns RAW_COLUMNS
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    chunk_bytes = max(1, memory_limit // (n_workers * PARSE_MEMORY_FACTOR))
+    # Nothing to read gives one empty range, and thereby an empty DataFrame
+    ranges = chunk_ranges(filepath, chunk_bytes, start) or [(start, start)]
+    print(f"Reading {os.path.basename(filepath)} in {len(ranges)} chunks "
+          f"with {n_workers} workers")
+    with tempfile.TemporaryDirectory(dir=data_io.DATA_DIR) as tmp_dir:
+        tasks = [(filepath, start, end,
+                  os.path.join(tmp_dir, f"part_{index:06d}.pkl"))
+                 for index, (start, end) in enumerate(ranges)]
+        if n_workers > 1 and len(tasks) > 1:
+            with Pool(n_workers) as pool:
+                results = pool.map(ingest_chunk, tasks)
+        else:
+            results = [ingest_chunk(task) for task in tasks]
+        num_rows = sum(num for _, num in results)
+        if num_rows * TYPED_ROW_BYTES > memory_limit:
+            raise MemoryError(
+                    f"{filepath} has {num_rows} rows, which do not fit into "
+                    f"the memory limit of {memory_limit} bytes.")
+        return merge_parts([part_path for part_path, _ in results])
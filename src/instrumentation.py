@@ -0,0 +1,278 @@
+"""
+This file contains the instrumentation of the pipeline: a run report that
+records, for every stage of a run (eg. of preprocessing or an experiment),
+its wall clock and cpu time, the number of rows that went in and out,
+and the peak memory (resident set size), and for every
+(origin, destination) pair its time and counters of the analysis
+(see count). The report is written as JSON, and the stages and pairs
+additionally as csv files, to dat/reports/.
+
+Stages can be profiled (opt-in), either with cProfile, or with a sampling
+profiler that periodically records the stack of the running stage,
+which slows it down much less and is suited for production-size data.
+
+Usage:
+    report = Report('exp_007')
+    with report.stage('load', rows_in=...) as stage:
+        ...
+        stage.rows_out = ...
+    report.write()
+"""
+import collections
+import contextlib
+import cProfile
+import csv
+import io
+import os
+import pstats
+import resource
+import sys
+import threading
+from datetime import datetime
+from time import perf_counter, process_time
+import psutil
+import data_io
+
+# The reports are stored in this subdirectory of the data directory
+REPORTS_BASENAME = 'reports'
+# Seconds between two measurements of the memory (and samples of the stack)
+SAMPLE_INTERVAL = 0.05
+# Number of functions per profiled stage that are stored in the report
+PROFILE_ENTRIES = 25
+
+# Counters of the (origin, destination) pair that is being processed,
+# reset for every pair (see Report.pair and scheduler.run_pair)
+counters = collections.Counter()
+
+
+def count(**values):
+    """Adds values to the counters of the current pair, eg. count(candidates=10)"""
+    counters.update(values)
+
+
+def process_rss(process):
+    """Resident set size of a process and all of its children, in bytes"""
+    rss = 0
+    for p in [process, *process.children(recursive=True)]:
+        try:
+            rss += p.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss
+
+
+class Sampler(threading.Thread):
+    """
+    Thread that measures the peak memory of the process (and its children),
+    and, if stacks is true, samples the stack of the given thread.
+    """
+
+    def __init__(self, thread_id, stacks=False):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.stacks = stacks
+        self.process = psutil.Process()
+        self.peak_rss = process_rss(self.process)
+        self.num_samples = 0
+        self.own_samples = collections.Counter()
+        self.total_samples = collections.Counter()
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.wait(SAMPLE_INTERVAL):
+            self.peak_rss = max(self.peak_rss, process_rss(self.process))
+            if self.stacks:
+                self.sample()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        self.num_samples += 1
+        self.own_samples[self.location(frame)] += 1
+        functions = set()
+        while frame is not None:
+            functions.add(self.location(frame, line=False))
+            frame = frame.f_back
+        self.total_samples.update(functions)
+
+    @staticmethod
+    def location(frame, line=True):
+        code = frame.f_code
+        where = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+        return f"{where}:{frame.f_lineno}" if line else where
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        self.peak_rss = max(self.peak_rss, process_rss(self.process))
+
+    def profile(self):
+        """The most frequent locations, with their share of the samples"""
+        num = max(self.num_samples, 1)
+        return {'samples': self.num_samples,
+                'own': [{'location': location, 'share': n / num}
+                        for location, n in self.own_samples.most_common(PROFILE_ENTRIES)],
+                'total': [{'function': function, 'share': n / num}
+                          for function, n in self.total_samples.most_common(PROFILE_ENTRIES)]}
+
+
+class Stage:
+    """
+    Measurements of one stage of a run.
+    rows_in and rows_out can be set while the stage is running.
+    """
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.record = {}
+
+    def summary(self):
+        return {'stage': self.name, 'rows_in': self.rows_in,
+                'rows_out': self.rows_out, **self.record}
+
+
+def stage(report, name, rows_in=None):
+    """
+    report.stage(name, rows_in), or a context manager that measures nothing
+    if report is None, for functions that take an optional report.
+    """
+    if report is None:
+        return contextlib.nullcontext(Stage(name, rows_in))
+    return report.stage(name, rows_in)
+
+
+class Report:
+    """
+    Run report with the measurements of the stages and pairs of a run.
+
+    Args:
+    - name: name of the run, eg. 'preprocessing' or 'exp_007'
+    - profile (optional): None (default), 'cprofile' or 'sampling',
+        to profile every stage with the given method
+    """
+
+    def __init__(self, name, profile=None):
+        if profile not in (None, 'cprofile', 'sampling'):
+            raise ValueError(f"Unknown profile method: {profile}")
+        self.name = name
+        self.profile = profile
+        self.created = datetime.now().isoformat(timespec='seconds')
+        self.stages = []
+        self.pairs = []
+        self.basename = f"{name}_{self.created.replace(':', '-')}"
+
+    @contextlib.contextmanager
+    def stage(self, name, rows_in=None):
+        """
+        Context manager that measures the code run within it as a stage.
+        Yields the Stage, whose rows_out (and rows_in) can be set.
+        """
+        stage = Stage(name, rows_in)
+        sampler = Sampler(threading.get_ident(), stacks=self.profile == 'sampling')
+        profiler = cProfile.Profile() if self.profile == 'cprofile' else None
+        children_cpu = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start_wall, start_cpu = perf_counter(), process_time()
+        sampler.start()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield stage
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            wall, cpu = perf_counter() - start_wall, process_time() - start_cpu
+            sampler.stop()
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            stage.record = {
+                'seconds': wall,
+                'cpu_seconds': cpu,
+                # Only includes child processes that have ended
+                'children_cpu_seconds': (children.ru_utime + children.ru_stime)
+                - (children_cpu.ru_utime + children_cpu.ru_stime),
+                'peak_rss_bytes': sampler.peak_rss,
+            }
+            if profiler is not None:
+                stage.record['profile'] = self.write_profile(name, profiler)
+            elif self.profile == 'sampling':
+                stage.record['profile'] = sampler.profile()
+            self.stages.append(stage)
+            print(f"Stage {name}: {wall:.2f}s, {cpu:.2f}s cpu, "
+                  f"peak rss {sampler.peak_rss / 1024**2:.0f} MiB")
+
+    def write_profile(self, stage_name, profiler):
+        """
+        Writes the cProfile statistics of a stage to a .prof file
+        (which can be opened with pstats or snakeviz), and returns
+        the functions with the highest cumulative time.
+        """
+        dirname = os.path.join(data_io.DATA_DIR, REPORTS_BASENAME, self.basename)
+        os.makedirs(dirname, exist_ok=True)
+        filepath = os.path.join(dirname, f"{data_io.filename_escape(stage_name)}.prof")
+        profiler.dump_stats(filepath)
+        stats = pstats.Stats(profiler, stream=io.StringIO())
+        entries = sorted(stats.stats.items(), key=lambda item: -item[1][3])
+        return {'file': os.path.relpath(filepath, data_io.DATA_DIR),
+                'functions': [
+                    {'function': f"{os.path.basename(filename)}:{line}:{function}",
+                     'calls': calls, 'seconds': own_time, 'cumulative_seconds': cumulative}
+                    for (filename, line, function), (_, calls, own_time, cumulative, _)
+                    in entries[:PROFILE_ENTRIES]]}
+
+    def add_pair(self, origin, destination, measurements):
+        """
+        Records the measurements (dict of times and counters)
+        of an (origin, destination) pair.
+        """
+        self.pairs.append({'origin': origin, 'destination': destination,
+                           **measurements})
+
+    @contextlib.contextmanager
+    def pair(self, origin, destination):
+        """
+        Context manager that records the time and the counters
+        of the analysis of one (origin, destination) pair.
+        """
+        counters.clear()
+        start_wall, start_cpu = perf_counter(), process_time()
+        try:
+            yield
+        finally:
+            self.add_pair(origin, destination,
+                          {'seconds': perf_counter() - start_wall,
+                           'cpu_seconds': process_time() - start_cpu,
+                           **counters})
+
+    def write(self):
+        """
+        Writes the report to dat/reports/<name>_<time>.json,
+        and the stages and pairs to csv files next to it.
+        Returns the path of the JSON file.
+        """
+        dirname = os.path.join(data_io.DATA_DIR, REPORTS_BASENAME)
+        data_io.write_json({'name': self.name, 'created': self.created,
+                            'profile': self.profile,
+                            'stages': [stage.summary() for stage in self.stages],
+                            'pairs': self.pairs},
+                           f"{self.basename}.json", REPORTS_BASENAME)
+        for kind, rows in (('stages', [{key: value for key, value in stage.summary().items()
+                                        if key != 'profile'}
+                                       for stage in self.stages]),
+                           ('pairs', self.pairs)):
+            if not rows:
+                continue
+            columns = list(dict.fromkeys(key for row in rows for key in row))
+            filepath = os.path.join(dirname, f"{self.basename}_{kind}.csv")
+            data_io.write_atomically(
+                    filepath, lambda file: self.write_csv(file, columns, rows))
+        filepath = os.path.join(dirname, f"{self.basename}.json")
+        print(f"Wrote the run report {filepath}")
+        return filepath
+
+    @staticmethod
+    def write_csv(file, columns, rows):
+        writer = csv.DictWriter(file, columns)
+        writer.writeheader()
+        writer.writerows(rows)
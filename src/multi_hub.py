@@ -0,0 +1,165 @@
+"""
+This script preprocesses the data of several transfer hubs (see hubs.py)
+and runs experiments on them, with the hubs processed in parallel.
+
+For every hub, the scraped csv files dat/raw/scraped_incoming_<label>.csv
+and dat/raw/scraped_outgoing_<label>.csv have to exist (see hubs.Hub).
+Every hub is processed in a forked process, which runs preprocessing.py and
+then the experiments in EXPERIMENTS with the key of the hub as their first
+argument, as in
+    python src/preprocessing.py koeln_hbf
+At most N_PARALLEL_HUBS hubs are processed at a time, and the experiments
+of a hub are only started when all hubs are preprocessed.
+The output of every hub is written to dat/reports/multi_hub_<time>_<key>.log.
+
+The data that is the same for all hubs is shared between them:
+the coordinates file is downloaded and read once, before the processes
+of the hubs are forked, so they share the parsed coordinates.
+After preprocessing, the station dictionaries of all hubs are given the
+same station ids (see StationDictionary.reindex), so that stations can
+be compared between hubs. The shared station names are written to
+dat/hubs/stations.json.
+
+Run it from the root directory of the repo with
+    python src/multi_hub.py
+"""
+import multiprocessing
+import os
+import runpy
+import shutil
+import sys
+import traceback
+from multiprocessing.connection import wait
+from time import perf_counter
+import data_io
+import hubs
+import instrumentation
+
+# Keys of the hubs that are processed (see hubs.HUBS)
+HUBS = ['frankfurt_hbf', 'koeln_hbf', 'hannover_hbf', 'mannheim_hbf']
+# Number of hubs that are processed at the same time. Every hub uses
+# further processes, eg. the workers of the experiments (see their N_WORKERS)
+N_PARALLEL_HUBS = 2
+# If false, the stored data of the hubs is used
+PREPROCESS = True
+PREPROCESSING_SCRIPT = os.path.join(data_io.REPO_ROOT, 'src', 'preprocessing.py')
+# Experiments that are run for every hub, in this order
+EXPERIMENTS = [
+    os.path.join(data_io.REPO_ROOT, 'exp', '007_delays_all_origins_all_destinations',
+                 'analysis_all_parallel.py'),
+]
+
+
+def run_script(filepath, hub):
+    """Runs a script with the key of the hub as its first argument"""
+    print(f"Running {os.path.relpath(filepath, data_io.REPO_ROOT)} for {hub.station}",
+          flush=True)
+    sys.argv = [filepath, hub.key]
+    try:
+        runpy.run_path(filepath, run_name='__main__')
+    except SystemExit as exit_:
+        if exit_.code not in (None, 0):
+            raise
+
+
+def run_hub(hub, scripts, log_path):
+    """
+    Runs the scripts for a hub (in the process of the hub),
+    with the output written to log_path.
+    """
+    with open(log_path, 'a', encoding='utf-8') as log:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Also redirects the output of the processes started by the scripts
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+    try:
+        for filepath in scripts:
+            run_script(filepath, hub)
+    except BaseException:
+        traceback.print_exc()
+        sys.stderr.flush()
+        raise
+
+
+def run_hubs(name, scripts, hub_list, n_parallel):
+    """
+    Runs the scripts for every hub in hub_list, every hub in a process
+    of its own, with at most n_parallel processes at a time.
+    Returns the hubs for which a script failed.
+    """
+    context = multiprocessing.get_context('fork')
+    os.makedirs(os.path.join(data_io.DATA_DIR, instrumentation.REPORTS_BASENAME), exist_ok=True)
+    todo = list(reversed(hub_list))
+    running = {}
+    failed = []
+    while todo or running:
+        while todo and len(running) < n_parallel:
+            hub = todo.pop()
+            log_path = os.path.join(data_io.DATA_DIR, instrumentation.REPORTS_BASENAME,
+                                    f'{report.basename}_{hub.key}.log')
+            process = context.Process(target=run_hub, args=(hub, scripts, log_path),
+                                      name=f'{name} {hub.key}')
+            process.start()
+            running[process.sentinel] = (hub, process, log_path, perf_counter())
+            print(f"Started the {name} of {hub.station}")
+        for sentinel in wait(list(running)):
+            hub, process, log_path, start = running.pop(sentinel)
+            process.join()
+            # The spilled train data is not removed at the exit of a forked process
+            shutil.rmtree(os.path.join(data_io.SPILL_DIR, str(process.pid)),
+                          ignore_errors=True)
+            if process.exitcode == 0:
+                print(f"Finished the {name} of {hub.station} "
+                      f"in {perf_counter() - start:.1f}s")
+            else:
+                failed.append(hub)
+                print(f"The {name} of {hub.station} failed, see {log_path}")
+    return failed
+
+
+def share_station_dictionaries(hub_list):
+    """
+    Gives the station dictionaries of the hubs the same ids,
+    those of the sorted names of the stations of all hubs.
+    Returns the number of stations.
+    """
+    dictionaries = {hub.key: data_io.load_station_dictionary(hub) for hub in hub_list}
+    names = sorted(set().union(*(dictionary.names for dictionary in dictionaries.values())))
+    for hub in hub_list:
+        data_io.write_station_dictionary(dictionaries[hub.key].reindex(names), hub)
+    data_io.write_json(names, data_io.STATIONS_BASENAME,
+                       os.path.relpath(data_io.HUBS_DIR, data_io.DATA_DIR))
+    return len(names)
+
+
+report = instrumentation.Report('multi_hub')
+hub_list = [hubs.get_hub(key) for key in HUBS]
+if PREPROCESS:
+    for hub in list(hub_list):
+        missing = [basename for basename in (hub.incoming_basename, hub.outgoing_basename)
+                   if not os.path.exists(os.path.join(data_io.DATA_DIR, 'raw', basename))]
+        if missing:
+            print(f"Skipping {hub.station}, the scraped data {missing} is missing")
+            hub_list.remove(hub)
+    # Read once and shared with the forked processes of the hubs
+    data_io.download_coordinates_file()
+    data_io.load_station_coordinates()
+    with report.stage('preprocessing', rows_in=len(hub_list)) as stage:
+        failed = run_hubs('preprocessing', [PREPROCESSING_SCRIPT], hub_list, N_PARALLEL_HUBS)
+        hub_list = [hub for hub in hub_list if hub not in failed]
+        stage.rows_out = len(hub_list)
+else:
+    failed = []
+
+with report.stage('station_dictionaries', rows_in=len(hub_list)) as stage:
+    stage.rows_out = share_station_dictionaries(hub_list)
+    print(f"The {len(hub_list)} hubs have {stage.rows_out} stations")
+
+with report.stage('analysis', rows_in=len(hub_list)) as stage:
+    failed += run_hubs('analysis', EXPERIMENTS, hub_list, N_PARALLEL_HUBS)
+    stage.rows_out = len(hub_list) - len(failed)
+report.write()
+if failed:
+    print(f"Processing failed for {', '.join(hub.station for hub in failed)}")
+    sys.exit(1)
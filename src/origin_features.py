@@ -0,0 +1,63 @@
+"""
+This file contains the origin features, the per-train information about
+the origin of the incoming trains (see analysis.select_incoming_from_origin)
+computed for all origins at once.
+
+The experiments select the incoming trains of every origin many times,
+so the features are computed once after preprocessing and cached in the
+data directory as plain arrays, which every experiment (and every worker
+process) can memory-map instead of computing them again
+(see data_io.load_origin_features).
+"""
+import numpy as np
+import pandas as pd
+import analysis
+
+# Version of the features, has to be increased whenever their computation
+# changes, so that cached features are computed again
+VERSION = 1
+COLUMNS = ['in_id', 'date', 'arrival', 'delay', 'origin_idx',
+           'departure_origin', 'arrival_fra', 'cancellation_inbound']
+
+
+class OriginFeatures:
+    """
+    The result of analysis.select_incoming_from_origin for every origin,
+    stored as one array per column.
+    The rows of the origin with code c (index in stations) are
+    offsets[c]:offsets[c+1].
+
+    Attributes:
+    - stations: array of station names, indexed by station code
+    - offsets: int64 array of length len(stations) + 1
+    - columns: dict of the arrays of the COLUMNS
+    """
+
+    def __init__(self, stations, offsets, columns):
+        self.stations = np.asarray(stations, dtype=object)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.columns = columns
+        self._index = pd.Index(self.stations)
+
+    @classmethod
+    def build(cls, incoming):
+        """Computes the features of all origins of incoming (StopTable)"""
+        index = incoming.station_index
+        features = analysis.compute_origin_features(
+                incoming, index.train_rows, index.positions)
+        return cls(incoming.stations, index.offsets,
+                   {column: features[column].to_numpy() for column in COLUMNS})
+
+    def select(self, origin):
+        """
+        Returns the incoming trains that stop at origin, in the same form as
+        analysis.select_incoming_from_origin (the arrays are copied,
+        so the result can be modified).
+        """
+        code = self._index.get_indexer([origin])[0]
+        if code < 0:
+            start = end = 0
+        else:
+            start, end = self.offsets[code], self.offsets[code + 1]
+        return pd.DataFrame({column: np.array(values[start:end])
+                             for column, values in self.columns.items()})
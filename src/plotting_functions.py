@@ -3,60 +3,64 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
+import data_io
+import instrumentation
 
 
-
-
-def read_data(main_folder_path, compare_gains=False):
-    """Reads json files containing delay data for origin-destination pairs
+def read_data(main_folder_path, compare_gains=False, hub=None):
+    """Reads delay data for origin-destination pairs from the result store
+    (see data_io.write_results)
 
     Args:
-        main_folder_path (str): Path
+        main_folder_path (str): Path of the results of an experiment
+            (eg. dat/results/exp_006) if compare_gains,
+            otherwise of one scenario (eg. dat/results/exp_006/avg_gain)
         compare_gains (bool, optional): If different gain calculation need to be loaded. 
             Defaults to False.
+        hub (str, optional): key of the hub of the results (see hubs.HUBS).
+            Defaults to Frankfurt(Main)Hbf.
 
     Returns:
-        dict: delay data for gains and origin-destination pairs
+        dict: delay data for gains and origin-destination pairs.
+            For every origin, a DataFrame indexed by destination,
+            with arrays of the switch times, dates, delays
+            and reachability cases in its cells.
     """
-    df_dict = {}
-
+    parts = os.path.relpath(os.path.realpath(main_folder_path),
+                            data_io.results_dir(hub)).split(os.sep)
     if compare_gains:
-        for foldername in os.listdir(main_folder_path):
-            folder_path = os.path.join(main_folder_path, foldername)
-
-            folder_dict = {}
-            print(foldername)
-
-            for filename in os.listdir(folder_path):
-                if filename.endswith('.json'):
-                    file_path = os.path.join(folder_path, filename)
-                    
-                    key_city = filename.split('_')[2].replace(".json", "")
-                    key_city = key_city.replace('ä', 'ae').replace('ö', 'oe').replace('ü', 'ue')
-
-                    df = pd.read_json(file_path, orient='index')
-                    df.index = df.index.str.replace('ä', 'ae').str.replace('ö', 'oe').str.replace('ü', 'ue')
-                    folder_dict[key_city] = df
-            
-            df_dict[foldername] = folder_dict
+        experiment, = parts
+        scenarios = data_io.result_scenarios(experiment, hub)
     else:
-        for filename in os.listdir(main_folder_path):
-            if filename.endswith('.json'):
-                file_path = os.path.join(main_folder_path, filename)
-                
-
-                key = filename.split('_')[2].replace(".json", "")
-
-                key = key.replace('ä', 'ae').replace('ö', 'oe').replace('ü', 'ue')
-
-                df = pd.read_json(file_path, orient='index')
-                df.index = df.index.str.replace('ä', 'ae').str.replace('ö', 'oe').str.replace('ü', 'ue')
-                print(key)
-                df_dict[key] = df
-        
-    return df_dict
+        experiment, scenario = parts
+        scenarios = [scenario]
+    station_ids = {name: i for i, name in
+                   enumerate(data_io.result_stations(experiment, hub=hub))}
+    df_dict = {scenario: {} for scenario in scenarios}
+
+    for scenario, origin, table, destinations in data_io.iter_results(experiment, scenarios,
+                                                                      hub=hub):
+        # The rows of every destination are stored contiguously, in the order of destinations
+        counts = np.bincount(table['destination'].to_numpy(),
+                             minlength=len(station_ids))[
+                                     [station_ids[d] for d in destinations]]
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        columns = {column: table[column].to_numpy() for column in data_io.RESULT_COLUMNS}
+        df = pd.DataFrame(
+                {column: [values[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+                 for column, values in columns.items()},
+                index=pd.Index(destinations, dtype=object))
+        df.index = df.index.str.replace('ä', 'ae').str.replace('ö', 'oe').str.replace('ü', 'ue')
+        df_dict[scenario][data_io.filename_escape(origin)] = df
+
+    for scenario in scenarios:
+        print(scenario, len(df_dict[scenario]))
+    if compare_gains:
+        return df_dict
+    return df_dict[scenarios[0]]
 
-def get_mean_delays(gain_dict, max_transfer_time=60, compare_gains=False, cases_needed=False):
+def get_mean_delays(gain_dict, max_transfer_time=60, compare_gains=False, cases_needed=False,
+                    report=None):
     """Calculates the mean delays over the origin destination pairs.
 
     Args:
@@ -65,6 +69,8 @@ def get_mean_delays(gain_dict, max_transfer_time=60, compare_gains=False, cases_
         compare_gains (bool, optional): If different gain calculation need to be loaded. 
             Defaults to False.
         cases_needed (bool, optional): If the reachability cases are needed. Defaults to False.
+        report (instrumentation.Report, optional): Report to which the aggregation is added
+            as a stage. Defaults to None.
 
     Returns:
         dict: mean delays and reachaility cases 
@@ -73,29 +79,90 @@ def get_mean_delays(gain_dict, max_transfer_time=60, compare_gains=False, cases_
         gain_dict = {'avg_gain': gain_dict}
     dict_mean_delays = {}
 
-    for key_gain, df_dict in gain_dict.items():
-        empty = pd.DataFrame(index=range(1, max_transfer_time + 1), columns=['mean_delay', 'reachable1', 'reachable2', 'reachable3'])
-        empty.loc[:, ['reachable1', 'reachable2', 'reachable3']] = 0
-        delay_matrix = [[] for _ in range(max_transfer_time)]
-
-        for key, df in df_dict.items():
-            for i in range(len(df)):
-                row = df.iloc[i]
-                valid_minutes = np.array(row['switch time']) <= max_transfer_time
-                minutes = np.array(row['switch time'])[valid_minutes].astype(int)
-                delays = np.array(row['delay'])[valid_minutes]
-                cases = np.array(row['reachable'])[valid_minutes]
+    with instrumentation.stage(report, 'aggregation') as stage:
+        stage.rows_in = 0
+        for key_gain, df_dict in gain_dict.items():
+            sums = DelaySums(max_transfer_time)
+            for key, df in df_dict.items():
+                if len(df) == 0:
+                    continue
+                switch_times = np.concatenate(df['switch time'].to_numpy())
+                sums.add(switch_times,
+                         np.concatenate(df['delay'].to_numpy()),
+                         np.concatenate(df['reachable'].to_numpy()))
+                stage.rows_in += len(switch_times)
+            dict_mean_delays[key_gain] = sums.mean_delays(cases_needed)
+        stage.rows_out = sum(len(df) for df in dict_mean_delays.values())
+    return dict_mean_delays
+
+
+def get_mean_delays_from_results(experiment, scenarios=None, max_transfer_time=60, cases_needed=False,
+                                 report=None, hub=None):
+    """Calculates the mean delays over the origin destination pairs
+    directly from the result store (see data_io.write_results),
+    reading one origin at a time. Gives the same result as
+    get_mean_delays(read_data(...)), without keeping all results in memory.
 
-                for minute, delay in zip(minutes, delays):
-                    delay_matrix[minute-1].append(delay)
-
-                if cases_needed:
-                    for minute, case in zip(minutes, cases):
-                        empty.loc[minute, f'reachable{case}'] += 1
-
-        means = [np.mean(minute).round(2) if minute else np.nan for minute in delay_matrix]
-        empty['mean_delay'] = means
-        df_mean_delays = empty
+    Args:
+        experiment (str): name of the experiment, eg. 'exp_006'
+        scenarios (list, optional): names of the scenarios (gain calculations).
+            Defaults to all scenarios of the experiment.
+        max_transfer_time (int, optional): maximally allowed scheduled transfert time in min. Defaults to 60.
+        cases_needed (bool, optional): If the reachability cases are needed. Defaults to False.
+        report (instrumentation.Report, optional): Report to which the aggregation is added
+            as a stage. Defaults to None.
+        hub (str, optional): key of the hub of the results (see hubs.HUBS).
+            Defaults to Frankfurt(Main)Hbf.
 
-        dict_mean_delays[key_gain] = df_mean_delays
-    return dict_mean_delays
\ No newline at end of file
+    Returns:
+        dict: mean delays and reachability cases per scenario
+    """
+    if scenarios is None:
+        scenarios = data_io.result_scenarios(experiment, hub)
+    sums = {scenario: DelaySums(max_transfer_time) for scenario in scenarios}
+    with instrumentation.stage(report, f'aggregation {experiment}') as stage:
+        stage.rows_in = 0
+        for scenario, _, table, _ in data_io.iter_results(experiment, scenarios, hub=hub):
+            sums[scenario].add(table['switch time'].to_numpy(),
+                               table['delay'].to_numpy(),
+                               table['reachable'].to_numpy())
+            stage.rows_in += table.num_rows
+        mean_delays = {scenario: sums[scenario].mean_delays(cases_needed)
+                       for scenario in scenarios}
+        stage.rows_out = sum(len(df) for df in mean_delays.values())
+    return mean_delays
+
+
+class DelaySums:
+    """Running sums and counts of delays and reachability cases per switch time minute"""
+
+    def __init__(self, max_transfer_time):
+        self.max_transfer_time = max_transfer_time
+        # Index 0 is not used, minute m is at index m
+        self.count = np.zeros(max_transfer_time + 1, dtype=np.int64)
+        self.delay_sum = np.zeros(max_transfer_time + 1)
+        self.cases = np.zeros((3, max_transfer_time + 1), dtype=np.int64)
+
+    def add(self, switch_times, delays, cases):
+        """Adds the delays of transfers with the given switch times and cases"""
+        switch_times = np.asarray(switch_times, dtype=float)
+        valid_minutes = (switch_times <= self.max_transfer_time) & (switch_times >= 1)
+        minutes = switch_times[valid_minutes].astype(int)
+        delays = np.asarray(delays, dtype=float)[valid_minutes]
+        cases = np.asarray(cases, dtype=np.int64)[valid_minutes]
+        length = self.max_transfer_time + 1
+        self.count += np.bincount(minutes, minlength=length)
+        self.delay_sum += np.bincount(minutes, weights=delays, minlength=length)
+        self.cases += np.bincount((cases - 1) * length + minutes,
+                                  minlength=3 * length).reshape(3, length)
+
+    def mean_delays(self, cases_needed=False):
+        """DataFrame of the mean delay (and the number of cases) per minute"""
+        df_mean_delays = pd.DataFrame(index=range(1, self.max_transfer_time + 1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.round(self.delay_sum[1:] / self.count[1:], 2)
+        df_mean_delays['mean_delay'] = np.where(self.count[1:] > 0, means, np.nan)
+        for case in range(1, 4):
+            df_mean_delays[f'reachable{case}'] = \
+                self.cases[case - 1, 1:] if cases_needed else 0
+        return df_mean_delays
@@ -1,28 +1,94 @@
 import os
+import sys
 import numpy as np
 import pandas as pd
-from datetime import timedelta
 from pathlib import Path
 from data_tools import *
 import data_io
+from station_dictionary import StationDictionary
 import requests
 import analysis
+import hubs
+import ingest
+import instrumentation
 
+# Transfer hub whose data is processed (see hubs.HUBS),
+# can be given as the first argument, eg. python src/preprocessing.py koeln_hbf
+HUB = hubs.get_hub(sys.argv[1] if len(sys.argv) > 1 else 'frankfurt_hbf')
 REPO_ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__), os.pardir))
 DATA_DIR = os.path.join(REPO_ROOT, "dat")
 INPUT_DIR = os.path.join(DATA_DIR, "raw")
-OUTPUT_DIR = os.path.join(DATA_DIR, "train_data", "frankfurt_hbf")
+OUTPUT_DIR = data_io.train_data_dir(HUB)
 Path(OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
-
-data_in = pd.read_csv(os.path.join(INPUT_DIR,
-                                   "scraped_incoming_Frankfurt_Hbf.csv"),
-                      names=['origin', 'destination', 'date', 'departure',
-                             'arrival', 'train', 'delay', 'cancellation'])
-data_out = pd.read_csv(os.path.join(INPUT_DIR,
-                                    "scraped_outgoing_Frankfurt_Hbf.csv"),
-                       names=['origin', 'destination', 'date', 'departure',
-                              'arrival', 'train', 'delay', 'cancellation'])
-data_in, data_out = fix_duplicate_frankfurt(data_in, data_out)
+# Upper bound for the memory used when reading the csv files, in bytes
+INGEST_MEMORY_LIMIT = ingest.MEMORY_LIMIT
+# If true, the gain estimates are computed from the stored train data a few
+# days at a time, with approximate medians (see analysis.GainStatistics),
+# instead of from all gains at once
+STREAM_GAINS = False
+GAIN_DAYS_PER_CHUNK = 31
+# If true, only the lines that were added to the scraped csv files since the
+# last run are read, and only their days after the last stored day are
+# processed and appended to the stored data (see README)
+APPEND = False
+SCRAPED_INCOMING_FILE = os.path.join(INPUT_DIR, HUB.incoming_basename)
+SCRAPED_OUTGOING_FILE = os.path.join(INPUT_DIR, HUB.outgoing_basename)
+# Profiling of the stages of the run report:
+# None, 'cprofile' or 'sampling' (see instrumentation.Report)
+PROFILE = None
+
+
+def stream_gain_statistics(days):
+    """Adds the gains of the stored data of the given days to a GainStatistics"""
+    gain_stats = analysis.GainStatistics()
+    for first in range(0, len(days), GAIN_DAYS_PER_CHUNK):
+        chunk_days = days[first:first + GAIN_DAYS_PER_CHUNK]
+        incoming_chunk, outgoing_chunk = data_io.load_incoming_outgoing_conns(
+                ['in_id', 'arrival', 'departure', 'delay'],
+                chunk_days[0], chunk_days[-1], hub=HUB)
+        gain_stats.add(*analysis.next_stop_gains(incoming_chunk, outgoing_chunk))
+    return gain_stats
+
+
+report = instrumentation.Report(f'preprocessing_{HUB.key}', profile=PROFILE)
+print(f"Preprocessing the data of {HUB.station}")
+stored_days = data_io.train_data_days(hub=HUB) if APPEND else []
+if APPEND and not stored_days:
+    print("There is no stored train data to append to, processing all data")
+    APPEND = False
+
+# Reading also formats the dates and times
+ingest_offsets = {}
+scraped_data = []
+with report.stage('read') as stage:
+    for filepath in (SCRAPED_INCOMING_FILE, SCRAPED_OUTGOING_FILE):
+        ingest_offsets[filepath] = os.path.getsize(filepath)
+        scraped_data.append(ingest.read_scraped_csv(
+                filepath, memory_limit=INGEST_MEMORY_LIMIT,
+                start=data_io.load_ingest_state(filepath, HUB) if APPEND else 0))
+    data_in, data_out = fix_duplicate_hub(*scraped_data, HUB)
+    stage.rows_out = len(data_in) + len(data_out)
+if APPEND:
+    # Stored days are not changed, so lines added later for them are dropped.
+    # They stay in the scraped csv files, so a run with APPEND = False includes them.
+    with report.stage('drop_stored_days', rows_in=len(data_in) + len(data_out)) as stage:
+        last_day = pd.Timestamp(stored_days[-1])
+        dates_in = pd.to_datetime(data_in['date'])
+        dates_out = pd.to_datetime(data_out['date'])
+        late_dates = pd.concat([dates_in[dates_in <= last_day],
+                                dates_out[dates_out <= last_day]])
+        if len(late_dates) > 0:
+            print(f"Warning: dropping {len(late_dates)} lines of the already stored days "
+                  f"{late_dates.min():%Y-%m-%d} to {late_dates.max():%Y-%m-%d} "
+                  f"(run with APPEND = False to include them)")
+        data_in = data_in[dates_in > last_day]
+        data_out = data_out[dates_out > last_day]
+        stage.rows_out = len(data_in) + len(data_out)
+    if len(data_in) == 0 and len(data_out) == 0:
+        print(f"There is no data after {stored_days[-1]} to append")
+        data_io.write_ingest_state(ingest_offsets, HUB)
+        report.write()
+        sys.exit()
 
 print(f"Number of incoming datapoints: {len(data_in)}")
 print(f"Number of outgoing datapoints: {len(data_out)}")
@@ -32,103 +98,86 @@ delays_out = data_out[pd.isna(data_out["cancellation"])]
 all_delays = np.append(np.array(delays_in["delay"]), np.array(delays_out["delay"]))
 print(f"Mean delay: {np.mean(all_delays)}")
 
-print("Formatting dates and times")
-format_datetimes(data_in)
-format_datetimes(data_out)
-
-data_in = data_in.sort_values(["date", "departure"])
-data_out = data_out.sort_values(["date", "arrival"])
-
-# Merge individual rows (stops of a train) together into one train line,
-# with lists specifying the stops, delays, etc.
-print("Group data by trains")
-result_in = data_in.groupby(['train', 'date', 'arrival', 'destination'])[
-        ['origin', 'departure', 'delay', 'cancellation']
-        ].agg(list).reset_index()
-result_out = data_out.groupby(['train', 'date', 'departure', 'origin'])[
-        ['destination', 'arrival', 'delay', 'cancellation']
-        ].agg(list).reset_index()
-
-
-# Collapse and/or clean up lists
-pd.options.mode.chained_assignment = None
-result_in.loc[:, 'delay'] = result_in.loc[:, 'delay'] \
-        .apply(lambda l: l[0])
-result_in.loc[:, 'cancellation'] = \
-        result_in.loc[:, 'cancellation'].apply(cancellation_to_int_lst)
-result_out.loc[:, 'cancellation'] = \
-        result_out.loc[:, 'cancellation'].apply(cancellation_to_int_lst)
-pd.options.mode.chained_assignment = 'warn'
-in_clean = result_in.infer_objects()
-out_clean = result_out.infer_objects()
-
-# Assign ids to every individual train
-len_in = len(in_clean)
-len_out = len(out_clean)
-in_clean['in_id'] = range(0, len_in)
-out_clean['out_id'] = range(len_in, len_in + len_out)
-
-print("Matching corresponding incoming and outgoing connections")
-merged = pd.merge(in_clean, out_clean, on=['date', 'train'], how='outer',
-                  suffixes=['_in', '_out'])
-correctly_matched = (
-        pd.isna(merged['arrival_in']) |
-        pd.isna(merged['departure_out']) |
-        ((merged['arrival_in'] <= merged['departure_out']) &
-         (merged['arrival_in'] > merged['departure_out'] - timedelta(minutes=60))
-         # Here, it is assumed that trains with the same train name have at
-         # least one hour in-between different trains with the same train name,
-         # which was manually verified to be the case for our dataset.
-         )
-        )
-merged = merged[correctly_matched]
-
-incoming = merged.loc[merged.loc[:, 'in_id'].notna()]
-outgoing = merged.loc[merged.loc[:, 'out_id'].notna()]
-incoming = incoming.loc[:, ['in_id', 'train', 'date', 'arrival_in',
-                            'destination_in', 'origin_in', 'departure_in',
-                            'delay_in', 'cancellation_in', 'out_id']]
-outgoing = outgoing.loc[:, ['out_id', 'train', 'date', 'arrival_out',
-                            'destination_out', 'origin_out', 'departure_out',
-                            'delay_out', 'cancellation_out', 'in_id']]
-# Rename the columns again after the merge and set some column types
-incoming = incoming.rename(columns={'arrival_in': 'arrival',
-                                    'destination_in': 'destination',
-                                    'origin_in': 'origin',
-                                    'departure_in': 'departure',
-                                    'delay_in': 'delay',
-                                    'cancellation_in': 'cancellation'})
-outgoing = outgoing.rename(columns={'arrival_out': 'arrival',
-                                    'destination_out': 'destination',
-                                    'origin_out': 'origin',
-                                    'departure_out': 'departure',
-                                    'delay_out': 'delay',
-                                    'cancellation_out': 'cancellation'})
-incoming['out_id'] = incoming.loc[:, 'out_id'].apply(d_id_to_int).astype(int)
-incoming['in_id'] = incoming.loc[:, 'in_id'].apply(d_id_to_int).astype(int)
-outgoing['out_id'] = outgoing.loc[:, 'out_id'].apply(d_id_to_int).astype(int)
-outgoing['in_id'] = outgoing.loc[:, 'in_id'].apply(d_id_to_int).astype(int)
-
-print(f"Removed {len_in - len(incoming)} wrongly merged incoming trains.")
-print(f"Removed {len_out - len(outgoing)} wrongly merged incoming trains.")
-
-incoming = determine_train_direction(incoming, True, debug=True)
-outgoing = determine_train_direction(outgoing, False, debug=True)
-incoming = remove_wrong_incoming_trains(incoming)
-outgoing = remove_wrong_outgoing_trains(outgoing)
-
-incoming['date'] = pd.to_datetime(incoming['date'])
-outgoing['date'] = pd.to_datetime(outgoing['date'])
+# The coordinates are the same for all hubs, they are downloaded if necessary
+data_io.download_coordinates_file()
+station_coords = data_io.load_station_coordinates()
+stations = unique_station_names(data_in, data_out, HUB)
+if not os.path.exists(data_io.hub_path(HUB, data_io.DIRECTIONS_BASENAME)):
+    # Only Frankfurt has hand-selected directions
+    print(f"Determine the directions of the stations from {HUB.station}")
+    data_io.write_directions(directions_by_bearing(station_coords, stations, HUB), HUB)
+
+with report.stage('match', rows_in=len(data_in) + len(data_out)) as stage:
+    # Merge the rows (stops) into trains, and match incoming and outgoing trains
+    incoming, outgoing = match_incoming_outgoing(data_in, data_out)
+
+    incoming = determine_train_direction(incoming, True, debug=True, hub=HUB)
+    outgoing = determine_train_direction(outgoing, False, debug=True, hub=HUB)
+    incoming = remove_wrong_incoming_trains(incoming, HUB)
+    if not APPEND:
+        # The ids of the wrong trains refer to the trains of all data
+        outgoing = remove_wrong_outgoing_trains(outgoing, HUB)
+
+    incoming.trains['date'] = pd.to_datetime(incoming.trains['date'])
+    outgoing.trains['date'] = pd.to_datetime(outgoing.trains['date'])
+    stage.rows_out = len(incoming) + len(outgoing)
 
 print("Determine station pairs to exclude from the analysis")
-excluded_pairs = determine_excluded_station_pairs(
-        data_io.load_station_coordinates(),
-        unique_station_names(data_in, data_out))
+with report.stage('excluded_pairs') as stage:
+    if APPEND:
+        # The stations of the stored data are the ones of the stored distances
+        stored_distances = data_io.load_station_distances(hub=HUB)
+        if stored_distances is not None:
+            stations |= set(stored_distances.index)
+    stage.rows_in = len(stations)
+    excluded_pairs = determine_excluded_station_pairs(station_coords, stations, HUB)
+    # Computes and caches the distances between the stations if necessary
+    station_distances(station_coords, stations, HUB)
+    stage.rows_out = len(excluded_pairs)
+
+if APPEND:
+    # Gains of the stored data, computed from it if they were not saved
+    gain_state = data_io.load_gain_statistics(HUB)
+    gain_stats = analysis.GainStatistics.from_state(gain_state) \
+        if gain_state is not None else stream_gain_statistics(stored_days)
 
 print("Write to data directory")
-data_io.write_incoming_outgoing_conns(incoming, outgoing)
-data_io.write_unique_station_names(incoming, outgoing)
-data_io.write_gain_vals(analysis.find_gains_per_next_stop(incoming, outgoing))
-data_io.download_coordinates_file()
+with report.stage('write', rows_in=len(incoming) + len(outgoing)):
+    if APPEND:
+        data_io.append_incoming_outgoing_conns(incoming, outgoing, HUB)
+    else:
+        data_io.write_incoming_outgoing_conns(incoming, outgoing, HUB)
+    unique_stations_in, unique_stations_out = \
+        data_io.write_unique_station_names(incoming, outgoing, append=APPEND, hub=HUB)
+    data_io.write_station_dictionary(StationDictionary.build(
+            unique_stations_in, unique_stations_out, excluded_pairs,
+            data_io.load_directions(HUB)), HUB)
+with report.stage('origin_features') as stage:
+    # Computes and caches the per-train information about the origins
+    stage.rows_out = len(data_io.load_origin_features(hub=HUB).columns['in_id'])
+with report.stage('gain_estimation', rows_in=len(incoming) + len(outgoing)) as stage:
+    if APPEND:
+        gain_stats.add(*analysis.next_stop_gains(incoming, outgoing))
+        data_io.write_gain_vals(gain_stats.statistics(), HUB)
+    elif STREAM_GAINS:
+        gain_stats = stream_gain_statistics(data_io.train_data_days(hub=HUB))
+        data_io.write_gain_vals(gain_stats.statistics(), HUB)
+    else:
+        next_stop, gains = analysis.next_stop_gains(incoming, outgoing)
+        stage.rows_out = len(gains)
+        data_io.write_gain_vals(analysis.gain_statistics(next_stop, gains), HUB)
+        # Kept for appending data later
+        gain_stats = analysis.GainStatistics()
+        gain_stats.add(next_stop, gains)
+    data_io.write_gain_statistics(gain_stats.state(), HUB)
 # Create list of (origin, destination) pairs to exclude
-data_io.write_excluded_station_pairs(excluded_pairs)
+data_io.write_excluded_station_pairs(excluded_pairs, HUB)
+new_days = sorted(set(incoming.trains['date'].dt.strftime('%Y-%m-%d'))
+                  | set(outgoing.trains['date'].dt.strftime('%Y-%m-%d')))
+if APPEND and new_days:
+    # Transfers on the day before the new days can continue on them
+    previous_day = (pd.Timestamp(new_days[0]) - pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+    data_io.mark_stale_result_days([previous_day] + new_days, HUB)
+    print(f"Appended the days {new_days[0]} to {new_days[-1]}")
+data_io.write_ingest_state(ingest_offsets, HUB)
+report.write()
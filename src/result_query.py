@@ -0,0 +1,215 @@
+"""
+This file contains a query API over the result store of an experiment
+(see data_io.write_results), which answers questions like
+"what is the expected delay from Köln Hbf to München Hbf with a switch time
+of 10 minutes?" without loading all results.
+
+The results of an origin are stored in one file, with the rows of every
+destination stored contiguously. ResultQuery memory-maps the file of an
+origin once, indexes the rows of its destinations, and computes the
+mean delays per switch time of a pair (like plotting_functions.get_mean_delays)
+only once. Both are kept in LRU caches, so repeated queries of the same
+(hot) pairs take well below a millisecond.
+Files that were rewritten (eg. because the experiment was run again)
+are read again.
+
+Usage:
+    query = ResultQuery('exp_007')
+    query.mean_delay('Köln Hbf', 'München Hbf', switch_time=10)
+or, for the results of another hub than Frankfurt(Main)Hbf (see hubs.HUBS),
+    query = ResultQuery('exp_007', hub='koeln_hbf')
+
+The queries can also be answered over HTTP, see result_server.py.
+"""
+import functools
+import os
+import numpy as np
+import pandas as pd
+import data_io
+import hubs
+from plotting_functions import DelaySums, get_mean_delays_from_results
+
+# Number of origin files and of pairs kept in the caches
+ORIGIN_CACHE_SIZE = 64
+PAIR_CACHE_SIZE = 1024
+# Reachability cases (see analysis.reachable_transfers)
+CASES = [1, 2, 3]
+
+
+class ResultQuery:
+    """
+    Queries of the results of one experiment.
+
+    Args:
+    - experiment: name of the experiment, eg. 'exp_007'
+    - max_transfer_time (optional): largest switch time in minutes
+        of the mean delays. Defaults to 60.
+    - hub (optional): the hub of the experiment or its key (see hubs.get_hub)
+    """
+
+    def __init__(self, experiment, max_transfer_time=60, hub=None):
+        self.experiment = experiment
+        self.max_transfer_time = max_transfer_time
+        self.hub = hubs.get_hub(hub)
+        self.results_dir = data_io.results_dir(self.hub)
+        self.scenarios = data_io.result_scenarios(experiment, self.hub)
+        self.stations = data_io.result_stations(experiment, hub=self.hub)
+        self.station_ids = {name: i for i, name in enumerate(self.stations)}
+        # Per instance, so that the caches of different experiments are separate
+        self._origin_rows = functools.lru_cache(ORIGIN_CACHE_SIZE)(self._read_origin)
+        self._pair_sums = functools.lru_cache(PAIR_CACHE_SIZE)(self._compute_pair_sums)
+        self._overall = functools.lru_cache(None)(self._compute_overall)
+
+    def scenario(self, scenario=None):
+        """Checks the name of a scenario, which may be omitted if there is only one"""
+        if scenario is None:
+            if len(self.scenarios) != 1:
+                raise ValueError(f"The scenario has to be one of {self.scenarios}")
+            return self.scenarios[0]
+        if scenario not in self.scenarios:
+            raise KeyError(f"Unknown scenario: {scenario}")
+        return scenario
+
+    def station_id(self, name):
+        if name not in self.station_ids:
+            # The experiment may have been run again with new stations
+            self.stations = data_io.result_stations(self.experiment, hub=self.hub)
+            self.station_ids = {name: i for i, name in enumerate(self.stations)}
+        if name not in self.station_ids:
+            raise KeyError(f"Unknown station: {name}")
+        return self.station_ids[name]
+
+    def _read_origin(self, scenario, origin_id, modified):
+        """
+        Memory-maps the results of an origin, and indexes the rows of its
+        destinations. modified is the modification time of the file,
+        so that a rewritten file is not taken from the cache.
+        """
+        filepath = os.path.join(self.results_dir, self.experiment, scenario,
+                                f'{origin_id}.arrow')
+        table, destinations = data_io.read_result_file(filepath)
+        # The rows of every destination are stored contiguously, in the order of destinations
+        counts = np.bincount(table['destination'].to_numpy(),
+                             minlength=max(destinations, default=-1) + 1)[destinations]
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        rows = {destination: (start, end) for destination, start, end
+                in zip(destinations, offsets[:-1], offsets[1:])}
+        return table, rows
+
+    def _pair_table(self, scenario, origin, destination):
+        origin_id = self.station_id(origin)
+        destination_id = self.station_id(destination)
+        filepath = os.path.join(self.results_dir, self.experiment, scenario,
+                                f'{origin_id}.arrow')
+        try:
+            modified = os.stat(filepath).st_mtime_ns
+        except FileNotFoundError:
+            raise KeyError(f"There are no results of {origin}") from None
+        table, rows = self._origin_rows(scenario, origin_id, modified)
+        if destination_id not in rows:
+            raise KeyError(f"There are no results from {origin} to {destination}")
+        start, end = rows[destination_id]
+        return table.slice(start, end - start), modified
+
+    def transfers(self, origin, destination, scenario=None, case=None):
+        """
+        Returns the transfers from origin to destination as a DataFrame
+        with the columns RESULT_COLUMNS (see data_io.write_results),
+        optionally only the ones of one reachability case.
+        """
+        table, _ = self._pair_table(self.scenario(scenario), origin, destination)
+        transfers = table.select(data_io.RESULT_COLUMNS).to_pandas(date_as_object=False)
+        if case is not None:
+            transfers = transfers[transfers['reachable'] == case].reset_index(drop=True)
+        return transfers
+
+    def _compute_pair_sums(self, scenario, origin, destination, modified):
+        """DelaySums of a pair, of all transfers (key None) and of every case"""
+        table, _ = self._pair_table(scenario, origin, destination)
+        switch_times = table['switch time'].to_numpy()
+        delays = table['delay'].to_numpy()
+        cases = table['reachable'].to_numpy()
+        sums = {None: DelaySums(self.max_transfer_time)}
+        sums[None].add(switch_times, delays, cases)
+        for case in CASES:
+            is_case = cases == case
+            sums[case] = DelaySums(self.max_transfer_time)
+            sums[case].add(switch_times[is_case], delays[is_case], cases[is_case])
+        return sums
+
+    def pair_sums(self, origin, destination, scenario=None, case=None):
+        """Cached DelaySums of a pair, of all transfers or of one case"""
+        if case is not None and case not in CASES:
+            raise ValueError(f"The reachability case has to be one of {CASES}")
+        scenario = self.scenario(scenario)
+        _, modified = self._pair_table(scenario, origin, destination)
+        return self._pair_sums(scenario, origin, destination, modified)[case]
+
+    def pair(self, origin, destination, scenario=None, case=None):
+        """
+        Returns the mean delays per switch time of the transfers from
+        origin to destination, in the format of plotting_functions.get_mean_delays
+        (mean_delay and the number of transfers per reachability case,
+        indexed by the switch time in minutes), optionally only of the
+        transfers of one reachability case.
+        """
+        return self.pair_sums(origin, destination, scenario, case).mean_delays(True) \
+            .rename_axis('switch_time')
+
+    def mean_delay(self, origin, destination, switch_time, scenario=None, case=None):
+        """
+        Returns the expected delay at destination, when transferring
+        at the hub with the given switch time (in whole minutes),
+        optionally only of the transfers of one reachability case.
+
+        Returns:
+        - dict with the mean delay (None if there are no such transfers),
+            the number of transfers and the number of transfers
+            per reachability case
+        """
+        scenario = self.scenario(scenario)
+        if not 1 <= switch_time <= self.max_transfer_time:
+            raise ValueError(f"The switch time has to be between 1 and "
+                             f"{self.max_transfer_time} minutes")
+        sums = self.pair_sums(origin, destination, scenario, case)
+        minute = int(switch_time)
+        count = int(sums.count[minute])
+        return {'scenario': scenario, 'origin': origin, 'destination': destination,
+                'switch_time': minute, 'case': case,
+                'mean_delay': round(sums.delay_sum[minute] / count, 2) if count > 0 else None,
+                'transfers': count,
+                **{f'reachable{c}': int(sums.cases[c - 1, minute]) for c in CASES}}
+
+    def _compute_overall(self, scenario, modified):
+        return get_mean_delays_from_results(self.experiment, [scenario],
+                                            self.max_transfer_time, True,
+                                            hub=self.hub)[scenario] \
+            .rename_axis('switch_time')
+
+    def overall(self, scenario=None):
+        """
+        Mean delays per switch time over all pairs
+        (see plotting_functions.get_mean_delays_from_results),
+        computed once per version of the results.
+        """
+        scenario = self.scenario(scenario)
+        dirname = os.path.join(self.results_dir, self.experiment, scenario)
+        modified = max((entry.stat().st_mtime_ns for entry in os.scandir(dirname)),
+                       default=0)
+        return self._overall(scenario, modified)
+
+    def clear(self):
+        """Empties the caches"""
+        self._origin_rows.cache_clear()
+        self._pair_sums.cache_clear()
+        self._overall.cache_clear()
+
+
+def records(frame):
+    """Rows of a DataFrame as a list of dicts that can be written as JSON"""
+    if frame.index.name is not None:
+        frame = frame.reset_index()
+    for column in frame.columns:
+        if pd.api.types.is_datetime64_any_dtype(frame[column]):
+            frame[column] = frame[column].dt.strftime('%Y-%m-%d %H:%M:%S')
+    return frame.astype(object).where(frame.notna(), None).to_dict(orient='records')
@@ -0,0 +1,89 @@
+"""
+This script serves the queries of result_query.ResultQuery over HTTP
+on the local machine, and answers with JSON.
+
+Run it from the root directory of the repo with
+    python src/result_server.py
+(or python src/result_server.py koeln_hbf for the results of another hub)
+and query it, eg. with
+    curl 'http://127.0.0.1:8000/mean_delay?origin=Köln Hbf&destination=München Hbf&switch_time=10'
+
+Endpoints (the parameters scenario and case are optional,
+scenario can only be omitted if the experiment has one scenario):
+- /scenarios: names of the scenarios of the experiment
+- /mean_delay?origin=...&destination=...&switch_time=...&scenario=...&case=...:
+    expected delay for one switch time (see ResultQuery.mean_delay)
+- /pair?origin=...&destination=...&scenario=...&case=...:
+    mean delays per switch time of a pair (see ResultQuery.pair)
+- /transfers?origin=...&destination=...&scenario=...&case=...:
+    all transfers of a pair (see ResultQuery.transfers)
+- /overall?scenario=...: mean delays per switch time over all pairs
+"""
+import json
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from time import perf_counter
+from urllib.parse import parse_qs, urlparse
+import hubs
+from result_query import ResultQuery, records
+
+# Hub of the results (see hubs.HUBS), can be given as the first argument
+HUB = hubs.get_hub(sys.argv[1] if len(sys.argv) > 1 else 'frankfurt_hbf')
+EXPERIMENT = 'exp_007'
+MAX_TRANSFER_TIME = 60
+# Only reachable from the local machine
+HOST = '127.0.0.1'
+PORT = 8000
+
+query = ResultQuery(EXPERIMENT, MAX_TRANSFER_TIME, HUB)
+
+
+def required(parameters, name):
+    if name not in parameters:
+        raise ValueError(f"Missing parameter: {name}")
+    return parameters[name]
+
+
+def answer(path, parameters):
+    """Answers a query, returns the content of the response"""
+    case = int(parameters['case']) if 'case' in parameters else None
+    scenario = parameters.get('scenario')
+    if path == '/scenarios':
+        return query.scenarios
+    if path == '/overall':
+        return records(query.overall(scenario))
+    if path not in ('/mean_delay', '/pair', '/transfers'):
+        raise FileNotFoundError(f"Unknown query: {path}")
+    origin = required(parameters, 'origin')
+    destination = required(parameters, 'destination')
+    if path == '/mean_delay':
+        return query.mean_delay(origin, destination,
+                                float(required(parameters, 'switch_time')), scenario, case)
+    if path == '/pair':
+        return records(query.pair(origin, destination, scenario, case))
+    return records(query.transfers(origin, destination, scenario, case))
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        start = perf_counter()
+        url = urlparse(self.path)
+        parameters = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            status, content = 200, answer(url.path, parameters)
+        except (FileNotFoundError, KeyError) as error:
+            status, content = 404, {'error': str(error).strip("'")}
+        except ValueError as error:
+            status, content = 400, {'error': str(error)}
+        body = json.dumps(content, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Query-Time-Ms', f'{(perf_counter() - start) * 1000:.3f}')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+print(f"Serving the results of {EXPERIMENT} of {HUB.station} on http://{HOST}:{PORT}")
+HTTPServer((HOST, PORT), QueryHandler).serve_forever()
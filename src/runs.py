@@ -0,0 +1,188 @@
+"""
+This file contains run manifests, which record the progress of long
+experiment runs, so that an interrupted run can be resumed.
+
+A run is identified by a hash of its parameters and of the input data
+(sizes and modification times of the data files), so that results are only
+reused if neither has changed. Its directory in dat/runs (in the directory
+of the hub for other hubs than the default one, see data_io.hub_dir) contains
+- manifest.json: the name, parameters and inputs of the run
+- journal.jsonl: one line [origin, destination, result] per completed pair
+    of an origin whose results are not written to the result store yet,
+    and one line [origin, destinations] per origin whose results are written
+The results of the pairs of an origin are only kept until the origin is
+written, the journal is compacted when a run is resumed and whenever
+no written origin is missing. A line that was cut off by a crash is
+discarded when the run is resumed.
+When a new run of an experiment is started, the directories of its
+previous runs (of other parameters or input data) are removed.
+"""
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+import data_io
+
+RUNS_BASENAME = 'runs'
+MANIFEST_BASENAME = 'manifest.json'
+JOURNAL_BASENAME = 'journal.jsonl'
+# Length of the hash in the directory name of a run
+KEY_LENGTH = 16
+
+
+def run_key(params, fingerprint):
+    """Hash of the parameters and inputs of a run"""
+    description = json.dumps({'params': params, 'inputs': fingerprint},
+                             sort_keys=True, default=str)
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()[:KEY_LENGTH]
+
+
+class Run:
+    """
+    Progress of an experiment run over (origin, destination) pairs.
+
+    Args:
+    - name: name of the experiment, eg. 'exp_007'
+    - params: dict of all parameters that influence the results
+        (has to be serializable to JSON)
+    - input_paths (optional): files or directories with the input data.
+        Defaults to the train data and the gain values of the hub.
+    - hub (optional): the hub or its key (see hubs.get_hub)
+
+    Attributes:
+    - key: hash of params and the inputs
+    - dirname: directory of the run
+    - done: set of the (origin, destination) pairs whose results
+        are written to the result store
+    - results: dict mapping completed pairs of origins that are not
+        written yet to their results
+    """
+
+    def __init__(self, name, params, input_paths=None, hub=None):
+        if input_paths is None:
+            input_paths = [data_io.train_data_dir(hub),
+                           data_io.hub_path(hub, data_io.GAIN_VALS_BASENAME)]
+        input_paths = [path for path in input_paths if os.path.exists(path)]
+        fingerprint = data_io.fingerprint_files(input_paths)
+        self.key = run_key(params, fingerprint)
+        self.dirname = data_io.hub_path(hub, RUNS_BASENAME, f'{name}_{self.key}')
+        self.journal_path = os.path.join(self.dirname, JOURNAL_BASENAME)
+        self.done = set()
+        self.results = {}
+        manifest_path = os.path.join(self.dirname, MANIFEST_BASENAME)
+        if os.path.exists(manifest_path):
+            self.read_journal()
+            print(f"Resuming run {name}_{self.key}: "
+                  f"{len(self.done) + len(self.results)} pairs are already done.")
+        else:
+            remove_runs(name, hub)
+            Path(self.dirname).mkdir(parents=True, exist_ok=True)
+            data_io.write_json({'name': name, 'key': self.key,
+                                'params': json.loads(json.dumps(params, default=str)),
+                                'inputs': fingerprint},
+                               MANIFEST_BASENAME,
+                               os.path.relpath(self.dirname, data_io.DATA_DIR))
+
+    def read_journal(self):
+        """
+        Reads the written and the completed pairs from the journal,
+        and compacts it, which also cuts off an incomplete last line.
+        """
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'rb') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                if len(entry) == 2:
+                    self.add_written(*entry)
+                else:
+                    origin, destination, result = entry
+                    self.results[(origin, destination)] = result
+        self.compact()
+
+    def compact(self):
+        """
+        Rewrites the journal with the written origins and the results
+        of the pairs of the other origins only.
+        """
+        destinations = {}
+        for origin, destination in self.done:
+            destinations.setdefault(origin, []).append(destination)
+
+        def write(journal):
+            for origin in sorted(destinations):
+                journal.write(json.dumps([origin, sorted(destinations[origin])]) + '\n')
+            for (origin, destination), result in self.results.items():
+                journal.write(json.dumps([origin, destination, result]) + '\n')
+        data_io.write_atomically(self.journal_path, write)
+
+    def add_written(self, origin, destinations):
+        """Moves the pairs of a written origin from results to done"""
+        for destination in destinations:
+            self.done.add((origin, destination))
+            self.results.pop((origin, destination), None)
+
+    def unwritten(self, pairs):
+        """
+        Returns the pairs of the origins that are not written yet
+        (with all of their destinations in pairs).
+        """
+        origins = {origin for origin, destination in pairs
+                   if (origin, destination) not in self.done}
+        return [tuple(pair) for pair in pairs if pair[0] in origins]
+
+    def pending(self, pairs):
+        """
+        Returns the pairs that have to be computed: the pairs of the origins
+        that are not written yet, except the ones that are completed.
+        """
+        return [pair for pair in self.unwritten(pairs) if pair not in self.results]
+
+    def record(self, results):
+        """
+        Writes the (origin, destination, result) tuples yielded by results
+        (see scheduler.run_pairs) to the journal as they are done,
+        and passes them on.
+        """
+        with open(self.journal_path, 'a', encoding='utf-8') as journal:
+            for origin, destination, result in results:
+                journal.write(json.dumps([origin, destination, result]) + '\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+                self.results[(origin, destination)] = result
+                yield origin, destination, result
+
+    def mark_written(self, origin, destinations):
+        """
+        Records that the results of origin to destinations are written
+        to the result store, after which they are not kept anymore.
+        """
+        destinations = list(destinations)
+        with open(self.journal_path, 'a', encoding='utf-8') as journal:
+            journal.write(json.dumps([origin, destinations]) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.add_written(origin, destinations)
+        if not self.results:
+            self.compact()
+
+
+def remove_runs(name, hub=None):
+    """Removes the directories of all runs of an experiment"""
+    dirname = data_io.hub_path(hub, RUNS_BASENAME)
+    if not os.path.isdir(dirname):
+        return
+    for entry in os.scandir(dirname):
+        manifest_path = os.path.join(entry.path, MANIFEST_BASENAME)
+        if not entry.is_dir() or not os.path.exists(manifest_path):
+            continue
+        with open(manifest_path, 'r', encoding='utf-8') as file:
+            if json.load(file)['name'] == name:
+                print(f"Removing the previous run {entry.name}")
+                shutil.rmtree(entry.path, ignore_errors=True)
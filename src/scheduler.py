@@ -0,0 +1,331 @@
+"""
+This file contains a process pool that runs the analysis for many
+(origin, destination) pairs in parallel. It is used in the experiments.
+
+The incoming and outgoing StopTables are copied once into shared memory,
+and every worker process creates its StopTables as views of that memory,
+so the dataset is not copied per worker.
+The pairs are processed longest-first, where the cost of a pair is estimated
+from the number of trains from origin and to destination.
+The number of workers is chosen such that they fit into a memory budget,
+and errors in workers (including workers that were killed, eg. because they
+ran out of memory) are raised in the main process instead of hanging.
+"""
+import itertools
+import mmap
+import os
+from time import perf_counter, process_time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+import psutil
+from stop_table import StopTable, StationIndex
+import instrumentation
+
+# Default upper bound for the memory used by the shared data and all workers,
+# in bytes
+MEMORY_LIMIT = 16 * 1024**3
+# Default estimate of the memory one worker uses on top of the shared data
+WORKER_MEMORY = 2 * 1024**3
+# Seconds to wait for a running pair before checking the free memory again
+MEMORY_POLL_INTERVAL = 1.0
+
+# Shared memory blocks are named <prefix><pid of the main process>_<name>
+SHARED_MEMORY_PREFIX = 'dataliteracy_'
+SHARED_MEMORY_DIR = '/dev/shm'
+
+STOP_ARRAYS = ['offsets', 'station', 'time', 'delay', 'cancellation']
+INDEX_ARRAYS = ['offsets', 'train_rows', 'positions']
+
+# Data of the worker processes, set by init_worker
+_shared_blocks = []
+_shared_data = {}
+
+
+def is_file_backed(array):
+    """Whether array is a memory-mapped file (see data_io.spill_array)"""
+    return isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap)
+
+
+class SharedArrays:
+    """
+    Copies numpy arrays into one shared memory block,
+    and describes them so that views of them can be created
+    in other processes (see attach_arrays).
+    Memory-mapped files are not copied, the other processes map the same file.
+    """
+
+    def __init__(self, arrays, name):
+        self.layout = []
+        offset = 0
+        for array in arrays:
+            if is_file_backed(array):
+                self.layout.append((array.offset, array.dtype.str, array.shape,
+                                    array.filename))
+                continue
+            array = np.ascontiguousarray(array)
+            self.layout.append((offset, array.dtype.str, array.shape, None))
+            # Keep every array aligned to 8 bytes
+            offset += -(-array.nbytes // 8) * 8
+        self.nbytes = offset
+        self.block = shared_memory.SharedMemory(
+                name=f'{SHARED_MEMORY_PREFIX}{os.getpid()}_{name}',
+                create=True, size=max(offset, 1))
+        for view, array, (_, _, _, filename) in zip(
+                attach_arrays(self.block, self.layout), arrays, self.layout):
+            if filename is None:
+                view[...] = array
+
+    def descriptor(self):
+        return self.block.name, self.layout
+
+    def close(self):
+        self.block.close()
+        self.block.unlink()
+
+
+def remove_stale_blocks():
+    """
+    Removes the shared memory of runs whose main process was killed
+    before it could clean up (only on systems with /dev/shm).
+    """
+    if not os.path.isdir(SHARED_MEMORY_DIR):
+        return
+    for filename in os.listdir(SHARED_MEMORY_DIR):
+        if not filename.startswith(SHARED_MEMORY_PREFIX):
+            continue
+        pid = filename[len(SHARED_MEMORY_PREFIX):].split('_')[0]
+        if pid.isdigit() and not psutil.pid_exists(int(pid)):
+            print(f"Removing stale shared memory {filename}")
+            os.remove(os.path.join(SHARED_MEMORY_DIR, filename))
+
+
+def attach_arrays(block, layout):
+    """Returns views of the arrays in a shared memory block (or in files)"""
+    return [np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf, offset=offset)
+            if filename is None
+            else np.memmap(filename, dtype=np.dtype(dtype), mode='r',
+                           offset=offset, shape=shape)
+            for offset, dtype, shape, filename in layout]
+
+
+def split_stop_table(stop_table):
+    """
+    Splits a StopTable into a list of numpy arrays and a (small)
+    description of how to put them together again (see join_stop_table).
+    Object columns of the trains are stored as categorical codes,
+    so they are categorical after joining.
+    """
+    arrays = [getattr(stop_table, name) for name in STOP_ARRAYS]
+    arrays += [getattr(stop_table.station_index, name) for name in INDEX_ARRAYS]
+    columns = []
+    for column, values in stop_table.trains.items():
+        if values.dtype == object:
+            values = values.astype('category')
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            columns.append((column, values.cat.categories))
+            arrays.append(values.cat.codes.to_numpy())
+        else:
+            columns.append((column, None))
+            arrays.append(values.to_numpy())
+    return arrays, (stop_table.stations, columns)
+
+
+def join_stop_table(arrays, description):
+    """Creates a StopTable from the output of split_stop_table without copying"""
+    stations, columns = description
+    offsets, station, time, delay, cancellation = arrays[:len(STOP_ARRAYS)]
+    index = arrays[len(STOP_ARRAYS):len(STOP_ARRAYS) + len(INDEX_ARRAYS)]
+    trains = {}
+    for (column, categories), values in zip(
+            columns, arrays[len(STOP_ARRAYS) + len(INDEX_ARRAYS):]):
+        if categories is None:
+            trains[column] = values
+        else:
+            trains[column] = pd.Categorical.from_codes(values, categories)
+    stop_table = StopTable(pd.DataFrame(trains, copy=False), offsets, station,
+                           stations, time, delay, cancellation)
+    stop_table.station_index = StationIndex(*index)
+    return stop_table
+
+
+def init_worker(descriptors, initializer=None, initargs=()):
+    """
+    Attaches a worker process to the shared StopTables,
+    and then calls initializer(*initargs) if it is given
+    """
+    for name, (block_name, layout, description) in descriptors.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _shared_blocks.append(block)
+        _shared_data[name] = join_stop_table(attach_arrays(block, layout), description)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def run_pair(function, origin, destination):
+    """
+    Runs function for one pair in a worker.
+    Returns its result, and the time and counters of the pair
+    (see instrumentation.Report.add_pair).
+    """
+    instrumentation.counters.clear()
+    start_wall, start_cpu = perf_counter(), process_time()
+    result = function(_shared_data['incoming'], _shared_data['outgoing'],
+                      origin, destination)
+    measurements = {'seconds': perf_counter() - start_wall,
+                    'cpu_seconds': process_time() - start_cpu,
+                    'worker': os.getpid(),
+                    **instrumentation.counters}
+    return result, measurements
+
+
+def estimate_costs(pairs, incoming, outgoing):
+    """
+    Estimates the relative cost of processing every pair, as the number
+    of candidate transfers grows with the number of incoming trains from
+    origin times the number of outgoing trains to destination.
+    """
+    num_incoming = np.diff(incoming.station_index.offsets)
+    num_outgoing = np.diff(outgoing.station_index.offsets)
+    costs = []
+    for origin, destination in pairs:
+        origin_code = incoming.station_code(origin)
+        destination_code = outgoing.station_code(destination)
+        costs.append(
+                (num_incoming[origin_code] if origin_code >= 0 else 0)
+                * (num_outgoing[destination_code] if destination_code >= 0 else 0))
+    return costs
+
+
+def choose_num_workers(n_workers, shared_bytes, memory_limit, worker_memory):
+    """
+    Number of workers that fit into the cpu and memory budget.
+    Raises a MemoryError if not even one worker fits.
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = min(n_workers, (memory_limit - shared_bytes) // worker_memory)
+    if n_workers < 1:
+        raise MemoryError(
+                f"The shared data ({shared_bytes} bytes) and one worker "
+                f"({worker_memory} bytes) do not fit into the memory limit "
+                f"of {memory_limit} bytes.")
+    return int(n_workers)
+
+
+def run_pairs(function, pairs, incoming, outgoing, n_workers=None,
+              memory_limit=MEMORY_LIMIT, worker_memory=WORKER_MEMORY, report=None,
+              initializer=None, initargs=()):
+    """
+    Calls function(incoming, outgoing, origin, destination) for every
+    (origin, destination) pair in parallel, and yields the results
+    in the order in which they are done.
+
+    Args:
+    - function: module level function, so that it can be sent to the workers.
+        It must not read data that only exists in the main process,
+        as the workers are not forked on every system (see initializer).
+    - pairs: list of (origin, destination) tuples
+    - incoming (StopTable): Incoming train information, shared with the workers
+    - outgoing (StopTable): Outgoing train information, shared with the workers
+    - n_workers (optional): maximum number of worker processes.
+        Defaults to the number of cpus.
+    - memory_limit (optional): upper bound for the memory in bytes that the
+        shared data and the workers may use.
+    - worker_memory (optional): estimate of the memory in bytes that one
+        worker uses. New pairs are only started if this much memory
+        is available on the system.
+    - report (optional): instrumentation.Report, to which the time and
+        the counters of every pair are added.
+    - initializer, initargs (optional): module level function that is called
+        with initargs once in every worker, eg. to set the data of a run that
+        function reads. initargs are sent to every worker once,
+        instead of with every pair.
+
+    Yields:
+    - (origin, destination, result) for every pair
+    """
+    if not pairs:
+        return
+    costs = estimate_costs(pairs, incoming, outgoing)
+    # Longest first, so that no long pair is started at the very end
+    todo = [pairs[i] for i in sorted(range(len(pairs)), key=lambda i: -costs[i])]
+    remove_stale_blocks()
+    shared = {}
+    try:
+        descriptors = {}
+        for name, stop_table in (('incoming', incoming), ('outgoing', outgoing)):
+            arrays, description = split_stop_table(stop_table)
+            shared[name] = SharedArrays(arrays, name)
+            descriptors[name] = (*shared[name].descriptor(), description)
+        n_workers = choose_num_workers(
+                n_workers, sum(s.nbytes for s in shared.values()),
+                memory_limit, worker_memory)
+        print(f"Processing {len(pairs)} pairs with {n_workers} workers")
+        with ProcessPoolExecutor(n_workers, initializer=init_worker,
+                                 initargs=(descriptors, initializer, initargs)) as executor:
+            yield from run_scheduled(executor, function, todo, n_workers,
+                                     worker_memory, report)
+    finally:
+        for shared_arrays in shared.values():
+            shared_arrays.close()
+
+
+def run_scheduled(executor, function, todo, n_workers, worker_memory, report=None):
+    """
+    Submits the pairs in todo in order, with at most n_workers running
+    at a time, and only if enough memory is available.
+    """
+    todo = list(reversed(todo))
+    running = {}
+    try:
+        while todo or running:
+            while todo and len(running) < n_workers:
+                if running and psutil.virtual_memory().available < worker_memory:
+                    break
+                origin, destination = todo.pop()
+                future = executor.submit(run_pair, function, origin, destination)
+                running[future] = (origin, destination)
+            done, _ = wait(running, timeout=MEMORY_POLL_INTERVAL,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                origin, destination = running.pop(future)
+                try:
+                    result, measurements = future.result()
+                except Exception as error:
+                    raise RuntimeError(
+                            f"Processing {origin} -> {destination} failed") from error
+                if report is not None:
+                    report.add_pair(origin, destination, measurements)
+                yield origin, destination, result
+    finally:
+        for future in running:
+            future.cancel()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def results_per_origin(results, pairs, done=None):
+    """
+    Collects the results of run_pairs per origin.
+    Yields (origin, {destination: result}) as soon as
+    all pairs of an origin are done, with the destinations
+    in the order of pairs.
+    done (optional) maps pairs that were done before (and are not
+    part of results) to their results (see runs.Run).
+    """
+    destinations = {}
+    for origin, destination in pairs:
+        destinations.setdefault(origin, []).append(destination)
+    remaining = {origin: len(dests) for origin, dests in destinations.items()}
+    collected = {}
+    previous = ((origin, destination, done[(origin, destination)])
+                for origin, destination in pairs
+                if done is not None and (origin, destination) in done)
+    for origin, destination, result in itertools.chain(previous, results):
+        collected.setdefault(origin, {})[destination] = result
+        remaining[origin] -= 1
+        if remaining[origin] == 0:
+            results_of_origin = collected.pop(origin)
+            yield origin, {destination: results_of_origin[destination]
+                           for destination in destinations[origin]}
@@ -0,0 +1,162 @@
+"""
+This file contains the station dictionary, which assigns dense integer ids
+to the names of the stations in the train data, and stores the information
+about stations as arrays indexed by these ids, so that stations and pairs
+of stations can be selected with array operations instead of comparing names.
+
+It is built in preprocessing for every hub, and can be loaded with
+data_io.load_station_dictionary. The dictionaries of several hubs can
+be given the same ids (see StationDictionary.reindex and multi_hub.py).
+"""
+import numpy as np
+import pandas as pd
+
+
+def station_direction_codes(stations, directions):
+    """
+    Returns, for every station name in stations, the index of its direction
+    in directions (see data_io.load_directions), or -1 if it is in none.
+    A station in several directions gets the first of them.
+    """
+    codes = {}
+    for code, direction_stations in enumerate(directions.values()):
+        for station in direction_stations:
+            codes.setdefault(station, code)
+    return np.array([codes.get(station, -1) for station in stations], dtype=np.int8)
+
+
+class StationDictionary:
+    """
+    Station names with dense integer ids (their positions in names,
+    which are sorted), and information about the stations indexed by id.
+
+    Attributes:
+    - names: array of the station names
+    - incoming: bool array, whether trains go from the station to the hub
+    - outgoing: bool array, whether trains go from the hub to the station
+    - direction: int8 array of the index of the direction of every station
+        in direction_names, -1 if the station is in none of them
+    - direction_names: list of the directions (see data_io.load_directions)
+    - excluded: bitmap of the excluded (origin, destination) pairs,
+        a uint8 array with one row per origin and one bit per destination
+        (see np.packbits)
+    """
+
+    def __init__(self, names, incoming, outgoing, direction, direction_names, excluded):
+        self.names = np.asarray(names, dtype=object)
+        self.incoming = np.asarray(incoming, dtype=bool)
+        self.outgoing = np.asarray(outgoing, dtype=bool)
+        self.direction = np.asarray(direction, dtype=np.int8)
+        self.direction_names = list(direction_names)
+        self.excluded = np.asarray(excluded, dtype=np.uint8)
+        self._index = pd.Index(self.names)
+
+    @classmethod
+    def build(cls, stations_in, stations_out, excluded_pairs, directions):
+        """
+        Builds the dictionary of all stations in stations_in and stations_out.
+
+        Args:
+        - stations_in: names of the stations with trains to the hub
+        - stations_out: names of the stations with trains from the hub
+        - excluded_pairs: DataFrame with the columns origin and destination
+            (see data_tools.determine_excluded_station_pairs).
+            Pairs of stations that are not in the dictionary are ignored.
+        - directions: dict of the stations per direction
+            (see data_io.load_directions)
+        """
+        names = np.array(sorted(set(stations_in) | set(stations_out)), dtype=object)
+        index = pd.Index(names)
+        incoming = np.zeros(len(names), dtype=bool)
+        incoming[index.get_indexer(list(stations_in))] = True
+        outgoing = np.zeros(len(names), dtype=bool)
+        outgoing[index.get_indexer(list(stations_out))] = True
+        origins = index.get_indexer(excluded_pairs['origin'])
+        destinations = index.get_indexer(excluded_pairs['destination'])
+        is_known = (origins >= 0) & (destinations >= 0)
+        excluded = np.zeros((len(names), len(names)), dtype=bool)
+        excluded[origins[is_known], destinations[is_known]] = True
+        return cls(names, incoming, outgoing,
+                   station_direction_codes(names, directions), list(directions),
+                   np.packbits(excluded, axis=1))
+
+    def reindex(self, names):
+        """
+        Returns the dictionary with the ids of the given station names,
+        eg. the names of the stations of several hubs, so that a station
+        has the same id in the dictionaries of all of them.
+        The stations that are not in this dictionary have no trains
+        to and from the hub, no direction and no excluded pairs.
+
+        Args:
+        - names: sorted station names, which contain the names of this dictionary
+        """
+        names = np.asarray(names, dtype=object)
+        ids = pd.Index(names).get_indexer(self.names)
+        if (ids < 0).any():
+            raise ValueError(f"The names do not contain {self.names[ids < 0].tolist()}")
+        incoming = np.zeros(len(names), dtype=bool)
+        incoming[ids] = self.incoming
+        outgoing = np.zeros(len(names), dtype=bool)
+        outgoing[ids] = self.outgoing
+        direction = np.full(len(names), -1, dtype=np.int8)
+        direction[ids] = self.direction
+        excluded = np.zeros((len(names), len(names)), dtype=bool)
+        excluded[np.ix_(ids, ids)] = self.excluded_matrix()
+        return StationDictionary(names, incoming, outgoing, direction,
+                                 self.direction_names, np.packbits(excluded, axis=1))
+
+    def __len__(self):
+        return len(self.names)
+
+    def ids(self, names):
+        """Ids of the given station names, -1 for unknown names"""
+        return self._index.get_indexer(list(names))
+
+    def mask(self, names):
+        """Bool array of the stations that are in names"""
+        return self._index.isin(list(names))
+
+    def is_excluded(self, origins, destinations):
+        """Whether the pairs of origin and destination ids are excluded"""
+        origins = np.asarray(origins)
+        destinations = np.asarray(destinations)
+        return (self.excluded[origins, destinations >> 3]
+                >> (7 - (destinations & 7)) & 1).astype(bool)
+
+    def excluded_matrix(self):
+        """Bool matrix of the excluded pairs, indexed by origin and destination id"""
+        return np.unpackbits(self.excluded, axis=1, count=len(self)).astype(bool)
+
+    def pairs(self, origins=None, destinations=None):
+        """
+        Selects the (origin, destination) pairs to analyse: pairs of
+        different stations that are not excluded, and that do not both
+        lie in the same direction.
+
+        Args:
+        - origins (optional): bool array of the possible origins.
+            Defaults to all stations with trains to the hub.
+        - destinations (optional): bool array of the possible destinations.
+            Defaults to all stations with trains from the hub.
+
+        Returns:
+        - origin_ids, destination_ids: arrays of the ids of the pairs,
+            sorted by origin and destination
+        """
+        origins = self.incoming if origins is None else np.asarray(origins, dtype=bool)
+        destinations = self.outgoing if destinations is None \
+            else np.asarray(destinations, dtype=bool)
+        is_pair = origins[:, np.newaxis] & destinations[np.newaxis, :]
+        np.fill_diagonal(is_pair, False)
+        is_pair &= ~self.excluded_matrix()
+        has_direction = self.direction >= 0
+        is_pair &= ~((self.direction[:, np.newaxis] == self.direction[np.newaxis, :])
+                     & has_direction[:, np.newaxis])
+        return np.nonzero(is_pair)
+
+    def pair_names(self, origins=None, destinations=None):
+        """The pairs selected by pairs, as a list of (origin, destination) names"""
+        origin_ids, destination_ids = self.pairs(origins, destinations)
+        return list(zip(self.names[origin_ids].tolist(),
+                        self.names[destination_ids].tolist()))
@@ -0,0 +1,296 @@
+"""
+This file contains the StopTable, a compact representation
+of train connections and the stops of every train.
+
+Instead of storing the stops of a train as python lists inside
+the cells of a DataFrame, the stops of all trains are stored in flat
+numpy arrays, and the stops of the i-th train are located at
+offsets[i]:offsets[i+1] within them.
+"""
+import numpy as np
+import pandas as pd
+
+
+class StopTable:
+    """
+    Train connections, with one row per train in `trains`,
+    and the stops of all trains in flat arrays.
+
+    For incoming trains, the stops are the stations the train departed
+    from before arriving at Frankfurt(Main)Hbf, and `time` is the
+    planned departure at each stop.
+    For outgoing trains, the stops are the stations the train arrives at
+    after departing from Frankfurt(Main)Hbf, and `time` is the
+    planned arrival at each stop.
+    The stops of every train are ordered by time.
+
+    Attributes:
+    - trains: DataFrame with one row per train (scalar columns only)
+    - offsets: int64 array of length len(trains) + 1
+    - station: int32 array of station codes per stop
+    - stations: array of station names, indexed by station code
+    - time: datetime64 array of planned departures/arrivals per stop
+    - delay: float64 array of delays in minutes per stop
+        (float32 in compact tables, see data_io.load_stop_table)
+    - cancellation: int8 array of cancellation codes per stop
+        (see data_tools.cancellation_to_int)
+    """
+
+    def __init__(self, trains, offsets, station, stations,
+                 time, delay, cancellation):
+        # Only reindex (and thereby copy) trains if necessary, so that
+        # trains can be a view of shared memory (see scheduler)
+        if not trains.index.equals(pd.RangeIndex(len(trains))):
+            trains = trains.reset_index(drop=True)
+        self.trains = trains
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.station = np.asarray(station, dtype=np.int32)
+        self.stations = np.asarray(stations, dtype=object)
+        self.time = np.asarray(time, dtype='datetime64[ns]')
+        self.delay = np.asarray(delay)
+        if self.delay.dtype != np.float32:
+            self.delay = self.delay.astype(np.float64, copy=False)
+        self.cancellation = np.asarray(cancellation, dtype=np.int8)
+        self._station_codes = None
+        self._station_index = None
+
+    @classmethod
+    def from_rows(cls, rows, keys, station, time, stations=None):
+        """
+        Groups individual rows (stops of a train) into trains.
+
+        Args:
+        - rows: DataFrame with one row per stop, sorted such that
+            the stops of every train are in the desired order
+        - keys: list of columns identifying a train
+        - station: column containing the station name of a stop
+        - time: column containing the planned time of a stop
+        - stations (optional): station names to use as the station
+            dictionary. By default, the stations in rows are used.
+
+        Returns:
+        - StopTable with one train per unique combination of keys,
+            with trains sorted by keys.
+            The trains DataFrame contains only the key columns.
+        """
+        rows = rows.dropna(subset=keys)
+        grouped = rows.groupby(keys, sort=True, observed=True)
+        group = grouped.ngroup().to_numpy()
+        # Stable sort keeps the original order of stops within each train
+        order = np.argsort(group, kind='stable')
+        counts = np.bincount(group)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        if stations is None:
+            codes, stations = pd.factorize(rows[station].to_numpy()[order])
+        else:
+            codes = pd.Categorical(rows[station].to_numpy()[order],
+                                   categories=stations).codes
+        return cls(grouped.size().reset_index()[keys],
+                   offsets,
+                   codes,
+                   stations,
+                   pd.to_datetime(rows[time]).to_numpy()[order],
+                   rows['delay'].to_numpy(dtype=np.float64)[order],
+                   rows['cancellation'].to_numpy()[order])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        """Number of stops of every train"""
+        return np.diff(self.offsets)
+
+    @property
+    def stop_train(self):
+        """Row of the train every stop belongs to"""
+        return np.repeat(np.arange(len(self), dtype=np.int64), self.lengths)
+
+    def take(self, rows, trains=None):
+        """
+        Returns a new StopTable containing only the given trains.
+
+        Args:
+        - rows: boolean mask or integer positions of the trains to keep
+        - trains (optional): DataFrame to use as the trains of the
+            returned table instead of the selected rows of self.trains.
+            Has to be aligned with rows.
+        """
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        starts = self.offsets[:-1][rows]
+        lengths = self.lengths[rows]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # Index of every selected stop in the flat arrays
+        index = np.repeat(starts - offsets[:-1], lengths) \
+            + np.arange(offsets[-1], dtype=np.int64)
+        if trains is None:
+            trains = self.trains.iloc[rows]
+        return StopTable(trains, offsets, self.station[index], self.stations,
+                         self.time[index], self.delay[index],
+                         self.cancellation[index])
+
+    def station_code(self, name):
+        """Returns the code of a station name, or -1 if it does not occur."""
+        if self._station_codes is None:
+            self._station_codes = {s: c for c, s in enumerate(self.stations)}
+        return self._station_codes.get(name, -1)
+
+    def station_names(self, codes):
+        """Translates station codes to station names."""
+        return self.stations[codes]
+
+    @property
+    def station_index(self):
+        """StationIndex of this table, built on first use"""
+        if self._station_index is None:
+            self._station_index = StationIndex.build(self)
+        return self._station_index
+
+    @station_index.setter
+    def station_index(self, station_index):
+        self._station_index = station_index
+
+    def trains_at(self, name):
+        """
+        Returns the rows of the trains that stop at the given station,
+        and the position of the (first) stop at the station
+        within each of these trains.
+        """
+        return self.station_index.lookup(self.station_code(name))
+
+    def position(self, name):
+        """
+        Returns, for every train, the position of the (first) stop
+        at the given station within the train, or -1 if the train
+        does not stop there.
+        """
+        result = np.full(len(self), -1, dtype=np.int64)
+        rows, positions = self.trains_at(name)
+        result[rows] = positions
+        return result
+
+    def first(self, values, rows=None):
+        """Values of the first stop of every train (or of rows)"""
+        starts = self.offsets[:-1]
+        return values[starts if rows is None else starts[rows]]
+
+    def last(self, values, rows=None):
+        """Values of the last stop of every train (or of rows)"""
+        ends = self.offsets[1:] - 1
+        return values[ends if rows is None else ends[rows]]
+
+    def at(self, values, pos, rows=None):
+        """
+        Values of the stop at position pos within every train (or rows).
+        pos may be a scalar or an array aligned with the trains.
+        """
+        starts = self.offsets[:-1]
+        return values[(starts if rows is None else starts[rows]) + pos]
+
+    def any_stop(self, stop_mask):
+        """Returns, for every train, whether stop_mask is true for any stop"""
+        return np.bincount(self.stop_train, weights=stop_mask,
+                           minlength=len(self)) > 0
+
+    def memory_usage(self):
+        """
+        Returns the number of bytes of every column of the trains,
+        every array of the stops and of the station index (if it exists),
+        as a Series.
+        """
+        usage = {f'trains.{column}': nbytes for column, nbytes
+                 in self.trains.memory_usage(index=False, deep=True).items()}
+        for name in ('offsets', 'station', 'time', 'delay', 'cancellation'):
+            usage[f'stops.{name}'] = getattr(self, name).nbytes
+        if self._station_index is not None:
+            for name in ('offsets', 'train_rows', 'positions'):
+                usage[f'index.{name}'] = getattr(self._station_index, name).nbytes
+        return pd.Series(usage)
+
+    def station_lists(self):
+        """Yields the list of station names for every train"""
+        names = self.stations[self.station]
+        for start, end in zip(self.offsets[:-1], self.offsets[1:]):
+            yield list(names[start:end])
+
+
+def integer_array(values):
+    """values as an array of its integer dtype, or of int64 if it is not one"""
+    values = np.asarray(values)
+    return values if values.dtype.kind in 'iu' else values.astype(np.int64)
+
+
+class StationIndex:
+    """
+    Inverted index from stations to the trains of a StopTable
+    that stop there.
+    The trains stopping at the station with code c are
+    train_rows[offsets[c]:offsets[c+1]] (in ascending order),
+    and positions contains the position of the (first) stop at the
+    station within each of these trains.
+
+    train_rows and positions may have narrower integer dtypes than int64
+    (see data_io.load_station_index).
+    The index also holds caches for views of the StopTable per station
+    (see analysis.select_outgoing_to_destination and
+    analysis.outgoing_calendar), so that they are only computed once.
+    """
+
+    def __init__(self, offsets, train_rows, positions):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.train_rows = integer_array(train_rows)
+        self.positions = integer_array(positions)
+        self.views = {}
+        self.calendars = {}
+
+    @classmethod
+    def build(cls, stop_table):
+        """Builds the index of a StopTable"""
+        # Stable sort keeps the trains and their stops in order per station
+        order = np.argsort(stop_table.station, kind='stable')
+        # Stops at stations missing from the station names are not indexed
+        order = order[stop_table.station[order] >= 0]
+        stations = stop_table.station[order]
+        train_rows = stop_table.stop_train[order]
+        # Only keep the first stop of a train at a station,
+        # equivalent to list.index
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (stations[1:] != stations[:-1]) \
+            | (train_rows[1:] != train_rows[:-1])
+        order, stations, train_rows = \
+            order[first], stations[first], train_rows[first]
+        return cls.from_entries(stations, train_rows,
+                                order - stop_table.offsets[train_rows],
+                                len(stop_table.stations))
+
+    @classmethod
+    def from_entries(cls, stations, train_rows, positions, num_stations):
+        """
+        Builds the index from entries (station code, train row, position)
+        sorted by station code and train row.
+        """
+        offsets = np.zeros(num_stations + 1, dtype=np.int64)
+        np.cumsum(np.bincount(stations, minlength=num_stations),
+                  out=offsets[1:])
+        return cls(offsets, train_rows, positions)
+
+    def lookup(self, code):
+        """
+        Returns the rows of the trains stopping at the station with
+        the given code, and the positions of the stops within them.
+        """
+        if code < 0 or code >= len(self.offsets) - 1:
+            return (np.zeros(0, dtype=np.int64),
+                    np.zeros(0, dtype=np.int64))
+        start, end = self.offsets[code], self.offsets[code + 1]
+        return self.train_rows[start:end], self.positions[start:end]
+
+    def entries(self):
+        """Returns the index as arrays (station code, train row, position)"""
+        stations = np.repeat(np.arange(len(self.offsets) - 1),
+                             np.diff(self.offsets))
+        return stations, self.train_rows, self.positions
@@ -0,0 +1,309 @@
+"""
+This file contains a generator of synthetic scraped data, in the format of
+the scraped csv files (see the .SAMPLE files), at a configurable scale.
+It is used to measure the performance of the code (see benchmark.py)
+without the dataset, and the results of the analysis on it are meaningless.
+
+The data consists of train lines that run through a hub (see hubs.py),
+by default Frankfurt(Main)Hbf, every day (unless they are left out on some
+days), with stops before the hub from one direction
+(see data_io.load_directions) and stops after the hub to another direction,
+so that the incoming and outgoing rows of a train can be matched in
+preprocessing. Like in the dataset, some trains stop at the airport right
+before or after Frankfurt(Main)Hbf, trains can pass midnight, and the
+stations that are named differently in the coordinates file
+(see data_tools.unique_station_names) occur in the data.
+The stations are the ones of the directions of Frankfurt(Main)Hbf for every
+hub, and lie in the same direction (see data_tools.DIRECTION_BEARINGS)
+from the hub as from Frankfurt.
+"""
+import os
+from datetime import date, timedelta
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import data_io
+import data_tools
+import hubs
+
+# Coordinates (longitude, latitude) of the hubs
+HUB_COORDINATES = {'frankfurt_hbf': (8.663, 50.107), 'koeln_hbf': (6.959, 50.943),
+                   'hannover_hbf': (9.741, 52.377), 'mannheim_hbf': (8.469, 49.479)}
+CANCELLED_AT_ORIGIN = 'Ausfall (Startbahnhof)'
+CANCELLED_AT_DESTINATION = 'Ausfall (Zielbahnhof)'
+TRAIN_CATEGORIES = ['ICE', 'IC', 'EC']
+# Number of days that are generated (and written) at once
+DAYS_PER_CHUNK = 28
+# Planned minutes between two stops of a train
+MIN_TRAVEL_MINUTES = 20
+MAX_TRAVEL_MINUTES = 70
+# Planned minutes a train stays in the hub
+MIN_DWELL_MINUTES = 2
+MAX_DWELL_MINUTES = 8
+
+
+class Lines:
+    """
+    Timetable of the train lines, with one row per stop before
+    (incoming) and after (outgoing) the hub.
+    Stop offsets are the planned minutes relative to the arrival (incoming)
+    or departure (outgoing) at the hub.
+    """
+
+    def __init__(self, rng, hub, directions, trains_per_day, stops_per_train,
+                 undirected_stations, undirected_share, airport_share):
+        direction_names = list(directions)
+        undirected = [f'Synthetic station {i + 1}' for i in range(undirected_stations)]
+        self.names = [f'{TRAIN_CATEGORIES[i % len(TRAIN_CATEGORIES)]} {100 + i}'
+                      for i in range(trains_per_day)]
+        self.hub_minute = rng.integers(0, 24 * 60, trains_per_day)
+        self.dwell = rng.integers(MIN_DWELL_MINUTES, MAX_DWELL_MINUTES + 1,
+                                  trains_per_day)
+        stations_in, stations_out = [], []
+        for _ in range(trains_per_day):
+            direction_in, direction_out = rng.choice(direction_names, 2, replace=False)
+            num_in, num_out = rng.integers(0, stops_per_train + 1, 2)
+            if num_in + num_out == 0:
+                num_out = 1
+            stops_in = self.choose_stations(rng, directions[direction_in], num_in,
+                                            undirected, undirected_share)
+            stops_out = self.choose_stations(rng, directions[direction_out], num_out,
+                                             undirected, undirected_share)
+            if hub.airport is not None:
+                if stops_in and rng.random() < airport_share:
+                    stops_in[-1] = hub.airport
+                if stops_out and rng.random() < airport_share:
+                    stops_out[0] = hub.airport
+            stations_in.append(stops_in)
+            stations_out.append(stops_out)
+        # Every renamed station occurs in one of the first lines
+        # (see generate_chunk), so that it is in the data
+        for i, station in enumerate(data_tools.COORDINATES_NAMES):
+            stops_out = stations_out[i % trains_per_day]
+            if station == hub.airport and station not in stops_out:
+                stops_out.insert(0, station)
+            elif station not in stops_out:
+                stops_out.append(station)
+        self.stations = sorted({hub.station, *data_tools.COORDINATES_NAMES, *undirected,
+                                *(s for stations in directions.values() for s in stations)})
+        station_codes = {station: i for i, station in enumerate(self.stations)}
+        for side, stations, sign in (('in', stations_in, -1), ('out', stations_out, 1)):
+            counts = np.array([len(stops) for stops in stations], dtype=np.int64)
+            station = np.array([station_codes[s] for stops in stations for s in stops],
+                               dtype=np.int64)
+            # Stops are ordered by time, so the incoming offsets count down
+            # to the arrival in the hub
+            travel = rng.integers(MIN_TRAVEL_MINUTES, MAX_TRAVEL_MINUTES + 1, len(station))
+            if sign > 0:
+                cumulative = grouped_cumsum(travel, counts)
+            else:
+                cumulative = grouped_cumsum(travel[::-1], counts[::-1])[::-1]
+            setattr(self, f'counts_{side}', counts)
+            setattr(self, f'offsets_{side}', np.concatenate([[0], np.cumsum(counts)]))
+            setattr(self, f'station_{side}', station)
+            setattr(self, f'minutes_{side}', sign * cumulative)
+
+    @staticmethod
+    def choose_stations(rng, stations, num, undirected, undirected_share):
+        chosen = [str(s) for s in rng.choice(stations, min(num, len(stations)),
+                                             replace=False)]
+        for i in range(len(chosen)):
+            if undirected and rng.random() < undirected_share:
+                station = undirected[rng.integers(len(undirected))]
+                if station not in chosen:
+                    chosen[i] = station
+        return chosen
+
+
+def grouped_cumsum(values, counts):
+    """Cumulative sums of values within consecutive groups of the given sizes"""
+    total = np.cumsum(values)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    before = np.concatenate([[0], total])[starts]
+    return total - np.repeat(before, counts)
+
+
+def expand(counts, offsets, trains):
+    """
+    For every stop of every train (line of the train given by trains),
+    returns the index of the train and the index of the stop in the timetable.
+    """
+    stop_counts = counts[trains]
+    train_of_stop = np.repeat(np.arange(len(trains)), stop_counts)
+    first = np.concatenate([[0], np.cumsum(stop_counts)[:-1]])
+    position = np.arange(len(train_of_stop)) - np.repeat(first, stop_counts)
+    return train_of_stop, offsets[trains][train_of_stop] + position
+
+
+def cancellations(rng, num, cancellation_rate, destination_cancellation_rate):
+    """Random cancellation column, where '' means not cancelled"""
+    draw = rng.random(num)
+    return np.where(draw < cancellation_rate, CANCELLED_AT_ORIGIN,
+                    np.where(draw < cancellation_rate + destination_cancellation_rate,
+                             CANCELLED_AT_DESTINATION, ''))
+
+
+def format_minutes(minutes, start_date):
+    """
+    Formats minutes since start_date as date and time strings
+    of the scraped data. The strings are looked up,
+    as there are only few different ones.
+    """
+    days, day_codes = np.unique(minutes // (24 * 60), return_inverse=True)
+    dates = np.array([(start_date + timedelta(days=int(day))).strftime('%d.%m.%Y')
+                      for day in days], dtype=object)
+    times = np.array([f'{m // 60:02d}:{m % 60:02d}' for m in range(24 * 60)],
+                     dtype=object)
+    return dates[day_codes], times[minutes % (24 * 60)]
+
+
+def generate_chunk(rng, hub, lines, first_day, num_days, start_date, service_probability,
+                   delay_mean, delay_spread, cancellation_rate,
+                   destination_cancellation_rate):
+    """
+    Generates the incoming and outgoing rows of num_days days,
+    starting at day first_day after start_date.
+    """
+    runs = rng.random((num_days, len(lines.names))) < service_probability
+    # The lines with the renamed stations always run
+    runs[:, :len(data_tools.COORDINATES_NAMES)] = True
+    day, line = np.nonzero(runs)
+    day = day + first_day
+    arrival = day * 24 * 60 + lines.hub_minute[line]
+    departure = arrival + lines.dwell[line]
+    delay_in = np.round(rng.exponential(delay_mean, len(line)))
+    # Delay when leaving the hub, if the train waits for the planned time
+    delay_departure = np.maximum(0, delay_in - lines.dwell[line])
+    names = np.array(lines.names, dtype=object)
+    stations = np.array(lines.stations, dtype=object)
+
+    train, stop = expand(lines.counts_in, lines.offsets_in, line)
+    # The date of a row is the date of its departure
+    dates, departures = format_minutes(arrival[train] + lines.minutes_in[stop],
+                                       start_date)
+    incoming = pd.DataFrame({
+        'origin': stations[lines.station_in[stop]],
+        'destination': hub.station,
+        'date': dates,
+        'departure': departures,
+        'arrival': format_minutes(arrival[train], start_date)[1],
+        'train': names[line[train]],
+        'delay': delay_in[train].astype(int),
+        'cancellation': cancellations(rng, len(stop), cancellation_rate,
+                                      destination_cancellation_rate)})
+
+    train, stop = expand(lines.counts_out, lines.offsets_out, line)
+    dates, departures = format_minutes(departure[train], start_date)
+    delay_out = np.round(delay_departure[train] + grouped_cumsum(
+        rng.normal(0, delay_spread, len(stop)), lines.counts_out[line]))
+    outgoing = pd.DataFrame({
+        'origin': hub.station,
+        'destination': stations[lines.station_out[stop]],
+        'date': dates,
+        'departure': departures,
+        'arrival': format_minutes(departure[train] + lines.minutes_out[stop],
+                                  start_date)[1],
+        'train': names[line[train]],
+        'delay': np.maximum(0, delay_out).astype(int),
+        'cancellation': cancellations(rng, len(stop), cancellation_rate,
+                                      destination_cancellation_rate)})
+    return incoming, outgoing
+
+
+def station_coordinates(rng, hub, stations, directions):
+    """
+    Coordinates in the format of the coordinates file,
+    with the stations of a direction lying in that direction from the hub.
+    """
+    bearings = {station: data_tools.DIRECTION_BEARINGS.get(direction, 0)
+                for direction, direction_stations in directions.items()
+                for station in direction_stations}
+    hub_longitude, hub_latitude = HUB_COORDINATES[hub.key]
+    rows = []
+    for i, station in enumerate(stations):
+        if station == hub.station:
+            longitude, latitude = hub_longitude, hub_latitude
+        else:
+            bearing = np.radians(bearings.get(station, rng.uniform(0, 360))
+                                 + rng.uniform(-40, 40))
+            distance = rng.uniform(20, 500) if station != hub.airport else 10
+            latitude = hub_latitude + distance * np.cos(bearing) / 111.2
+            longitude = hub_longitude + distance * np.sin(bearing) \
+                / (111.2 * np.cos(np.radians(hub_latitude)))
+        rows.append({'EVA_NR': 8000000 + i, 'DS100': f'X{i}', 'IFOPT': f'de:{i}',
+                     'NAME': data_tools.COORDINATES_NAMES.get(station, station),
+                     'Verkehr': 'FV',
+                     'Laenge': f'{longitude:.6f}'.replace('.', ','),
+                     'Breite': f'{latitude:.6f}'.replace('.', ','),
+                     'Betreiber_Name': 'DB', 'Betreiber_Nr': 1, 'Status': ''})
+    return pd.DataFrame(rows)
+
+
+def generate_scraped_data(dirname, days=30, trains_per_day=200, stops_per_train=4,
+                          service_probability=0.95, delay_mean=4.0, delay_spread=2.0,
+                          cancellation_rate=0.03, destination_cancellation_rate=0.02,
+                          undirected_stations=20, undirected_share=0.1,
+                          airport_share=0.15, start_date=date(2022, 1, 1), seed=0,
+                          hub=None):
+    """
+    Writes synthetic scraped incoming and outgoing csv files,
+    and a coordinates file for the stations in them.
+
+    Args:
+    - dirname: directory in which the files are written
+    - days (optional): number of days of data
+    - trains_per_day (optional): number of train lines, each of which
+        runs through the hub at most once per day
+    - stops_per_train (optional): maximum number of stops of a train before
+        and after the hub (the number is uniform between 0 and this)
+    - service_probability (optional): probability that a line runs on a day
+    - delay_mean (optional): mean delay in minutes at the hub
+        (exponentially distributed)
+    - delay_spread (optional): standard deviation of the change of the delay
+        in minutes between two stops after Frankfurt
+    - cancellation_rate (optional): fraction of stops that are cancelled
+        at their origin
+    - destination_cancellation_rate (optional): fraction of stops
+        that are cancelled at their destination
+    - undirected_stations (optional): number of additional stations that are
+        in none of the directions
+    - undirected_share (optional): fraction of stops at those stations
+    - airport_share (optional): fraction of trains that stop at the airport
+        right before or after the hub (if it has one, see hubs.Hub)
+    - start_date (optional): date of the first day
+    - seed (optional): seed of the random number generator
+    - hub (optional): the hub or its key (see hubs.get_hub)
+
+    Returns:
+    - paths: dict with the paths of the 'incoming', 'outgoing'
+        and 'coordinates' files
+    """
+    rng = np.random.default_rng(seed)
+    hub = hubs.get_hub(hub)
+    directions = data_io.load_directions()
+    if hub is not hubs.DEFAULT_HUB:
+        # The stations of the city of the hub are not in a direction from it
+        directions = {direction: [station for station in stations if hub.city not in station]
+                      for direction, stations in directions.items()}
+    lines = Lines(rng, hub, directions, trains_per_day, stops_per_train,
+                  undirected_stations, undirected_share, airport_share)
+    Path(dirname).mkdir(parents=True, exist_ok=True)
+    paths = {'incoming': os.path.join(dirname, hub.incoming_basename),
+             'outgoing': os.path.join(dirname, hub.outgoing_basename),
+             'coordinates': os.path.join(dirname, data_io.COORDINATES_BASENAME)}
+    num_rows = {'incoming': 0, 'outgoing': 0}
+    for first_day in range(0, days, DAYS_PER_CHUNK):
+        chunk = generate_chunk(
+                rng, hub, lines, first_day, min(DAYS_PER_CHUNK, days - first_day),
+                start_date, service_probability, delay_mean, delay_spread,
+                cancellation_rate, destination_cancellation_rate)
+        for name, rows in zip(('incoming', 'outgoing'), chunk):
+            # The scraped files have no header
+            rows.to_csv(paths[name], header=False, index=False,
+                        mode='w' if first_day == 0 else 'a')
+            num_rows[name] += len(rows)
+    station_coordinates(rng, hub, lines.stations, directions) \
+        .to_csv(paths['coordinates'], sep=';', index=False)
+    print(f"Generated {num_rows['incoming']} incoming and "
+          f"{num_rows['outgoing']} outgoing rows in {dirname}")
+    return paths